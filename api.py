@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+Normalize and encode files from other Python code, without normalize.py.
+
+submit() plans the jobs, starts them on a pool of worker threads and
+returns a Batch right away:
+
+    with api.submit(["a.flac", "b.flac"], formats=["aac", "mp3"], target=-16,
+                    output="converted", database="converted/volumes.db", log_level="ERROR") as batch:
+        for result in batch.as_completed():
+            print(result.job.output, result.lufs, result.gain)
+
+Every source is hashed and analyzed once, however many formats it is
+encoded to, and measurements found in the database are not repeated.
+Every format is encoded by the fastest available encoder within the
+quality profile, like in normalize.py (see backends.py).
+Failed jobs raise their encoder's exception from Future.result().
+The modules log through one shared logger, log_level sets its level
+while a batch runs.
+"""
+
+__all__ = ["submit", "Batch", "Loudness", "Result", "APIError"]
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from threading import Lock, local
+import logging
+import os
+import time
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+from utils import atomic_output
+from ffmpeg import FFmpeg, FFmpegException
+from qaac import Qaac, QaacException
+from lame import LAME, LAMEException
+from backends import QUALITY_PROFILES, CALIBRATION_FILE, Calibration, select_backend
+from database import Database
+from events import EventStream
+from plan import plan, FORMATS
+
+
+
+class APIError(Exception):
+    pass
+
+
+class Loudness:
+    """What the analysis of a source measured, and the gain to the target."""
+    __slots__ = ("md5", "lufs", "peak", "gain")
+
+    def __init__(self, md5, lufs, peak, gain):
+        self.md5 = md5
+        self.lufs = lufs
+        self.peak = peak
+        self.gain = gain
+
+    def __repr__(self):
+        return "Loudness(md5={!r}, lufs={!r}, peak={!r}, gain={!r})".format(self.md5, self.lufs, self.peak, self.gain)
+
+
+class Result:
+    """A finished job: the job with the gain it was encoded with and its source's loudness."""
+    __slots__ = ("job", "loudness", "seconds")
+
+    def __init__(self, job, loudness, seconds):
+        self.job = job
+        self.loudness = loudness
+        self.seconds = seconds
+
+    @property
+    def lufs(self):
+        return self.loudness.lufs
+
+    @property
+    def peak(self):
+        return self.loudness.peak
+
+    @property
+    def gain(self):
+        return self.job.gain
+
+    def __repr__(self):
+        return "Result(job={!r}, loudness={!r}, seconds={!r})".format(self.job, self.loudness, self.seconds)
+
+
+class Batch:
+    """Handle of the jobs started by submit().
+
+    futures maps every planned Job (without gain) to a Future of its
+    Result, analyses maps every source to a Future of its Loudness,
+    backends maps every format to the (encoder name, method) making it.
+    progress(task, position, duration) is called from the worker threads,
+    task is the Job of an encode or the source of an analysis.
+
+    Used as a context manager, leaving waits for the batch to finish, or
+    to stop after the running jobs on an exception. With a log_level the
+    logger is set to it until close() and then back to its former level.
+    """
+    def __init__(self, sources, formats, target, output, album, workers, database, progress, overwrite, fsync,
+                 ffmpeg, qaac, lame, profile, calibration, log_level=None):
+        self._former_level = None
+        if log_level is not None:
+            former = logging.getLevelName(log.level)
+            try:
+                log.level = log_level
+            except AttributeError as err:
+                raise APIError(err) from None
+            self._former_level = former
+
+        try:
+            self._start(sources, formats, target, output, album, workers, database, progress, overwrite, fsync,
+                        ffmpeg, qaac, lame, profile, calibration)
+        except BaseException:
+            self._restore_level()
+            raise
+
+    def _start(self, sources, formats, target, output, album, workers, database, progress, overwrite, fsync,
+               ffmpeg, qaac, lame, profile, calibration):
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise APIError("Unknown formats: {}".format(", ".join(sorted(unknown))))
+        if profile not in QUALITY_PROFILES:
+            raise APIError("Unknown quality profile: {}".format(profile))
+
+        self.target = target
+        self._album = album
+        self._progress = progress
+        self._fsync = fsync
+        self._paths = tuple(pathlib.Path(path) if path else None for path in (ffmpeg, qaac, lame))
+        self._local = local()
+        self.backends = self._select_backends(formats, profile, calibration)
+
+        try:
+            self._db = Database(database, in_memory=(database is None))
+        except Exception as err:
+            raise APIError("Could not open database {}: {}".format(database, err)) from None
+        self._db_lock = Lock()
+
+        # outputs go into one subfolder per format of output or of the source's folder:
+        sources = [pathlib.Path(source).absolute() for source in sources]
+        self.jobs = []
+        for source in sources:
+            folder = pathlib.Path(output).absolute() if output else source.parent
+            jobs = plan([source], folder, formats, lambda path: overwrite or not path.exists())
+            self.jobs.extend(job for name in formats for job in jobs[name])
+
+        self.futures = {job: Future() for job in self.jobs}
+
+        # with album gain every source counts, not only the ones still to encode:
+        needed = sources if album else list(dict.fromkeys(job.source for job in self.jobs))
+
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.analyses = {source: self._executor.submit(self._analyze, source) for source in needed}
+
+        if album:
+            self._pending = len(self.analyses)
+            self._pending_lock = Lock()
+            for analysis in self.analyses.values():
+                analysis.add_done_callback(self._album_analyzed)
+        else:
+            for job in self.jobs:
+                self.analyses[job.source].add_done_callback(
+                    lambda analysis, job=job: self._schedule(job, analysis, None))
+
+    def _restore_level(self):
+        if self._former_level is not None:
+            log.level, self._former_level = self._former_level, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+        return False
+
+    def _encoder(self, name):
+        # the encoders keep the state of the running job, so every
+        # worker thread has its own:
+        encoders = getattr(self._local, "encoders", None)
+        if encoders is None:
+            encoders = self._local.encoders = {}
+
+        if name not in encoders:
+            ffmpeg_path, qaac_path, lame_path = self._paths
+            if name == "ffmpeg":
+                encoders[name] = FFmpeg(path=ffmpeg_path)
+            else:
+                ff_path = pathlib.Path(self._encoder("ffmpeg").path)
+                if name == "qaac":
+                    encoders[name] = Qaac(ff_path=ff_path, qaac_path=qaac_path)
+                else:
+                    encoders[name] = LAME(ff_path=ff_path, lame_path=lame_path)
+        return encoders[name]
+
+    def _select_backends(self, formats, profile, calibration):
+        # the encoders found on this host, qaac and lame are optional:
+        try:
+            encoders = {"ffmpeg": self._encoder("ffmpeg")}
+        except (FFmpegException, ValueError) as err:
+            raise APIError("Could not run ffmpeg: {}".format(err)) from None
+        for name, errors in (("qaac", QaacException), ("lame", LAMEException)):
+            try:
+                encoders[name] = self._encoder(name)
+            except (errors, ValueError) as err:
+                log.d("no {}: {}", name, err)
+                encoders[name] = None
+
+        calibration = Calibration(calibration) if calibration else None
+        backends = {}
+        for name in formats:
+            backends[name] = select_backend(name, encoders, profile, calibration)
+            if backends[name] is None:
+                raise APIError("No available encoder makes {} within the {} quality profile.".format(name, profile))
+        return backends
+
+    def _converter(self, name):
+        encoder, method = self.backends[name]
+        return getattr(self._encoder(encoder), method)
+
+    def _start_progress(self, task):
+        if self._progress:
+            EventStream().start_job(None, callback=lambda position, duration: self._progress(task, position, duration))
+
+    def _analyze(self, source):
+        md5 = Database.md5sum(source)
+        with self._db_lock:
+            record = self._db.get_record(md5)
+
+        # older entries only have a gain, album gain needs the histogram:
+        if record and "lufs" in record and (not self._album or "hist" in record):
+            return Loudness(md5, record["lufs"], record.get("peak"), round(self.target - record["lufs"], 1))
+
+        ffmpeg = self._encoder("ffmpeg")
+        self._start_progress(source)
+        try:
+            lufs, peak = ffmpeg.analyze_volume(source)
+        finally:
+            EventStream().end_job()
+
+        gain = round(self.target - lufs, 1)
+        with self._db_lock:
+            self._db.set_entry(md5, {"gain": gain,
+                                     "lufs": lufs,
+                                     "peak": peak,
+                                     "hist": ffmpeg.histogram.encode()}, replace=True)
+        return Loudness(md5, lufs, peak, gain)
+
+    def _fail(self, jobs, err):
+        for job in jobs:
+            future = self.futures[job]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(err)
+
+    def _album_analyzed(self, analysis):
+        with self._pending_lock:
+            self._pending -= 1
+            if self._pending:
+                return
+
+        # runs in the thread of the last analysis, errors must end up in the futures:
+        try:
+            md5s = [analysis.result().md5 for analysis in self.analyses.values()]
+            with self._db_lock:
+                lufs = self._db.integrated_loudness(md5s)
+            if lufs is None:
+                raise APIError("The database has no gating blocks for some of the sources.")
+        except BaseException as err:
+            self._fail(self.jobs, err)
+            return
+
+        album = round(self.target - lufs, 1)
+        log.i("Album loudness is {} LUFS, applying {} dB to all files.", lufs, album)
+
+        for job in self.jobs:
+            self._schedule(job, self.analyses[job.source], album)
+
+    def _schedule(self, job, analysis, gain):
+        if analysis.exception():
+            self._fail([job], analysis.exception())
+            return
+
+        loudness = analysis.result()
+        self._executor.submit(self._encode, job.with_gain(loudness.gain if gain is None else gain, loudness.lufs),
+                              self.futures[job], loudness)
+
+    def _encode(self, job, future, loudness):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        start = time.perf_counter()
+        try:
+            convert = self._converter(job.format)
+            job.output.parent.mkdir(parents=True, exist_ok=True)
+
+            self._start_progress(job)
+            try:
+                with atomic_output(job.output, fsync=self._fsync) as temp_file:
+                    convert(job.source, temp_file, volume=job.gain)
+            finally:
+                EventStream().end_job()
+
+        except BaseException as err:
+            future.set_exception(err)
+        else:
+            future.set_result(Result(job, loudness, time.perf_counter() - start))
+
+    def as_completed(self, timeout=None):
+        """Yield the results of the jobs as they finish."""
+        for future in as_completed(self.futures.values(), timeout=timeout):
+            yield future.result()
+
+    def wait(self, timeout=None):
+        """Wait for all jobs, return the (done, not_done) sets of futures."""
+        return wait(self.futures.values(), timeout=timeout)
+
+    def cancel(self):
+        """Cancel the jobs that have not started, return how many."""
+        return sum(future.cancel() for future in self.futures.values())
+
+    def close(self, cancel=False):
+        """Wait for the jobs (only the running ones with cancel) and stop the workers."""
+        if cancel:
+            self.cancel()
+        wait(list(self.analyses.values()))
+        self.wait()
+        self._executor.shutdown(wait=True)
+        self._restore_level()
+
+
+def submit(sources, formats=("aac",), target=-16, output=None, album=False, workers=None, database=None,
+           progress=None, overwrite=False, fsync="file", ffmpeg=None, qaac=None, lame=None, profile="best",
+           calibration=CALIBRATION_FILE, log_level=None):
+    """Start normalizing sources to target LUFS in formats, return a Batch.
+
+    Args:
+        sources: flac files
+        formats: names out of plan.FORMATS
+        target: integrated loudness of the outputs in LUFS
+        output: folder the format folders are created in [default: next to each source]
+        album: apply one gain to all sources based on their joint loudness
+        workers: jobs running at the same time [default: number of cpus]
+        database: volumes.db that caches the measurements [default: kept in memory]
+        progress: called with (task, position, duration) while jobs run
+        overwrite: encode outputs that exist already
+        fsync: "none", "file" or "dir", see utils.atomic_output
+        ffmpeg, qaac, lame: paths of the binaries [default: searched for]
+        profile: quality profile out of backends.QUALITY_PROFILES the encoders are chosen in
+        calibration: file with the speeds of the encoders on this host, None to take
+            the preferred encoder without measuring [default: the one of normalize.py]
+        log_level: "DEBUG", "INFO", "WARNING", "ERROR" or "CRITICAL" while the batch
+            runs [default: the logger's level is left as it is]
+
+    Raises:
+        APIError: for unknown formats, profiles or log levels, formats no encoder on this host
+            makes, a missing ffmpeg or a database that can't be read
+    """
+    return Batch(sources, formats, target, output, album, workers, database, progress, overwrite, fsync,
+                 ffmpeg, qaac, lame, profile, calibration, log_level)
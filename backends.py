@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pick the encoder that produces each format, by quality and measured speed.
+
+Most formats can be made by more than one backend: mp3 by lame or
+ffmpeg's libmp3lame, alac by qaac or ffmpeg and aac by qaac or ffmpeg's
+own encoder. ffmpeg runs with settings of its own (no 24 bit alac, no
+-V 0 -q 0 and CRCs for mp3, a lower aac quality) and can't encode in
+spliced parts, so it is rated below the native encoders. A quality
+profile sets how good a backend has to be; of those that are good
+enough and available, the fastest one on this host is used.
+
+Speeds are measured once by encoding a few seconds of pink noise with
+every candidate and kept in a calibration file, by default
+~/.normalize-backends.json, under the name of the host and with the size
+and date of the binaries, so that another host or an updated encoder is
+measured again. The file is json and can be deleted at any time.
+
+The calibration encodes are not jobs: the profiler, the resource report,
+the metrics and the event stream are switched off while they run.
+"""
+
+__all__ = ["BACKENDS", "QUALITY_PROFILES", "Calibration", "candidates", "select_backend", "CALIBRATION_FILE"]
+
+import json
+import os
+import socket
+import tempfile
+import time
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+from utils import atomic_output
+from profiler import uninstrumented
+from ffmpeg import FFmpegProcessError
+from qaac import QaacProcessError
+from lame import LAMEProcessError
+
+# the encoders and their methods that convert to each format, with the
+# quality of their output, in the order they are preferred without a
+# calibration:
+BACKENDS = {"aac": [("qaac", "convert_to_aac", 2), ("ffmpeg", "convert_to_aac", 1)],
+            "alac": [("qaac", "convert_to_alac", 2), ("ffmpeg", "convert_to_alac", 1)],
+            "mp3": [("lame", "convert_to_mp3", 2), ("ffmpeg", "convert_to_mp3", 1)],
+            "ac3": [("ffmpeg", "convert_to_ac3", 2)]}
+
+# the lowest quality each profile accepts:
+QUALITY_PROFILES = {"best": 2, "fast": 1}
+
+# where the speeds are kept between runs, unless another file is given:
+CALIBRATION_FILE = pathlib.Path.home() / ".normalize-backends.json"
+
+# seconds of noise every backend encodes:
+CALIBRATION_SECONDS = 20
+
+
+def candidates(fmt, encoders, profile="best"):
+    """The backends of fmt that encoders (a dict of name: instance or None) can run within profile."""
+    return [(name, method) for name, method, quality in BACKENDS[fmt]
+            if encoders.get(name) and quality >= QUALITY_PROFILES[profile]]
+
+
+def _binary_id(encoders, name):
+    # the binaries that do the work of a backend, with their sizes and dates:
+    paths = [encoders["ffmpeg"].path]
+    if name != "ffmpeg":
+        paths.append(getattr(encoders[name], "{}_path".format(name)))
+
+    binaries = []
+    for path in paths:
+        try:
+            stat = os.stat(str(path))
+            binaries.append("{}:{}:{}".format(path, stat.st_size, int(stat.st_mtime)))
+        except OSError:
+            binaries.append(str(path))
+    return "|".join(binaries)
+
+
+class Calibration:
+    """Speeds of the backends on this host, read from and written to file.
+
+    A speed is the audio encoded per second of wall time, like the x of
+    the progress bars.
+    """
+    def __init__(self, file=CALIBRATION_FILE):
+        self.file = pathlib.Path(file)
+        self.host = socket.gethostname()
+        self._hosts = {}
+
+        try:
+            with open(str(self.file), mode='r', encoding="utf-8") as f:
+                self._hosts = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            log.w("Ignoring calibration file {}: {}", self.file, err)
+
+    def speed(self, fmt, name, binary):
+        """The measured speed of a backend, None if its binaries weren't measured on this host."""
+        entry = self._hosts.get(self.host, {}).get("{}/{}".format(fmt, name))
+        if entry and entry.get("binary") == binary:
+            return entry["speed"]
+        return None
+
+    def set_speed(self, fmt, name, binary, speed):
+        self._hosts.setdefault(self.host, {})["{}/{}".format(fmt, name)] = {"binary": binary, "speed": speed}
+
+    def save(self):
+        try:
+            with atomic_output(self.file) as temp_file:
+                with open(str(temp_file), mode='w', encoding="utf-8") as f:
+                    json.dump(self._hosts, f, indent=2, sort_keys=True)
+        except OSError as err:
+            log.w("Could not write calibration file {}: {}", self.file, err)
+
+    def measure(self, fmt, name, method, encoders, sample):
+        """Encode the flac file sample with a backend and keep its speed."""
+        with tempfile.TemporaryDirectory(prefix="r128") as folder:
+            output_file = pathlib.Path(folder) / "calibration.{}".format("m4a" if fmt in ("aac", "alac") else fmt)
+
+            start = time.perf_counter()
+            getattr(encoders[name], method)(sample, output_file)
+            seconds = time.perf_counter() - start
+
+        speed = round(CALIBRATION_SECONDS / seconds, 1) if seconds else None
+        self.set_speed(fmt, name, _binary_id(encoders, name), speed)
+
+        log.i("{} encodes {} at {}x realtime.", name, fmt, speed)
+        return speed
+
+
+def select_backend(fmt, encoders, profile="best", calibration=None, recalibrate=False):
+    """(encoder name, method) of the fastest backend of fmt within profile, None if there is none.
+
+    Backends without a speed are measured if there is a choice and a
+    calibration is given, otherwise the preferred one is picked.
+    """
+    backends = candidates(fmt, encoders, profile)
+    if len(backends) < 2 or calibration is None:
+        return backends[0] if backends else None
+
+    speeds = {}
+    sample = None
+    with tempfile.TemporaryDirectory(prefix="r128") as folder, uninstrumented():
+        for name, method in backends:
+            speed = None if recalibrate else calibration.speed(fmt, name, _binary_id(encoders, name))
+
+            if speed is None:
+                try:
+                    if sample is None:
+                        sample = pathlib.Path(folder) / "noise.flac"
+                        encoders["ffmpeg"].test_signal(sample, CALIBRATION_SECONDS)
+                    speed = calibration.measure(fmt, name, method, encoders, sample)
+                except (OSError, FFmpegProcessError, QaacProcessError, LAMEProcessError) as err:
+                    # not kept, it is tried again next time:
+                    log.w("Measuring {} encoding {} failed: {}", name, fmt, err)
+
+            speeds[(name, method)] = speed or 0
+
+    if any(speeds.values()) and sample is not None:
+        calibration.save()
+
+    # the first of equally fast ones, as without a calibration:
+    backend = max(backends, key=lambda backend: speeds[backend])
+    log.d("backend speeds for {}: {}, using {}", fmt, speeds, backend[0])
+    return backend
+
+
+if __name__ == "__main__":
+    # measure the backends of every format with the default encoders:
+    import sys
+
+    from ffmpeg import FFmpeg
+    from qaac import Qaac, QaacException
+    from lame import LAME, LAMEException
+
+    ffmpeg = FFmpeg()
+    encoders = {"ffmpeg": ffmpeg, "qaac": None, "lame": None}
+    for name, create, errors in (("qaac", Qaac, QaacException), ("lame", LAME, LAMEException)):
+        try:
+            encoders[name] = create(ff_path=pathlib.Path(ffmpeg.path))
+        except (errors, ValueError) as err:
+            print("no {}: {}".format(name, err), file=sys.stderr)
+
+    calibration = Calibration()
+    for fmt in sorted(BACKENDS):
+        for profile in sorted(QUALITY_PROFILES):
+            print("{} ({}): {}".format(fmt, profile, select_backend(fmt, encoders, profile, calibration,
+                                                                    recalibrate="-f" in sys.argv and profile == "best")))
@@ -0,0 +1,227 @@
+#! python3
+# -*- coding: utf-8 -*-
+
+"""
+Measures the time the Python orchestration adds to the encoders.
+
+Everything runs against the stub executables of stubs.py, so no codec
+has to be installed. The bare stub pipelines are timed first and then
+subtracted from the same work done through FFmpeg, Qaac and LAME and
+through whole normalize.py runs:
+
+    python bench_overhead.py -o overhead.json
+    python bench_overhead.py --duration 240 --speed 0 --jobs 1 8 32 64
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import pathlib
+
+import config
+conf = config.Config()
+
+import logger
+log = logger.Logger(__name__)
+
+import stubs
+from ffmpeg import FFmpeg
+from qaac import Qaac
+from lame import LAME
+
+NORMALIZE = pathlib.Path(__file__).parent / "normalize.py"
+
+
+def _median_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _flac(folder, name):
+    # the stubs don't decode anything, any non-empty file will do:
+    path = pathlib.Path(folder) / name
+    path.write_bytes(os.urandom(4096))
+    return path
+
+
+def _pipe(first, second):
+    with open(os.devnull, mode='wb') as null:
+        producer = subprocess.Popen(first, stdout=subprocess.PIPE, stderr=null)
+        consumer = subprocess.Popen(second, stdin=producer.stdout, stderr=null)
+        producer.stdout.close()
+        consumer.wait()
+        producer.wait()
+
+
+def bench_bare(bins, tmp, repeat):
+    """Seconds per job of the stub commands alone, without any Python around them."""
+    flac = _flac(tmp, "bare.flac")
+    ff = str(bins["ffmpeg"])
+    wav = [ff, "-hide_banner", "-i", str(flac), "-vn", "-f", "wav", "-y", "-"]
+
+    def analysis():
+        with open(os.devnull, mode='wb') as null:
+            subprocess.call([ff, "-hide_banner", "-nostats", "-i", str(flac), "-vn", "-filter:a", "ebur128",
+                             "-f", "null", os.devnull], stderr=null)
+
+    def ac3():
+        with open(os.devnull, mode='wb') as null:
+            subprocess.call([ff, "-hide_banner", "-i", str(flac), "-vn", "-f", "ac3", "-y",
+                             str(pathlib.Path(tmp) / "bare.ac3")], stderr=null)
+
+    return {"analysis": _median_of(analysis, repeat),
+            "aac": _median_of(lambda: _pipe(wav, [str(bins["qaac"]), "-", "-o", str(pathlib.Path(tmp) / "bare.m4a")]),
+                              repeat),
+            "mp3": _median_of(lambda: _pipe(wav, [str(bins["lame"]), "-", str(pathlib.Path(tmp) / "bare.mp3")]),
+                              repeat),
+            "ac3": _median_of(ac3, repeat)}
+
+
+def bench_classes(bins, tmp, repeat, bare):
+    """Seconds the classes add to one job, on top of the bare stub commands."""
+    flac = _flac(tmp, "classes.flac")
+    folder = pathlib.Path(tmp)
+
+    ffmpeg = FFmpeg(path=bins["ffmpeg"])
+    qaac = Qaac(ff_path=bins["ffmpeg"], qaac_path=bins["qaac"])
+    lame = LAME(ff_path=bins["ffmpeg"], lame_path=bins["lame"])
+
+    timings = {"analysis": _median_of(lambda: ffmpeg.analyze_volume(flac), repeat),
+               "aac": _median_of(lambda: qaac.convert_to_aac(flac, folder / "classes.m4a", volume=1.5), repeat),
+               "mp3": _median_of(lambda: lame.convert_to_mp3(flac, folder / "classes.mp3", volume=1.5), repeat),
+               "ac3": _median_of(lambda: ffmpeg.convert_to_ac3(flac, folder / "classes.ac3", volume=1.5), repeat)}
+
+    results = {}
+    for stage, seconds in timings.items():
+        results["class_{}_seconds".format(stage)] = (seconds, "s")
+        results["class_{}_overhead".format(stage)] = ((seconds - bare[stage]) * 1e3, "ms/job")
+    return results
+
+
+def _normalize(bins, library, *options):
+    command = [sys.executable, str(NORMALIZE),
+               "--ffmpeg", str(bins["ffmpeg"]), "--qaac", str(bins["qaac"]), "--lame", str(bins["lame"])]
+    command.extend(options)
+    command.append(str(library))
+
+    start = time.perf_counter()
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError("normalize.py failed:\n{}".format(result.stderr.decode("utf-8", errors="replace")))
+    return elapsed
+
+
+def _library(tmp, name, jobs):
+    library = pathlib.Path(tmp) / name
+    library.mkdir()
+    for number in range(jobs):
+        _flac(library, "track{:04d}.flac".format(number))
+    return library
+
+
+def bench_startup(bins, tmp, repeat):
+    """A run that finds everything done: interpreter, imports and binary tests."""
+    library = _library(tmp, "startup", 1)
+    _normalize(bins, library, "--aac")
+
+    return {"startup": (_median_of(lambda: _normalize(bins, library, "--aac"), repeat), "s")}
+
+
+def bench_scaling(bins, tmp, job_counts, bare, startup):
+    """Whole runs with an analysis and an aac encode per job."""
+    walls = []
+    for jobs in job_counts:
+        library = _library(tmp, "scaling{}".format(jobs), jobs)
+        walls.append(_normalize(bins, library, "--aac"))
+
+    results = {"run_{}_jobs".format(jobs): (wall, "s") for jobs, wall in zip(job_counts, walls)}
+
+    # least squares slope of wall time over job count:
+    mean_jobs = statistics.mean(job_counts)
+    mean_wall = statistics.mean(walls)
+    slope = (sum((jobs - mean_jobs) * (wall - mean_wall) for jobs, wall in zip(job_counts, walls)) /
+             sum((jobs - mean_jobs) ** 2 for jobs in job_counts))
+
+    results["run_seconds_per_job"] = (slope, "s/job")
+    results["run_overhead_per_job"] = ((slope - bare["analysis"] - bare["aac"]) * 1e3, "ms/job")
+
+    # slope of log(work) over log(jobs), 1.0 is linear:
+    work = [max(wall - startup, 1e-6) for wall in walls]
+    results["run_scaling"] = ((math.log(work[-1]) - math.log(work[0])) /
+                              (math.log(job_counts[-1]) - math.log(job_counts[0])), "exponent")
+    return results
+
+
+def run(settings, job_counts, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        bins = stubs.install(pathlib.Path(tmp) / "bin", **settings)
+
+        bare = bench_bare(bins, tmp, repeat)
+        results.update({"bare_{}_seconds".format(stage): (seconds, "s") for stage, seconds in bare.items()})
+        results.update(bench_classes(bins, tmp, repeat, bare))
+
+        startup = bench_startup(bins, tmp, repeat)
+        results.update(startup)
+        results.update(bench_scaling(bins, tmp, job_counts, bare, startup["startup"][0]))
+
+    return {"meta": {"python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "stubs": dict(stubs.DEFAULTS, **settings),
+                     "jobs": job_counts,
+                     "repeat": repeat},
+            "results": {name: {"value": value, "unit": unit} for name, (value, unit) in results.items()}}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Orchestration overhead measured against stub encoders")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="write json results to file instead of stdout")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="runs per measurement, the median counts [default: 3]")
+    parser.add_argument("--jobs", default=[1, 4, 16], type=int, nargs="+", metavar="n",
+                        help="job counts of the scaling runs [default: 1 4 16]")
+    parser.add_argument("--duration", default=stubs.DEFAULTS["duration"], type=float, metavar="sec",
+                        help="seconds of audio per stub file [default: {}]".format(stubs.DEFAULTS["duration"]))
+    parser.add_argument("--speed", default=stubs.DEFAULTS["speed"], type=float, metavar="x",
+                        help="realtime multiple the stubs run at, 0 for unthrottled [default: 0]")
+    parser.add_argument("--progress", default=stubs.DEFAULTS["progress"], type=float, metavar="sec",
+                        help="audio seconds between two progress lines [default: {}]".format(
+                            stubs.DEFAULTS["progress"]))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    log.level = "ERROR"
+
+    if os.name != "posix":
+        print("The stub encoders need a posix system.", file=sys.stderr)
+        raise SystemExit(1)
+
+    if len(args.jobs) < 2:
+        print("At least two job counts are needed for the scaling runs.", file=sys.stderr)
+        raise SystemExit(1)
+
+    results = run({"duration": args.duration, "speed": args.speed, "progress": args.progress},
+                  sorted(args.jobs), args.repeat)
+    output = json.dumps(results, indent=4)
+
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
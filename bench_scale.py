@@ -0,0 +1,229 @@
+#! python3
+# -*- coding: utf-8 -*-
+
+"""
+Scale benchmark of the planner and the loudness database.
+
+Builds a synthetic library of empty FLAC files, part of them with their
+outputs already in place, next to a volumes.db that holds an entry for
+every track. For every library size it measures directory enumeration,
+the output-existence checks of the planner, database load time and
+memory, lookups and a single write, then fits how each of them grows:
+
+    python bench_scale.py --sizes 1000 10000 100000
+    python bench_scale.py --sizes 1000 10000 100000 1000000 --keep /mnt/scratch/library
+    python bench_scale.py --check
+
+With --check the exit code is 1 when something grows faster than it
+should (a linear step turning quadratic, a lookup that depends on N).
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import pathlib
+
+import config
+conf = config.Config()
+
+import logger
+log = logger.Logger(__name__)
+
+import normalize
+from database import Database
+from loudness import BlockHistogram
+
+# (expected exponent of the growth with N, unit) per measurement; lookups
+# are per operation so they should not grow at all:
+EXPECTED = {"enumerate": (1.0, "s"),
+            "plan": (1.0, "s"),
+            "db_load": (1.0, "s"),
+            "db_memory": (1.0, "MiB"),
+            "db_lookup": (0.0, "us/lookup"),
+            "db_write": (1.0, "s")}
+
+# fraction of tracks whose outputs already exist:
+DONE = 0.1
+
+
+def _md5(number):
+    return "{:032x}".format(number * 2654435761 % 2 ** 128)
+
+
+def grow_library(library, start, stop):
+    """Add tracks start..stop-1 with their outputs for every 1/DONE-th one."""
+    for folder in ("aac", "alac", "mp3"):
+        (library / folder).mkdir(exist_ok=True)
+
+    for number in range(start, stop):
+        name = "track{:07d}".format(number)
+        open(str(library / "{}.flac".format(name)), mode='wb').close()
+
+        if number % int(1 / DONE) == 0:
+            for output in ("aac/{}.m4a", "alac/{}.m4a", "mp3/{}.mp3"):
+                open(str(library / output.format(name)), mode='wb').close()
+
+
+def write_database(path, size):
+    # one representative record, with a histogram, for every track:
+    histogram = BlockHistogram()
+    rand = random.Random(0)
+    for _ in range(2400):
+        histogram.add(round(rand.gauss(-17, 4), 3))
+    record = {"gain": 1.1, "lufs": -17.1, "peak": 0.5, "hist": histogram.encode()}
+
+    with open(str(path), mode='w') as f:
+        json.dump({_md5(number): record for number in range(size)}, f, ensure_ascii=False, indent=4)
+
+
+def bench_enumerate(library):
+    # the same glob main() uses to find the inputs:
+    start = time.perf_counter()
+    files = [file for file in library.glob("*.flac")]
+    return time.perf_counter() - start, files
+
+
+def bench_plan(library, files):
+    conf.input = library
+    conf.input_is_file = False
+    conf.database_path = library / "volumes.db"
+    conf.journal = None
+    conf.leases = None
+    conf.aac = conf.alac = conf.mp3 = True
+
+    start = time.perf_counter()
+    normalize.plan_conversions(files)
+    return time.perf_counter() - start
+
+
+def bench_database(path, size, lookups=100000):
+    tracemalloc.start()
+    start = time.perf_counter()
+    db = Database(path)
+    load = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+
+    # half hits, half misses:
+    rand = random.Random(size)
+    md5s = [_md5(rand.randrange(size)) if n % 2 else "{:032x}".format(rand.getrandbits(128))
+            for n in range(lookups)]
+    start = time.perf_counter()
+    for md5 in md5s:
+        db.get_record(md5)
+    lookup = (time.perf_counter() - start) / lookups * 1e6
+
+    # analyzing one new track stores one entry:
+    start = time.perf_counter()
+    db.set_entry("f" * 32, {"gain": 0.0})
+    write = time.perf_counter() - start
+
+    return {"db_load": load, "db_memory": memory, "db_lookup": lookup, "db_write": write}
+
+
+def exponent(sizes, values):
+    # least squares slope of log(value) over log(N):
+    points = [(math.log(size), math.log(value)) for size, value in zip(sizes, values) if value > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in points) /
+            sum((x - mean_x) ** 2 for x, _ in points))
+
+
+def run(sizes, library):
+    measurements = {name: [] for name in EXPECTED}
+    built = 0
+
+    for size in sizes:
+        start = time.perf_counter()
+        grow_library(library, built, size)
+        write_database(library / "volumes.db", size)
+        built = size
+        print("built {} tracks in {:.1f} s".format(size, time.perf_counter() - start), file=sys.stderr, flush=True)
+
+        seconds, files = bench_enumerate(library)
+        measurements["enumerate"].append(seconds)
+        measurements["plan"].append(bench_plan(library, files))
+        for name, value in bench_database(library / "volumes.db", size).items():
+            measurements[name].append(value)
+
+    return {"meta": {"python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "sizes": sizes,
+                     "done": DONE},
+            "results": {name: {"values": values,
+                               "unit": EXPECTED[name][1],
+                               "exponent": exponent(sizes, values),
+                               "expected": EXPECTED[name][0]} for name, values in measurements.items()}}
+
+
+def report(results, tolerance):
+    """Print the scaling table, return the names that grow too fast."""
+    sizes = results["meta"]["sizes"]
+    failed = []
+
+    print("{:<12} {:>10} ".format("measure", "unit") + " ".join("{:>12}".format(size) for size in sizes) +
+          " {:>9} {:>9}".format("exponent", "expected"), file=sys.stderr)
+
+    for name, result in results["results"].items():
+        flag = ""
+        if result["exponent"] is not None and result["exponent"] > result["expected"] + tolerance:
+            failed.append(name)
+            flag = " TOO FAST"
+
+        print("{:<12} {:>10} ".format(name, result["unit"]) +
+              " ".join("{:>12.4g}".format(value) for value in result["values"]) +
+              " {:>9} {:>9.1f}{}".format("{:.2f}".format(result["exponent"]) if result["exponent"] is not None
+                                         else "-", result["expected"], flag), file=sys.stderr)
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scale benchmark of the planner and the loudness database")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="write json results to file instead of stdout")
+    parser.add_argument("--sizes", default=[1000, 10000, 100000], type=int, nargs="+", metavar="n",
+                        help="library sizes, 1000000 needs a few GB of disk and memory [default: 1000 10000 100000]")
+    parser.add_argument("--keep", metavar="folder",
+                        help="build the library in this empty folder and keep it")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with 1 if a measurement grows faster than expected")
+    parser.add_argument("--tolerance", default=0.3, type=float,
+                        help="how much an exponent may exceed the expected one [default: 0.3]")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    log.level = "ERROR"
+
+    sizes = sorted(set(args.sizes))
+    if len(sizes) < 2:
+        print("At least two sizes are needed to fit the growth.", file=sys.stderr)
+        raise SystemExit(1)
+
+    if args.keep:
+        folder = pathlib.Path(args.keep)
+        folder.mkdir(parents=True, exist_ok=True)
+        results = run(sizes, folder)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run(sizes, pathlib.Path(tmp))
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+    if report(results, args.tolerance) and args.check:
+        raise SystemExit(1)
@@ -0,0 +1,339 @@
+#! python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for the Python hot paths of the normalizer.
+
+All inputs are synthetic so no encoder has to be installed. Results are
+written as json and can be compared against a stored baseline:
+
+    python benchmark.py -o results.json
+    python benchmark.py --save-baseline
+    python benchmark.py --baseline bench_baseline.json --max-regression 0.25
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import pathlib
+
+import config
+conf = config.Config()
+
+import logger
+log = logger.Logger(__name__)
+
+from database import Database
+from ffmpeg import FFmpeg, FFmpegProcess
+from qaac import QaacProcess
+from lame import LAMEProcess
+from loudness import BlockHistogram
+from utils import HashProgressBar, locate_bin
+
+DEFAULT_BASELINE = pathlib.Path(__file__).parent / "bench_baseline.json"
+
+
+# synthetic ffmpeg stderr, with windows line endings like the real thing:
+
+def duration_banner(seconds):
+    return ("Input #0, flac, from 'input.flac':\r\n"
+            "  Metadata:\r\n"
+            "    TITLE           : Synthetic\r\n"
+            "  Duration: {:02d}:{:02d}:{:05.2f}, start: 0.000000, bitrate: 912 kb/s\r\n"
+            "    Stream #0:0: Audio: flac, 44100 Hz, stereo, s16\r\n"
+            "Output #0, null, to 'nul':\r\n").format(int(seconds // 3600), int(seconds % 3600 // 60),
+                                                    seconds % 60)
+
+
+def ebur128_lines(seconds, lufs=-16.9, peak=0.5, seed=0):
+    rand = random.Random(seed)
+    lines = []
+    for block in range(1, int(seconds * 10) + 1):
+        lines.append("[Parsed_ebur128_0 @ 0000000002d1e2a0] t: {:<10.1f} TARGET:-23 LUFS    "
+                     "M:{:6.1f} S:{:6.1f}     I:{:6.1f} LUFS       LRA:{:6.1f} LU\r\n"
+                     .format(block / 10, rand.gauss(lufs, 4), rand.gauss(lufs, 2), lufs, 6.1))
+    lines.append("[Parsed_ebur128_0 @ 0000000002d1e2a0] Summary:\r\n"
+                 "\r\n"
+                 "  Integrated loudness:\r\n"
+                 "    I:         {:5.1f} LUFS\r\n"
+                 "    Threshold: {:5.1f} LUFS\r\n"
+                 "\r\n"
+                 "  Loudness range:\r\n"
+                 "    LRA:         6.1 LU\r\n"
+                 "    Threshold: -47.2 LUFS\r\n"
+                 "    LRA low:   -21.0 LUFS\r\n"
+                 "    LRA high:  -14.9 LUFS\r\n"
+                 "\r\n"
+                 "  True peak:\r\n"
+                 "    Peak:      {:5.1f} dBFS\r\n".format(lufs, lufs - 10, peak))
+    return "".join(lines)
+
+
+def progress_lines(seconds, step=0.5):
+    lines = []
+    position = 0.0
+    while position < seconds:
+        position += step
+        lines.append("size=   {:6d}kB time={:02d}:{:02d}:{:05.2f} bitrate= 838.9kbits/s speed=48.1x    \r"
+                     .format(int(position * 100), int(position // 3600), int(position % 3600 // 60),
+                             position % 60))
+    return "".join(lines)
+
+
+class _FakeProc:
+    # stands in for a Popen object of a process that has already exited
+    # and left its stderr:
+    def __init__(self, stderr=b""):
+        self.stderr = io.BytesIO(stderr)
+        self.stdout = None
+        self.returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def communicate(self, timeout=None):
+        return None, b""
+
+    def terminate(self):
+        pass
+
+    def kill(self):
+        pass
+
+
+def _fake_popen(stderr):
+    # a popen for the process classes: ffmpeg without arguments prints its
+    # usage, with arguments stderr; encoders print nothing:
+    usage = "Hyper fast Audio and Video encoder\r\nUse -h to get full help or, even better, run 'man ffmpeg'\r\n"
+
+    def popen(cmd, **kwargs):
+        if pathlib.Path(str(cmd[0])).stem != "ffmpeg":
+            return _FakeProc()
+        return _FakeProc(stderr if len(cmd) > 1 else usage.encode("utf-8"))
+    return popen
+
+
+def _best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_md5sum(tmp, repeat, size=16 * 1024 * 1024):
+    file = pathlib.Path(tmp) / "md5.flac"
+    file.write_bytes(os.urandom(size))
+
+    elapsed = _best_of(lambda: Database.md5sum(file), repeat)
+    return {"md5sum_throughput": (size / elapsed / 1e6, "MB/s", True)}
+
+
+def bench_database(tmp, repeat, sizes=(100, 300, 1000)):
+    results = {}
+    histogram = BlockHistogram()
+    for block in range(2400):
+        histogram.add(round(random.gauss(-17, 4), 3))
+    record = {"gain": 1.1, "lufs": -17.1, "peak": 0.5, "hist": histogram.encode()}
+
+    timings = []
+    for entries in sizes:
+        def fill():
+            path = pathlib.Path(tmp) / "volumes_{}.db".format(entries)
+            if path.exists():
+                path.unlink()
+            db = Database(path)
+            for n in range(entries):
+                db.set_entry("{:032x}".format(n), record)
+
+        elapsed = _best_of(fill, repeat)
+        timings.append(elapsed)
+        results["db_set_entry_{}".format(entries)] = (elapsed / entries * 1e6, "us/entry", False)
+
+    # slope of log(time) over log(n), 1.0 is linear:
+    exponent = (math.log(timings[-1]) - math.log(timings[0])) / (math.log(sizes[-1]) - math.log(sizes[0]))
+    results["db_set_entry_scaling"] = (exponent, "exponent", False)
+    return results
+
+
+def _parse_lines(process):
+    count = 0
+    for _ in process:
+        count += 1
+    return count
+
+
+def bench_stderr_parsing(repeat, seconds=240):
+    data = (duration_banner(seconds) + ebur128_lines(seconds)).encode("utf-8")
+    lines = data.count(b"\r")
+    results = {}
+
+    popen = _fake_popen(data)
+
+    def ffmpeg():
+        with FFmpegProcess("ffmpeg", args=["-i", "input.flac"], popen=popen) as process:
+            _parse_lines(process)
+
+    def qaac():
+        with QaacProcess("ffmpeg", "qaac", ff_args=["-i", "input.flac"], popen=popen) as process:
+            _parse_lines(process)
+
+    def lame():
+        with LAMEProcess("ffmpeg", "lame", ff_args=["-i", "input.flac"], popen=popen) as process:
+            _parse_lines(process)
+
+    for name, func in (("ffmpeg", ffmpeg), ("qaac", qaac), ("lame", lame)):
+        elapsed = _best_of(func, repeat)
+        results["stderr_parse_{}".format(name)] = (lines / elapsed, "lines/s", True)
+    return results
+
+
+def bench_analyze_volume(tmp, repeat, seconds=240):
+    file = pathlib.Path(tmp) / "analyze.flac"
+    file.write_bytes(b"fLaC")
+    data = (duration_banner(seconds) + ebur128_lines(seconds)).encode("utf-8")
+    lines = data.count(b"\r")
+
+    # a file that passes the checks of a given path, nothing runs it:
+    ffmpeg_bin = pathlib.Path(tmp) / "ffmpeg"
+    ffmpeg_bin.write_bytes(b"")
+    ffmpeg_bin.chmod(0o755)
+    ffmpeg = FFmpeg(path=ffmpeg_bin, popen=_fake_popen(data))
+
+    elapsed = _best_of(lambda: ffmpeg.analyze_volume(file), repeat)
+    return {"analyze_volume_loop": (lines / elapsed, "lines/s", True)}
+
+
+def bench_progressbar(repeat, updates=20000):
+    results = {}
+    bar = HashProgressBar()
+
+    for verbose in (False, True):
+        conf.verbose = verbose
+
+        def run():
+            bar.create(updates)
+            if bar._bar:
+                bar._bar.fd = io.StringIO()
+            for value in range(updates):
+                bar.update(value)
+            bar.finish()
+
+        elapsed = _best_of(run, repeat)
+        results["progressbar_update_{}".format("verbose" if verbose else "quiet")] = \
+            (elapsed / updates * 1e6, "us/update", False)
+
+    conf.verbose = False
+    return results
+
+
+def bench_locate_bin(tmp, repeat):
+    # a binary that is found last, in the system PATH:
+    folder = pathlib.Path(tmp) / "bin"
+    folder.mkdir()
+    exe = folder / "benchstub.exe"
+    exe.write_bytes(b"")
+    exe.chmod(0o755)
+
+    path = os.environ["PATH"]
+    os.environ["PATH"] = os.pathsep.join([path, str(folder)])
+    try:
+        elapsed = _best_of(lambda: locate_bin("benchstub", FileNotFoundError), repeat)
+    finally:
+        os.environ["PATH"] = path
+    return {"locate_bin": (elapsed * 1e3, "ms", False)}
+
+
+def run(repeat, quick):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        results.update(bench_md5sum(tmp, repeat, size=(4 if quick else 16) * 1024 * 1024))
+        results.update(bench_database(tmp, repeat, sizes=(50, 100, 200) if quick else (100, 300, 1000)))
+        results.update(bench_stderr_parsing(repeat))
+        results.update(bench_analyze_volume(tmp, repeat))
+        results.update(bench_progressbar(repeat))
+        results.update(bench_locate_bin(tmp, repeat))
+
+    return {"meta": {"python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "machine": platform.machine(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "repeat": repeat,
+                     "quick": quick},
+            "results": {name: {"value": value, "unit": unit, "higher_is_better": higher}
+                        for name, (value, unit, higher) in results.items()}}
+
+
+def compare(results, baseline, max_regression):
+    """Print results next to the baseline, return the names that regressed."""
+    regressed = []
+    print("{:<32} {:>14} {:>14} {:>8}".format("benchmark", "baseline", "current", "change"), file=sys.stderr)
+
+    for name, current in sorted(results["results"].items()):
+        base = baseline["results"].get(name)
+        if not base or not base["value"]:
+            print("{:<32} {:>14} {:>14.3f} {:>8}".format(name, "-", current["value"], "new"), file=sys.stderr)
+            continue
+
+        change = (current["value"] - base["value"]) / abs(base["value"])
+        if not current["higher_is_better"]:
+            change = -change
+
+        flag = ""
+        if change < -max_regression:
+            regressed.append(name)
+            flag = " REGRESSION"
+
+        print("{:<32} {:>14.3f} {:>14.3f} {:>+7.0%}{} {}".format(name, base["value"], current["value"],
+                                                               change, flag, current["unit"]), file=sys.stderr)
+    return regressed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the normalizer's hot paths")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="write json results to file instead of stdout")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="runs per benchmark, the best one counts [default: 3]")
+    parser.add_argument("--quick", action="store_true",
+                        help="smaller inputs for a fast smoke run")
+    parser.add_argument("--baseline", nargs="?", const=str(DEFAULT_BASELINE), metavar="file",
+                        help="compare against a stored baseline [default: {}]".format(DEFAULT_BASELINE.name))
+    parser.add_argument("--save-baseline", nargs="?", const=str(DEFAULT_BASELINE), metavar="file",
+                        help="store the results as the new baseline")
+    parser.add_argument("--max-regression", default=0.25, type=float, metavar="fraction",
+                        help="exit with 1 if a benchmark is this much worse than the baseline [default: 0.25]")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    log.level = "ERROR"
+
+    results = run(args.repeat, args.quick)
+    output = json.dumps(results, indent=4)
+
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+    if args.save_baseline:
+        pathlib.Path(args.save_baseline).write_text(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.max_regression):
+                raise SystemExit(1)
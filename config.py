@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ["Config"]
+__all__ = ["Config", "Singleton"]
 
 import pathlib
 
@@ -23,6 +23,10 @@ class Config(metaclass=Singleton):
     This is a singleton class that contains all the configuration data
     shared by all the classes of the application.
     Initially all variables are initialized to None.
+
+    It only holds settings and the tools they select (database, encoders,
+    journal, leases); what is converted is planned into plan.Job objects
+    that are passed to the workers.
     """
     log_level = None
     input = pathlib.Path
@@ -36,28 +40,49 @@ class Config(metaclass=Singleton):
     mp3 = False
     ac3 = False
     quality = 0
+    quality_profile = "best"
+    calibrate = False
+    calibration_file = None
+    backends = None
     volume = 0
     volume_choices = [-16, -19, -23]
+    album = False
+    stream = None
+    command = None
+    workers = None
+    report = "-"
+    report_format = None
+    verify = False
+    verify_sample = 0.05
+    verify_tolerance = 1.0
+    flagged = None
     dry_run = False
     no_db = False
+    batch = 1
+    segments = 1
+    encode_segments = 1
+    fsync = "file"
+    journal = None
+    cooperative = False
+    lease_ttl = 300
+    lease_poll = 5
+    leases = None
     verbose = False
+    profile = None
+    rusage = False
+    stderr_log = None
+    log_file = None
+    events = None
+    events_file = "-"
+    metrics_file = None
+    metrics_port = None
     debug = False
+    ffmpeg_path = None
+    qaac_path = None
+    lame_path = None
     ffmpeg = None
     qaac = None
     lame = None
-    input_list = []
-    aac_conversion_list = []
-    alac_conversion_list = []
-    mp3_conversion_list = []
-    ac3_conversion_list = []
-
-    input_list_str = []
-    output_aac_list = []
-    output_aac_list_str = []
-    output_alac_list = []
-    output_alac_list_str = []
-    output_mp3_list = []
-    output_mp3_list_str = []
 
     def __repr__(self):
         return str(vars(self))
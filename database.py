@@ -2,16 +2,29 @@
 
 __all__ = ["Database", "DatabaseError"]
 
+from contextlib import contextmanager
 from functools import partial
 import hashlib
 import json
+import os
 import pathlib
+import time
+import uuid
 
 import logger
 log = logger.Logger(__name__)
 log.level = "DEBUG"
 
 from utils import HashProgressBar
+from profiler import timed
+from loudness import BlockHistogram, integrated_loudness
+
+
+# bytes read per md5 update, large enough for the syscalls not to matter:
+MD5_CHUNK = 1024 * 1024
+
+# seconds between writes of a database while commits are deferred:
+DEFER_INTERVAL = 30
 
 
 class DatabaseError(Exception):
@@ -26,19 +39,31 @@ class Database:
 
     Args:
         raise_not_found: raise FileNotFoundError if an existing db is not found
-        in_memory: never write a database file but keep all data in memory
+        in_memory: never write a database file but keep all data in memory,
+        path can be None then to start empty
+        lock: context manager held while committing; when given the database
+        is treated as shared and entries written by other processes are
+        merged in before every write
 
     Raises:
         DatabaseError: the only exception that will be raised with a description
         of the error
         FileNotFoundError: if raise_not_found == True
     """
-    def __init__(self, path, raise_not_found=False, in_memory=False):
-        self.path = str(path)
-        log.d("created Database with path: {}".format(self.path))
+    def __init__(self, path, raise_not_found=False, in_memory=False, lock=None):
+        if path is None and not in_memory:
+            raise DatabaseError("A path is needed unless the database is kept in memory.")
+        self.path = str(path) if path is not None else None
+        log.d("created Database with path: {}", self.path)
 
         self._raise_not_found = raise_not_found
         self._in_memory = in_memory
+        self._lock = lock
+
+        # while deferred, commits within the interval only mark the data dirty:
+        self._defer = None
+        self._committed = 0.0
+        self._dirty = False
 
         # holds data of an existing database:
         self.db_data = None
@@ -46,6 +71,9 @@ class Database:
         self._load()
 
     def _load(self):
+        if self.path is None:
+            return
+
         try:
             log.d("trying to open database")
 
@@ -62,13 +90,57 @@ class Database:
         except ValueError:
             raise DatabaseError("Error with argument to open().")
 
+    def refresh(self):
+        """Merge entries written by other processes into memory."""
+        if self._in_memory:
+            return
+
+        try:
+            with open(self.path, mode='r') as f:
+                disk_data = json.load(f)
+        except FileNotFoundError:
+            return
+        except OSError:
+            raise DatabaseError("Error while reading/writing the database.")
+        except ValueError:
+            raise DatabaseError("Error with argument to open().")
+
+        if self.db_data:
+            disk_data.update(self.db_data)
+        self.db_data = disk_data
+
+    def _write(self):
+        # write next to the database and rename over it so that readers
+        # never see a partially written file:
+        temp = "{}.{}.tmp".format(self.path, uuid.uuid4().hex[:8])
+        try:
+            with open(temp, mode='w') as f:
+                json.dump(self.db_data, f, ensure_ascii=False, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
     def _commit(self):
+        if self._defer is not None and time.monotonic() - self._committed < self._defer:
+            self._dirty = True
+            return
+
+        self._committed = time.monotonic()
+        self._dirty = False
+
         if not self._in_memory:
             try:
                 log.d("trying to write database")
 
-                with open(self.path, mode='w') as f:
-                    json.dump(self.db_data, f, ensure_ascii=False, indent=4)
+                if self._lock:
+                    with self._lock:
+                        self.refresh()
+                        self._write()
+                else:
+                    self._write()
 
             except OSError:
                 raise DatabaseError("Error while reading/writing the database.")
@@ -77,22 +149,70 @@ class Database:
         else:
             log.d("skipping writing database file")
 
-    def get_entry(self, md5):
+    @contextmanager
+    def deferred(self, interval=DEFER_INTERVAL):
+        """Write the database at most every interval seconds within the block.
+
+        Every set_entry() rewrites the whole file otherwise, which grows
+        quadratic over a large library. What is still dirty is written
+        when the block is left.
+        """
+        self._defer = interval
+        self._committed = time.monotonic()
+        try:
+            yield self
+        finally:
+            self._defer = None
+            if self._dirty:
+                self._commit()
+
+    def get_record(self, md5):
+        """Return the full entry as a dict with at least a "gain" key.
+
+        Entries of older databases only hold the gain, newer ones also
+        keep "lufs", "peak" and the gating-block histogram "hist".
+        """
         if self.db_data:
             try:
-                return self.db_data[md5]
+                record = self.db_data[md5]
             except KeyError:
-                log.d("entry for md5: {} not found".format(md5))
+                log.d("entry for md5: {} not found", md5)
                 return None
+
+            if isinstance(record, dict):
+                return record
+            return {"gain": record}
         else:
             return None
 
-    def set_entry(self, md5, value):
+    def get_entry(self, md5):
+        record = self.get_record(md5)
+        if record:
+            return record["gain"]
+        return None
+
+    def integrated_loudness(self, md5s):
+        """Integrated loudness of the given entries played back to back.
+
+        Merges the stored gating-block histograms, so an album or any
+        playlist is measured without decoding audio again. Returns None
+        if an entry is missing or was stored without a histogram.
+        """
+        histograms = []
+        for md5 in md5s:
+            record = self.get_record(md5)
+            if not record or "hist" not in record:
+                return None
+            histograms.append(BlockHistogram.decode(record["hist"]))
+
+        return integrated_loudness(histograms)
+
+    def set_entry(self, md5, value, replace=False):
         if self.db_data:
-            if md5 not in self.db_data.keys():
+            if replace or md5 not in self.db_data.keys():
                 self.db_data[md5] = value
             else:
-                log.d("value for md5 {} already present".format(md5))
+                log.d("value for md5 {} already present", md5)
                 pass
             self._commit()
 
@@ -102,21 +222,21 @@ class Database:
             self._commit()
 
     @staticmethod
+    @timed("md5sum")
     def md5sum(filename):
         file = pathlib.Path(filename)
         filesize = file.stat().st_size
 
-        log.i("Calculating MD5 for file {}...".format(file.name))
+        log.i("Calculating MD5 for file {}...", file.name)
         bar = HashProgressBar()
-        bar.create(filesize)
+        bar.create(filesize, label=file.name)
 
         read_bytes = 0
-        chunk = 128
         md5 = hashlib.md5()
         with open(str(filename), mode='rb') as f:
-            for buf in iter(partial(f.read, chunk), b''):
+            for buf in iter(partial(f.read, MD5_CHUNK), b''):
                 md5.update(buf)
-                read_bytes += chunk
+                read_bytes += len(buf)
                 bar.update(read_bytes)
             else:
                 bar.finish()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["EventStream", "EventsError", "EVENT_FORMATS"]
+
+from threading import Lock, local
+import json
+import sys
+import time
+
+from config import Singleton
+
+EVENT_FORMATS = ["jsonl"]
+
+
+class EventsError(Exception):
+    pass
+
+
+class EventStream(metaclass=Singleton):
+    """Machine readable state changes, one json object per line.
+
+    Every line has "event" and "ts" (unix time) followed by the fields
+    of the event. Jobs are identified by their output path relative to
+    the library, progress is throttled to one event per interval and job.
+    Disabled by default, emit() then returns right away.
+
+    A job can also be given a callback, which gets every progress update
+    of the thread whether events are written or not.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.interval = 1.0
+        self._file = None
+        self._lock = Lock()
+        self._local = local()
+        self._encode = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(",", ":")).encode
+
+    def open(self, target="-"):
+        """Write to stdout for "-", otherwise to a file or an existing fifo.
+
+        Opening a fifo blocks until the orchestrator opens it for reading.
+        """
+        if target == "-":
+            self._file = sys.stdout
+        else:
+            try:
+                self._file = open(str(target), mode='a', encoding="utf-8")
+            except OSError as err:
+                raise EventsError("Could not open event stream {}: {}".format(target, err)) from None
+        self.enabled = True
+
+    def close(self):
+        self.enabled = False
+        if self._file not in (None, sys.stdout):
+            self._file.close()
+        self._file = None
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+
+        line = self._encode(dict(event=event, ts=round(time.time(), 3), **fields)) + "\n"
+        with self._lock:
+            try:
+                self._file.write(line)
+                self._file.flush()
+            except (OSError, ValueError):
+                # the reader went away, don't fail the batch because of it:
+                self.enabled = False
+
+    def start_job(self, job, callback=None):
+        """Make job the one the progress of this thread belongs to.
+
+        callback is called with position and duration on every update.
+        """
+        self._local.job = job
+        self._local.last = 0.0
+        self._local.callback = callback
+
+    def end_job(self):
+        self._local.job = None
+        self._local.callback = None
+
+    def wants_progress(self):
+        """True if progress of this thread goes anywhere, to events or a callback."""
+        return bool(getattr(self._local, "callback", None)) or \
+            (self.enabled and getattr(self._local, "job", None) is not None)
+
+    def progress(self, position, duration):
+        callback = getattr(self._local, "callback", None)
+        if callback:
+            callback(position, duration)
+
+        if not self.enabled:
+            return
+
+        job = getattr(self._local, "job", None)
+        now = time.monotonic()
+        if job is None or (now - self._local.last < self.interval and position < duration):
+            return
+
+        self._local.last = now
+        self.emit("progress", job=job, position=position, duration=duration,
+                  percent=round(position / duration * 100, 1) if duration else None)
@@ -1,15 +1,15 @@
 # -*- coding: utf-8 -*-
 
 __all__ = ["FFmpeg", "FFmpegNotFoundError", "FFmpegTestFailedError",
-           "FFmpegProcessError", "FFmpegMissingLib", "NotSetError"]
+           "FFmpegProcessError", "FFmpegMissingLib", "NotSetError", "Meter", "audio_filter_args", "input_args",
+           "part_duration"]
 
-from subprocess import Popen, PIPE, TimeoutExpired
-from functools import partial
-from collections import deque
+from subprocess import PIPE, TimeoutExpired
 from threading import Thread, Event
 from queue import Queue, Empty
 import sys
 import os
+import tempfile
 import re
 import pathlib
 
@@ -23,7 +23,77 @@ if conf.log_level:
 else:
     log.level = "DEBUG"
 
-from utils import locate_bin, HashProgressBar
+from utils import locate_bin, HashProgressBar, StderrCapture, StderrLines, stderr_log_path
+from profiler import Profiler, timed
+from rusage import AccountedPopen, ResourceReport
+from events import EventStream
+from loudness import BlockHistogram
+
+# resampled to 48 kHz and cut into 100 ms frames so that ebur128 puts the
+# momentary loudness of every block into the metadata of one frame:
+ANALYSIS_FILTER = ("aresample=48000,asetnsamples=n=4800:p=0,"
+                   "ebur128=framelog=verbose:peak=true:metadata=1,"
+                   "ametadata=mode=print:key=lavfi.r128.M:file={}")
+
+# the filtered audio is split, one copy goes to the output and the other
+# into an ebur128 filter, so it is measured without being decoded again:
+METER_GRAPH = "[0:a]{},asplit=2[out][meter];[meter]ebur128=framelog=verbose:peak=true,anullsink"
+
+
+def input_args(input, start=None, length=None):
+    """ffmpeg args reading input, only length seconds of it from start on if given.
+
+    ffmpeg seeks sample accurately, to the microsecond the times are given in.
+    """
+    args = []
+    if start:
+        args.extend(["-ss", "{:.6f}".format(start)])
+    args.extend(["-i", input])
+    if length:
+        args.extend(["-t", "{:.6f}".format(length)])
+    return args
+
+
+def part_duration(duration, start=None, length=None):
+    """Whole seconds of the part of duration that input_args() reads."""
+    if start:
+        duration = max(duration - round(start), 0)
+    if length:
+        duration = min(duration, round(length))
+    return duration
+
+
+def audio_filter_args(filter, meter=False):
+    """ffmpeg args applying filter to the audio, with meter also measuring the result."""
+    if meter:
+        return ["-filter_complex", METER_GRAPH.format(filter), "-map", "[out]"]
+    return ["-filter:a", filter]
+
+
+class Meter:
+    """Integrated loudness and true peak from the summary ebur128 prints."""
+    def __init__(self):
+        self.lufs = None
+        self.peak = None
+
+    def feed(self, line):
+        if not isinstance(line, str):
+            return
+
+        lufs_re = re.search(r"^I:\s+(.*)\sLUFS", line)
+        if lufs_re:
+            self.lufs = round(float(lufs_re.group(1)), 1)
+
+        peak_re = re.search(r"^Peak:\s+(.*)\sdBFS", line)
+        if peak_re:
+            self.peak = round(float(peak_re.group(1)), 1)
+
+    @property
+    def loudness(self):
+        """(lufs, peak), None if no summary was seen."""
+        if self.lufs is None:
+            return None
+        return self.lufs, self.peak
 
 
 class FFmpegException(Exception):
@@ -51,19 +121,26 @@ class FFmpegMissingLib(FFmpegException):
 
 
 class FFmpegProcess:
-    def __init__(self, path, args=[], store_stderr=False):
+    """ffmpeg with its stderr read line by line.
+
+    popen starts the process, it takes the arguments of subprocess.Popen
+    and can be replaced by anything that returns an object like it.
+    """
+    def __init__(self, path, args=[], capture=None, stdin=None, popen=AccountedPopen):
         if args and not isinstance(args, list):
             raise ValueError("you must provide a list for args")
 
         self._path = path
         self._args = args
-        self._keep_stderr = store_stderr
+        self._capture = capture or StderrCapture()
+        self._stdin = stdin
+        self._popen = popen
 
         self._cmd = []
         self._proc = None
+        self._lines = None
         self._returncode = None
         self._interrupted = False
-        self._full_stderr = deque()
 
     @property
     def args(self):
@@ -77,10 +154,11 @@ class FFmpegProcess:
         self._args = value
 
     def _run(self):
-        log.d("starting subprocess: {}".format(self._cmd))
+        log.d("starting subprocess: {}", self._cmd)
 
         try:
-            self._proc = Popen(self._cmd, stderr=PIPE, bufsize=0)
+            self._proc = self._popen(self._cmd, stdin=self._stdin, stderr=PIPE, bufsize=0)
+            self._lines = StderrLines(self._proc.stderr)
 
         except FileNotFoundError as err:
             raise FFmpegNotFoundError(err) from None
@@ -122,45 +200,50 @@ class FFmpegProcess:
         return self
 
     def __next__(self):
-        buffer = deque()
-        for err_char in iter(partial(self._proc.stderr.read, 1), b''):
-            try:
-                # replace any not decoded char with a space:
-                try:
-                    buffer.append(err_char.decode("utf-8"))
-                except UnicodeDecodeError:
-                    buffer.append(' ')
-
-                if '\r' in buffer:
-                    line = "".join(buffer).strip()
-                    buffer.clear()
-
-                    if self._keep_stderr:
-                        self._full_stderr.append(line)
-
-                    return line
+        try:
+            line = self._lines.readline()
+        except KeyboardInterrupt:
+            self._returncode = self._proc.poll()
+            self._interrupted = True
+            raise StopIteration
 
-            except KeyboardInterrupt:
-                self._returncode = self._proc.poll()
-                self._interrupted = True
-                raise StopIteration
-        else:
+        if line is None:
             self._returncode = self._proc.poll()
             raise StopIteration
 
+        self._capture.append(line, "ffmpeg")
+        return line
+
     @property
     def returncode(self):
         return self._returncode
 
     @property
     def full_stderr(self):
-        return self._full_stderr
+        # only the last lines are kept:
+        return self._capture.tail("ffmpeg")
+
+    @property
+    def usage(self):
+        # resource usage of the children once they have been reaped:
+        return {"ffmpeg": self._proc.usage}
 
 
 class FFmpeg:
-    def __init__(self, path=None, debug=False):
+    # codec arguments, filter ({} is the gain) and muxer of the
+    # formats ffmpeg encodes itself:
+    OUTPUTS = {"mp3": (["-c:a", "libmp3lame", "-qscale:a", "0", "-compression_level", "0"], "volume={}dB", "mp3"),
+               "ac3": (["-c:a", "ac3", "-b:a", "640k"],
+                       "aresample=48000:out_sample_fmt=fltp:resampler=soxr:precision=28,volume={}dB", "ac3"),
+               "flac": (["-c:a", "flac"], "volume={}dB", "flac"),
+               "alac": (["-c:a", "alac"], "volume={}dB", "ipod"),
+               "aac": (["-c:a", "aac", "-b:a", "256k"], "volume={}dB", "ipod")}
+
+    def __init__(self, path=None, debug=False, popen=AccountedPopen):
         self.ffmpeg_bin = path
         self._debug = debug
+        # starts every ffmpeg process, see FFmpegProcess:
+        self._popen = popen
 
         self._queue = None
         self._thread = None
@@ -169,7 +252,17 @@ class FFmpeg:
         self._bar = None
 
         self._requirements = []
-        self._full_stderr = []
+        self._stderr = StderrCapture()
+        self._histogram = None
+        self._blocks = []
+        self._stdin = None
+
+        self._job = (None, None)
+        self._usage = None
+
+        # measure the loudness of what the conversions write:
+        self.meter_output = False
+        self._meter = None
 
         self._progressbar = HashProgressBar()
 
@@ -191,7 +284,7 @@ class FFmpeg:
     def _test_bin(self):
         log.d("testing ffmpeg binary")
 
-        with FFmpegProcess(self.ffmpeg_bin) as ff:
+        with FFmpegProcess(self.ffmpeg_bin, popen=self._popen) as ff:
             for line in ff:
                 if ff.returncode != 0 and line == "Use -h to get full help or, even better, run 'man ffmpeg'":
                     log.d("testing ffmpeg binary succeded")
@@ -217,28 +310,46 @@ class FFmpeg:
             raise ValueError("value must be a str or a list")
 
     def check_requirements(self):
-        log.d("checking ffmpeg for required libs: {}".format(self.requrements))
+        log.d("checking ffmpeg for required libs: {}", self.requrements)
 
         if self.requrements:
-            with FFmpegProcess(self.ffmpeg_bin, store_stderr=self._debug) as ff:
+            self._stderr = StderrCapture()
+            with FFmpegProcess(self.ffmpeg_bin, capture=self._stderr, popen=self._popen) as ff:
                 for line in ff:
                     if line.startswith("configuration:"):
-                        log.d("ffmpeg {}".format(line))
+                        log.d("ffmpeg {}", line)
 
                         missing = [lib for lib in self.requrements if lib not in line]
 
                         if len(missing) > 0:
                             raise FFmpegMissingLib("{}".format(", ".join(missing)))
-                self._full_stderr = ff.full_stderr
         else:
             raise NotSetError("requirements property must be set")
 
     @property
     def full_stderr(self):
-        try:
-            return "\n".join(self._full_stderr)
-        except TypeError:
-            return None
+        """Last lines ffmpeg wrote during the last job, see --stderr-log for all of them."""
+        return self._stderr.text("ffmpeg")
+
+    @property
+    def usage(self):
+        """Resource usage of the children of the last job, with --rusage."""
+        return self._usage
+
+    @property
+    def output_loudness(self):
+        """(lufs, peak) of the audio the last conversion wrote, with meter_output."""
+        return self._meter.loudness if self._meter else None
+
+    @property
+    def histogram(self):
+        """Gating-block histogram of the last analyzed file."""
+        return self._histogram
+
+    @property
+    def blocks(self):
+        """Momentary loudness of every 100 ms step of the last analyzed file."""
+        return self._blocks
 
     @staticmethod
     def _check_file(file):
@@ -250,50 +361,68 @@ class FFmpeg:
         if file.stat().st_size == 0:
             raise FFmpegProcessError("{} is 0-byte file".format(file))
 
+    def _input(self, input_file, stdin):
+        # with stdin ffmpeg reads the input from that file descriptor
+        # and input_file only names the job:
+        self._stdin = stdin
+        if stdin is None:
+            self._check_file(input_file)
+            return str(input_file)
+        return "-"
+
+    def _check_output(self, output_file):
+        # "-" is written to stdout:
+        if str(output_file) != "-":
+            self._check_file(output_file)
+
     @staticmethod
-    def _start_ffmpeg_process(queue, quit_event, bin_path, args=[], store_stderr=False):
+    def _start_ffmpeg_process(queue, quit_event, bin_path, args=[], capture=None, stdin=None, popen=AccountedPopen):
         # to be started as a thread!
         try:
-            with FFmpegProcess(bin_path, args=args, store_stderr=store_stderr) as ff:
+            with FFmpegProcess(bin_path, args=args, capture=capture, stdin=stdin, popen=popen) as ff:
                 for line in ff:
                     if line:
                         queue.put(line)
 
                     if quit_event.is_set():
                         break
-                if store_stderr:
-                    queue.put(("stderr", ff.full_stderr))
+            if ResourceReport().enabled:
+                queue.put(("rusage", ff.usage))
         # catching all exceptions from the thread:
         except Exception:
             exc = sys.exc_info()
             queue.put((exc[0], exc[1]))
+        finally:
+            if capture:
+                capture.close()
 
     def _create_queue_event_thread(self, args):
         self._queue = Queue()
         self._quit_event = Event()
+        self._stderr = StderrCapture(stderr_log_path(self._job))
 
         # start thread that reads from stderr:
         self._thread = Thread(target=self._start_ffmpeg_process,
-                              args=(self._queue, self._quit_event, self.ffmpeg_bin, args, self._debug,))
+                              args=(self._queue, self._quit_event, self.ffmpeg_bin, args, self._stderr, self._stdin,
+                                    self._popen))
         self._thread.daemon = True
         self._thread.start()
-        log.d("started thread: {}".format(self._thread.name))
+        log.d("started thread: {}", self._thread.name)
 
     def _thread_dead(self):
         return (not self._thread.is_alive()) and self._queue.empty()
 
     def _get_stderr_exception(self, data):
-        # a tuple is either an exception or full stderr
+        # a tuple is either an exception or resource usage
         if isinstance(data, tuple):
-            # get stderr info:
-            if data[0] == "stderr":
-                if self._debug:
-                    self._full_stderr = data[1]
+            if data[0] == "rusage":
+                self._usage = data[1]
+                ResourceReport().add(self._job[0], self._job[1], self._usage)
             else:
                 # react to exception:
                 self._progressbar.finish()
-                log.d("raising exception {} from thread".format(data[0]))
-                raise data[0](data[1])
+                log.d("raising exception {} from thread", data[0])
+                raise self._stderr.attach(data[0](data[1]))
 
     def _quit_thread(self, exception=None):
         self._progressbar.finish()
@@ -302,17 +431,20 @@ class FFmpeg:
 
         # give thread a chance:
         if self._thread.is_alive():
-            log.d("thread {} is still alive".format(self._thread.name))
+            log.d("thread {} is still alive", self._thread.name)
             self._thread.join(timeout=5)
 
         # check again:
         if self._thread.is_alive():
-            log.d("thread {} is still alive, will not exit cleanly!".format(self._thread.name))
+            log.d("thread {} is still alive, will not exit cleanly!", self._thread.name)
 
         if exception:
-            raise exception
+            raise self._stderr.attach(exception)
 
-    def _get_duration(self):
+    @timed("_get_duration")
+    def _get_duration(self, start=0, length=None):
+        # the duration of the input, or of the part of it from start on
+        # that is length seconds long:
         log.d("getting file duration")
 
         duration = 0
@@ -329,7 +461,11 @@ class FFmpeg:
                 self._get_stderr_exception(data)
 
                 if duration == 0:
-                    duration_re = re.search(r"^Duration:\s(\d\d):(\d\d):(\d\d)\.(\d\d)", data)
+                    duration_re = None
+                    try:
+                        duration_re = re.search(r"^Duration:\s(\d\d):(\d\d):(\d\d)\.(\d\d)", data)
+                    except TypeError:
+                        pass
 
                     if duration_re:
                         hh = int(duration_re.group(1))
@@ -341,168 +477,429 @@ class FFmpeg:
                         duration = hh * 60 * 60 + mm * 60 + ss
 
                 else:
-                    log.d("got duration: {}".format(duration))
+                    log.d("got duration: {}", duration)
                     break
 
+        duration = part_duration(duration, start, length)
+        Profiler().audio(duration)
         return duration
 
-    def analyze_volume(self, input_file):
-        self._check_file(input_file)
+    @staticmethod
+    def _analysis_filter(blocks_file):
+        # ebur128 logs a line every 100 ms unless framelog is below the
+        # log level; the momentary loudness of those blocks, which the
+        # histogram needs, is written into blocks_file instead, one 100 ms
+        # frame (at the 48 kHz ebur128 measures at) per block:
+        path = str(blocks_file).replace("\\", "/").replace(":", "\\\\:")
+        return ANALYSIS_FILTER.format(path)
+
+    @staticmethod
+    def _read_blocks(blocks_file):
+        blocks = []
+        if not blocks_file.exists():
+            return blocks
+
+        with open(str(blocks_file), mode='r') as f:
+            for value in re.findall(r"lavfi\.r128\.M=(\S+)", f.read()):
+                try:
+                    blocks.append(float(value))
+                except ValueError:
+                    pass
+        return blocks
+
+    @staticmethod
+    def _progress_args():
+        # the stats lines drive the progress, without a display for it
+        # ffmpeg writes only the summary:
+        if conf.verbose or EventStream().wants_progress():
+            return []
+        return ["-nostats"]
+
+    @staticmethod
+    def _stats_time(data):
+        time_re = re.search(r"time=(\d+):(\d\d):(\d\d(?:\.\d+)?)", data)
+        if time_re:
+            return int(time_re.group(1)) * 60 * 60 + int(time_re.group(2)) * 60 + float(time_re.group(3))
+        return None
+
+    @timed("analyze_volume")
+    def analyze_volume(self, input_file, stdin=None, start=None, length=None):
+        """Analyze input_file, return (lufs, peak).
+
+        With start and length only that part of it, in seconds, is
+        decoded; ffmpeg seeks to start sample accurately.
+        """
+        self._job = (input_file.name, "analysis")
+
+        blocks = tempfile.TemporaryDirectory(prefix="r128")
+        blocks_file = pathlib.Path(blocks.name) / "blocks.txt"
 
         # prepare args to give to ffmpeg:
-        args = ["-hide_banner", "-nostats",
-                "-i", str(input_file),
-                "-vn", "-filter:a", "ebur128",
-                "-f", "null", os.devnull]
+        args = ["-hide_banner"] + self._progress_args()
+        args.extend(input_args(self._input(input_file, stdin), start, length))
+        args.extend(["-vn", "-filter:a", self._analysis_filter(blocks_file),
+                     "-f", "null", os.devnull])
 
         self._create_queue_event_thread(args)
 
-        duration = self._get_duration()
+        duration = self._get_duration(start, length)
 
-        log.i("Analyzing {}...".format(input_file.name))
-        self._progressbar.create(duration)
+        log.i("Analyzing {}...", input_file.name)
+        self._progressbar.create(duration, label=self._job[0])
 
-        try:
-            lufs = 0
-            peak = 0
-            time_re = None
-            lufs_re = None
-            peak_re = None
-
-            while True:
-                if self._thread_dead():
-                    self._progressbar.finish()
-                    break
+        with blocks, Profiler().span("wait"):
+            try:
+                lufs = 0
+                peak = 0
+                lufs_re = None
+                peak_re = None
+
+                while True:
+                    if self._thread_dead():
+                        self._progressbar.finish()
+                        break
 
-                try:
-                    data = self._queue.get(timeout=0.1)
-                except Empty:
-                    continue
+                    try:
+                        data = self._queue.get(timeout=0.1)
+                    except Empty:
+                        continue
 
-                else:
-                    self._get_stderr_exception(data)
+                    else:
+                        self._get_stderr_exception(data)
+                        if not isinstance(data, str):
+                            continue
 
-                    try:
-                        time_re = re.search(r"t:\s+(.*)\s+M", data)
+                        time = self._stats_time(data)
                         lufs_re = re.search(r"^I:\s+(.*)\sLUFS", data)
                         peak_re = re.search(r"^Peak:\s+(.*)\sdBFS", data)
-                    except TypeError:
-                        pass
 
-                    if time_re:
-                        time = round(float(time_re.group(1)), 1)
-                        if time < duration:
-                            self._progressbar.update(time)
-                        else:
-                            self._progressbar.update(duration)
+                        if time is not None:
+                            time = round(time, 1)
+                            self._progressbar.update(min(time, duration))
+                            EventStream().progress(time, duration)
+
+                        if lufs_re:
+                            lufs = round(float(lufs_re.group(1)), 1)
+
+                        if peak_re:
+                            peak = round(float(peak_re.group(1)), 1)
+
+                self._quit_thread()
+
+                self._blocks = self._read_blocks(blocks_file)
+                self._histogram = BlockHistogram.of(self._blocks)
+                return lufs, peak
+
+            except KeyboardInterrupt as exc:
+                self._quit_thread(exc)
+
+    @timed("analyze_batch")
+    def analyze_batch(self, input_files):
+        """Analyze several files with one ffmpeg process.
+
+        Every input gets its own analysis chain in one filtergraph, so the
+        summary lines of its ebur128 filter are told apart by the filter's
+        name (Parsed_ebur128_<n>); lines without one belong to the filter
+        named last. Returns a list of (lufs, peak, histogram) per input.
+        """
+        for input_file in input_files:
+            self._check_file(input_file)
+        self._stdin = None
+        self._job = ("{}+{}".format(input_files[0].name, len(input_files) - 1), "analysis")
+
+        blocks = tempfile.TemporaryDirectory(prefix="r128")
+        blocks_files = [pathlib.Path(blocks.name) / "blocks{}.txt".format(number)
+                        for number in range(len(input_files))]
+
+        # prepare args to give to ffmpeg:
+        args = ["-hide_banner"] + self._progress_args()
+        for input_file in input_files:
+            args.extend(["-i", str(input_file)])
+
+        chains = ["[{0}:a]{1}[r{0}]".format(number, self._analysis_filter(blocks_file))
+                  for number, blocks_file in enumerate(blocks_files)]
+        args.extend(["-vn", "-filter_complex", ";".join(chains)])
+        for number in range(len(input_files)):
+            args.extend(["-map", "[r{}]".format(number), "-f", "null", os.devnull])
+
+        # filters are numbered through the whole graph:
+        chain = [part.split("=")[0] for part in ANALYSIS_FILTER.split(",")]
+        chain_length, ebur128_index = len(chain), chain.index("ebur128")
+
+        self._create_queue_event_thread(args)
+
+        log.i("Analyzing {} files...", len(input_files))
+
+        with blocks, Profiler().span("wait"):
+            try:
+                durations = []
+                results = [[None, 0, None] for _ in input_files]
+                current = 0
+
+                while True:
+                    if self._thread_dead():
+                        self._progressbar.finish()
+                        break
+
+                    try:
+                        data = self._queue.get(timeout=0.1)
+                    except Empty:
+                        continue
+
+                    self._get_stderr_exception(data)
+                    if not isinstance(data, str):
+                        continue
+
+                    # all inputs are opened, and their durations printed, first:
+                    duration_re = re.search(r"^Duration:\s(\d\d):(\d\d):(\d\d)\.(\d\d)", data)
+                    if duration_re and len(durations) < len(input_files):
+                        hh, mm, ss, cs = (int(group) for group in duration_re.groups())
+                        durations.append(hh * 60 * 60 + mm * 60 + ss + cs / 100)
+
+                        if len(durations) == len(input_files):
+                            Profiler().audio(sum(durations))
+                            self._progressbar.create(sum(durations), label=self._job[0])
+                        continue
+
+                    # the inputs are decoded side by side, each up to its end:
+                    time = self._stats_time(data)
+                    if time is not None:
+                        position = round(sum(min(time, duration) for duration in durations), 1)
+                        self._progressbar.update(position)
+                        EventStream().progress(position, sum(durations))
+                        continue
+
+                    name_re = re.search(r"Parsed_ebur128_(\d+)", data)
+                    if name_re:
+                        number = (int(name_re.group(1)) - ebur128_index) // chain_length
+                        if 0 <= number < len(input_files):
+                            current = number
+                    result = results[current]
+
+                    lufs_re = re.search(r"^I:\s+(.*)\sLUFS", data)
+                    peak_re = re.search(r"^Peak:\s+(.*)\sdBFS", data)
 
                     if lufs_re:
-                        lufs = round(float(lufs_re.group(1)), 1)
+                        result[0] = round(float(lufs_re.group(1)), 1)
 
                     if peak_re:
-                        peak = round(float(peak_re.group(1)), 1)
+                        result[1] = round(float(peak_re.group(1)), 1)
+
+                self._quit_thread()
+
+                for result, blocks_file in zip(results, blocks_files):
+                    if blocks_file.exists():
+                        result[2] = BlockHistogram.of(self._read_blocks(blocks_file))
 
-            self._quit_thread()
+            except KeyboardInterrupt as exc:
+                self._quit_thread(exc)
 
-            return lufs, peak
+        for input_file, (lufs, _, _) in zip(input_files, results):
+            if lufs is None:
+                raise self._stderr.attach(FFmpegProcessError("no loudness measured for {}".format(input_file.name)))
 
-        except KeyboardInterrupt as exc:
-            self._quit_thread(exc)
+        return [tuple(result) for result in results]
 
     def _single_file_conversion(self, args):
+        self._meter = Meter() if self.meter_output else None
         self._create_queue_event_thread(args)
 
         duration = self._get_duration()
 
-        self._progressbar.create(duration)
+        self._progressbar.create(duration, label=self._job[0], audio=True)
 
-        try:
-            time_re = None
-            while True:
-                if self._thread_dead():
-                    self._progressbar.finish()
-                    break
+        with Profiler().span("wait"):
+            try:
+                time_re = None
+                while True:
+                    if self._thread_dead():
+                        self._progressbar.finish()
+                        break
 
-                try:
-                    data = self._queue.get(timeout=0.1)
-                except Empty:
-                    continue
+                    try:
+                        data = self._queue.get(timeout=0.1)
+                    except Empty:
+                        continue
 
-                else:
-                    self._get_stderr_exception(data)
+                    else:
+                        self._get_stderr_exception(data)
 
-                    try:
-                        time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
-                    except TypeError:
-                        pass
+                        if self._meter:
+                            self._meter.feed(data)
 
-                    if time_re:
-                        hh = int(time_re.group(1))
-                        mm = int(time_re.group(2))
-                        ss = int(time_re.group(3))
-                        ms = int(time_re.group(4))
+                        try:
+                            time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
+                        except TypeError:
+                            pass
 
-                        if ms > 50:
-                            ss += 1  # round up
+                        if time_re:
+                            hh = int(time_re.group(1))
+                            mm = int(time_re.group(2))
+                            ss = int(time_re.group(3))
+                            ms = int(time_re.group(4))
 
-                        time = hh * 60 * 60 + mm * 60 + ss
+                            if ms > 50:
+                                ss += 1  # round up
 
-                        if time < duration:
-                            self._progressbar.update(time)
-                        else:
-                            self._progressbar.update(duration)
+                            time = hh * 60 * 60 + mm * 60 + ss
 
-                    if "Error" in data:
-                        self._quit_thread(FFmpegProcessError(data))
+                            if time < duration:
+                                self._progressbar.update(time)
+                            else:
+                                self._progressbar.update(duration)
+                            EventStream().progress(time, duration)
 
-            self._quit_thread()
+                        if "Error" in data:
+                            self._quit_thread(FFmpegProcessError(data))
 
-        except KeyboardInterrupt as exc:
-            self._quit_thread(exc)
+                self._quit_thread()
 
-    def convert_to_mp3(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+            except KeyboardInterrupt as exc:
+                self._quit_thread(exc)
+
+    def _output_args(self, fmt, volume, meter=False):
+        codec, filter, muxer = self.OUTPUTS[fmt]
+        return codec + audio_filter_args(filter.format(volume), meter) + ["-f", muxer]
+
+    @timed("convert_to_mp3")
+    def convert_to_mp3(self, input_file, output_file, volume=0, stdin=None):
+        self._job = (input_file.name, "mp3")
+
+        # prepare args to give to ffmpeg:
+        args = ["-hide_banner", "-i", self._input(input_file, stdin), "-vn"]
+        args.extend(self._output_args("mp3", volume, self.meter_output))
+        args.extend(["-y", str(output_file)])
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(args)
+
+        self._check_output(output_file)
+
+    @timed("convert_to_ac3")
+    def convert_to_ac3(self, input_file, output_file, volume=0, stdin=None):
+        self._job = (input_file.name, "ac3")
 
         # prepare args to give to ffmpeg:
-        args = ["-hide_banner", "-i", str(input_file),
-                "-vn", "-c:a", "libmp3lame", "-qscale:a", "0",
-                "-compression_level", "0",
-                "-filter:a", "volume={}dB".format(volume),
-                "-f", "mp3", "-y", str(output_file)]
+        args = ["-hide_banner", "-i", self._input(input_file, stdin), "-vn"]
+        args.extend(self._output_args("ac3", volume, self.meter_output))
+        args.extend(["-y", str(output_file)])
 
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
         self._single_file_conversion(args)
 
-        self._check_file(output_file)
+        self._check_output(output_file)
 
-    def convert_to_ac3(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+    @timed("convert_to_flac")
+    def convert_to_flac(self, input_file, output_file, volume=0, stdin=None):
+        self._job = (input_file.name, "flac")
 
         # prepare args to give to ffmpeg:
-        args = ["-hide_banner",
-                "-i", str(input_file),
-                "-vn", "-c:a", "ac3", "-b:a", "640k",
-                "-filter:a",
-                "aresample=48000:out_sample_fmt=fltp:resampler=soxr:precision=28,volume={}dB".format(volume),
-                "-f", "ac3", "-y", str(output_file)]
-
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
+        args = ["-hide_banner", "-i", self._input(input_file, stdin), "-vn"]
+        args.extend(self._output_args("flac", volume, self.meter_output))
+        args.extend(["-y", str(output_file)])
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
         self._single_file_conversion(args)
 
-        self._check_file(output_file)
+        self._check_output(output_file)
 
-    def convert_to_flac(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+    @timed("convert_to_alac")
+    def convert_to_alac(self, input_file, output_file, volume=0, stdin=None):
+        self._job = (input_file.name, "alac")
 
         # prepare args to give to ffmpeg:
-        args = ["-hide_banner",
-                "-i", str(input_file),
-                "-vn", "-c:a", "flac",
-                "-filter:a",
-                "volume={}dB".format(volume),
-                "-f", "flac", "-y", str(output_file)]
-
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
+        args = ["-hide_banner", "-i", self._input(input_file, stdin), "-vn"]
+        args.extend(self._output_args("alac", volume, self.meter_output))
+
+        # stdout can't be seeked back to write the index at the end,
+        # a fragmented mp4 starts with an empty one:
+        if str(output_file) == "-":
+            args.extend(["-movflags", "+frag_keyframe+empty_moov"])
+        args.extend(["-y", str(output_file)])
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(args)
+
+        self._check_output(output_file)
+
+    @timed("convert_to_aac")
+    def convert_to_aac(self, input_file, output_file, volume=0, stdin=None):
+        """Encode with ffmpeg's own aac encoder, for hosts without qaac."""
+        self._job = (input_file.name, "aac")
+
+        # prepare args to give to ffmpeg:
+        args = ["-hide_banner", "-i", self._input(input_file, stdin), "-vn"]
+        args.extend(self._output_args("aac", volume, self.meter_output))
+        args.extend(["-y", str(output_file)])
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(args)
+
+        self._check_output(output_file)
+
+    @timed("test_signal")
+    def test_signal(self, output_file, seconds, rate=44100, step=None):
+        """Write seconds of stereo pink noise into the flac output_file.
+
+        With step, a (time, dB) pair, the noise changes by dB from time
+        seconds on.
+        """
+        self._stdin = None
+        self._job = (output_file.name, "flac")
+
+        args = ["-hide_banner", "-f", "lavfi",
+                "-i", "anoisesrc=color=pink:sample_rate={}:duration={}".format(rate, seconds)]
+        if step:
+            args.extend(["-af", "volume={1}dB:enable='gte(t,{0})'".format(*step)])
+        args.extend(["-ac", "2", "-sample_fmt", "s16", "-c:a", "flac", "-y", str(output_file)])
+
+        log.d("Writing {} s of noise to {}...", seconds, output_file.name)
+        self._single_file_conversion(args)
+
+        self._check_output(output_file)
+
+    @timed("remux_adts")
+    def remux_adts(self, input_file, output_file):
+        """Copy the raw ADTS stream input_file into the m4a output_file.
+
+        The edit list covers every frame, splice.set_edit_list() trims
+        the priming and padding from it.
+        """
+        self._job = (input_file.name, "m4a")
+
+        args = ["-hide_banner", "-f", "aac", "-i", self._input(input_file, None), "-vn",
+                "-c:a", "copy", "-f", "ipod", "-y", str(output_file)]
+
+        log.d("Remuxing {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(args)
+
+        self._check_output(output_file)
+
+    @timed("convert_batch")
+    def convert_batch(self, conversions, fmt):
+        """Convert several files to fmt with one ffmpeg process.
+
+        conversions is a list of (input_file, output_file, volume), every
+        input is mapped to its own output with its own volume filter.
+        Progress follows the first input.
+        """
+        for input_file, _, _ in conversions:
+            self._check_file(input_file)
+        self._stdin = None
+        self._job = ("{}+{}".format(conversions[0][0].name, len(conversions) - 1), fmt)
+
+        # prepare args to give to ffmpeg:
+        args = ["-hide_banner"]
+        for input_file, _, _ in conversions:
+            args.extend(["-i", str(input_file)])
+
+        for number, (_, output_file, volume) in enumerate(conversions):
+            args.extend(["-map", "{}:a".format(number)])
+            args.extend(self._output_args(fmt, volume))
+            args.extend(["-y", str(output_file)])
+
+        log.i("Converting {} files to {}...", len(conversions), fmt)
         self._single_file_conversion(args)
 
-        self._check_file(output_file)
+        for _, output_file, _ in conversions:
+            self._check_file(output_file)
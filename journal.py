@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["Journal", "JournalError"]
+
+import json
+import os
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal:
+    """Append-only record of the jobs of a batch.
+
+    Instantiate with: Journal(path, root)
+        where path is the journal file and root the folder output paths
+        are stored relative to.
+
+    Every job writes a "start" line naming its temporary file before
+    encoding and a "done" line with the final size after the output has
+    been renamed into place. A restarted batch reads the journal back,
+    removes temporary files of jobs that were interrupted and knows which
+    outputs are complete. The journal is removed once a batch finishes.
+
+    Args:
+        fsync: flush every line to disk (set for the "file" and "dir"
+        fsync policies)
+
+    Raises:
+        JournalError: if the journal can not be read or written
+    """
+    def __init__(self, path, root, fsync=True):
+        self.path = pathlib.Path(path)
+        self._root = pathlib.Path(root)
+        self._fsync = fsync
+
+        self._started = {}
+        self._done = {}
+        self._file = None
+
+        self._load()
+
+    def _key(self, output_file):
+        return pathlib.Path(output_file).relative_to(self._root).as_posix()
+
+    def _load(self):
+        try:
+            with open(str(self.path), mode='r', encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short by a crash:
+                        continue
+
+                    if entry["event"] == "start":
+                        self._started[entry["output"]] = entry["temp"]
+                    elif entry["event"] == "done":
+                        self._started.pop(entry["output"], None)
+                        self._done[entry["output"]] = entry["size"]
+
+        except FileNotFoundError:
+            return
+        except (OSError, KeyError) as err:
+            raise JournalError("Error while reading the journal: {}".format(err)) from None
+
+        log.i("Resuming batch: {} jobs done, {} interrupted.", len(self._done), len(self._started))
+
+    def _write(self, entry):
+        try:
+            if not self._file:
+                self._file = open(str(self.path), mode='a', encoding="utf-8")
+
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+
+        except OSError as err:
+            raise JournalError("Error while writing the journal: {}".format(err)) from None
+
+    def cleanup(self):
+        """Remove temporary files left behind by interrupted jobs."""
+        for output, temp in self._started.items():
+            try:
+                os.remove(str(self._root / temp))
+                log.d("removed leftover {}", temp)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                log.w("Could not remove leftover {}: {}", temp, err)
+        self._started.clear()
+
+    def intact(self, output_file):
+        """False if output_file was completed by this batch but changed since."""
+        size = self._done.get(self._key(output_file))
+        if size is None:
+            return True
+
+        try:
+            return pathlib.Path(output_file).stat().st_size == size
+        except FileNotFoundError:
+            return False
+
+    def start(self, output_file, temp_file):
+        key = self._key(output_file)
+        self._started[key] = self._key(temp_file)
+        self._write({"event": "start", "output": key, "temp": self._started[key]})
+
+    def done(self, output_file):
+        key = self._key(output_file)
+        self._started.pop(key, None)
+        self._done[key] = pathlib.Path(output_file).stat().st_size
+        self._write({"event": "done", "output": key, "size": self._done[key]})
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """The batch is complete, nothing is left to resume."""
+        self.close()
+        try:
+            os.remove(str(self.path))
+        except FileNotFoundError:
+            pass
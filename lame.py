@@ -3,8 +3,6 @@
 __all__ = ["LAME", "LAMENotFoundError", "LAMEProcessError", "LAMETestFailedError"]
 
 from subprocess import Popen, PIPE, TimeoutExpired
-from functools import partial
-from collections import deque
 from threading import Thread, Event
 from queue import Queue, Empty
 import sys
@@ -26,7 +24,10 @@ if conf.log_level:
 else:
     log.level = "ERROR"
 
-from utils import locate_bin, HashProgressBar
+from utils import locate_bin, HashProgressBar, StderrCapture, StderrLines, stderr_log_path
+from profiler import Profiler, timed
+from rusage import AccountedPopen, ResourceReport
+from events import EventStream
 
 class LAMEException(Exception):
     pass
@@ -45,7 +46,13 @@ class LAMETestFailedError(LAMEException):
 
 
 class LAMEProcess:
-    def __init__(self, ff_path, lame_path, ff_args=[], lame_args=[], test=False, store_stderr=False):
+    """ffmpeg piping into lame, with ffmpeg's stderr read line by line.
+
+    popen starts both processes, it takes the arguments of subprocess.Popen
+    and can be replaced by anything that returns an object like it.
+    """
+    def __init__(self, ff_path, lame_path, ff_args=[], lame_args=[], test=False, capture=None, stdin=None,
+                 popen=AccountedPopen):
         if ff_args and not isinstance(ff_args, list):
             raise ValueError("you must provide a list for args")
 
@@ -57,16 +64,18 @@ class LAMEProcess:
         self._ff_args = ff_args
         self._lame_args = lame_args
         self._test = test
-        self._keep_stderr = store_stderr
+        self._capture = capture or StderrCapture()
+        self._stdin = stdin
+        self._popen = popen
+        self._drain = None
 
         self._ff_cmd = []
         self._lame_cmd = []
         self._ff_proc = None
         self._lame_proc = None
+        self._lines = None
         self._ff_returncode = None
         self._lame_returncode = None
-        self._ff_stderr = deque()
-        self._lame_stderr = None
         self._interrupted = False
 
     @property
@@ -95,10 +104,14 @@ class LAMEProcess:
                 log.d("starting lame test subprocess")
                 self._lame_proc = Popen([self._lame_path], stderr=PIPE, bufsize=0)
             else:
-                log.d("starting ffmpeg subprocess: {}".format(self._ff_cmd))
-                log.d("starting lame subprocess: {}".format(self._lame_cmd))
-                self._ff_proc = Popen(self._ff_cmd, stderr=PIPE, stdout=PIPE, bufsize=0)
-                self._lame_proc = Popen(self._lame_cmd, stdin=self._ff_proc.stdout, stderr=PIPE, bufsize=0)
+                log.d("starting ffmpeg subprocess: {}", self._ff_cmd)
+                log.d("starting lame subprocess: {}", self._lame_cmd)
+                self._ff_proc = self._popen(self._ff_cmd, stdin=self._stdin, stderr=PIPE, stdout=PIPE, bufsize=0)
+                self._lame_proc = self._popen(self._lame_cmd, stdin=self._ff_proc.stdout, stderr=PIPE, bufsize=0)
+                self._lines = StderrLines(self._ff_proc.stderr)
+
+                # lame's stderr is read all along so a full pipe never blocks it:
+                self._drain = self._capture.start_drain(self._lame_proc.stderr, "lame")
 
         except FileNotFoundError as err:
             raise LAMENotFoundError(err.strerror) from None
@@ -139,7 +152,7 @@ class LAMEProcess:
             try:
                 log.d("terminating lame process")
                 self._lame_proc.terminate()
-                self._lame_proc.communicate(timeout=5)
+                self._lame_proc.wait(timeout=5)
             except TimeoutExpired:
                 log.d("killing lame process")
                 self._lame_proc.kill()
@@ -160,44 +173,31 @@ class LAMEProcess:
         self._ff_returncode = self._ff_proc.poll()
         self._lame_returncode = self._lame_proc.poll()
 
-        # give qaac a chance to terminate cleanly:
-        if self._keep_stderr:
-            # and get stderr:
-            self._lame_stderr = self._lame_proc.communicate(timeout=5)[1]
-        self._lame_proc.communicate(timeout=5)
+        # give lame a chance to terminate cleanly and write its last lines:
+        self._lame_proc.wait(timeout=5)
+        if self._drain:
+            self._drain.join(timeout=5)
         raise StopIteration
 
     def __next__(self):
-        buffer = deque()
-        for err_char in iter(partial(self._ff_proc.stderr.read, 1), b''):
-            try:
-                if self._lame_proc.poll() is not None:
-                    # caught when exiting generator:
-                    raise LAMEProcessError("unexpected termination")
-                    # noinspection PyUnreachableCode
-                    raise StopIteration
-
-                # replace any not decoded char with a space:
-                try:
-                    buffer.append(err_char.decode("utf-8"))
-                except UnicodeDecodeError:
-                    buffer.append(' ')
-
-                if '\r' in buffer:
-                    line = "".join(buffer).strip()
-                    buffer.clear()
-
-                    if self._keep_stderr:
-                        self._ff_stderr.append(line)
-
-                    return line
-
-            except KeyboardInterrupt:
-                self._interrupted = True
-                self._stop_iteration()
-        else:
+        try:
+            line = self._lines.readline()
+        except KeyboardInterrupt:
+            self._interrupted = True
             self._stop_iteration()
 
+        if line is None:
+            self._stop_iteration()
+
+        # lines are read ahead, so only an encoder gone while ffmpeg
+        # still decodes has terminated too early:
+        if self._lame_proc.poll() is not None and self._ff_proc.poll() is None:
+            # caught when exiting generator:
+            raise LAMEProcessError("unexpected termination")
+
+        self._capture.append(line, "ffmpeg")
+        return line
+
     @property
     def ffmpeg_returncode(self):
         return self._ff_returncode
@@ -208,14 +208,17 @@ class LAMEProcess:
 
     @property
     def ff_stderr(self):
-        return self._ff_stderr
+        # only the last lines are kept:
+        return self._capture.tail("ffmpeg")
 
     @property
     def lame_stderr(self):
-        try:
-            return self._lame_stderr.decode("utf-8")
-        except AttributeError:
-            return None
+        return self._capture.text("lame")
+
+    @property
+    def usage(self):
+        # resource usage of the children once they have been reaped:
+        return {"ffmpeg": self._ff_proc.usage, "lame": self._lame_proc.usage}
 
 
 class LAME:
@@ -228,8 +231,15 @@ class LAME:
         self._lame_args = []
         self._bar = None
         self._duration = 0
-        self._ff_stderr = []
-        self._qaac_stderr = None
+        self._stderr = StderrCapture()
+        self._stdin = None
+
+        self._job = (None, None)
+        self._usage = None
+
+        # measure the gained audio on its way to the encoder:
+        self.meter_output = False
+        self._meter = None
 
         self._progressbar = HashProgressBar()
 
@@ -259,7 +269,7 @@ class LAME:
     def _test_bin(self):
         log.d("testing lame binary")
 
-        lame = LAMEProcess(ff_path=None, lame_path=self._lame_path, test=True, store_stderr=True).test()
+        lame = LAMEProcess(ff_path=None, lame_path=self._lame_path, test=True).test()
 
         if lame[1] == 1 and "LAME 64bits version 3.99.5" in lame[0]:
             log.d("testing lame binary succeded")
@@ -270,17 +280,28 @@ class LAME:
 
     @property
     def ffmpeg_stderr(self):
-        try:
-            return "\n".join(self._ff_stderr)
-        except TypeError:
-            return None
+        """Last lines ffmpeg wrote during the last job, see --stderr-log for all of them."""
+        return self._stderr.text("ffmpeg")
+
+    @property
+    def usage(self):
+        """Resource usage of the children of the last job, with --rusage."""
+        return self._usage
+
+    @property
+    def lame_path(self):
+        """Path of the LAME binary that is run."""
+        return self._lame_path
+
+    @property
+    def output_loudness(self):
+        """(lufs, peak) of the audio the last conversion encoded, with meter_output."""
+        return self._meter.loudness if self._meter else None
 
     @property
     def lame_stderr(self):
-        try:
-            return self._lame_stderr
-        except (TypeError, AttributeError):
-            return None
+        """Last lines lame wrote during the last job."""
+        return self._stderr.text("lame")
 
     @staticmethod
     def _check_file(file):
@@ -292,54 +313,71 @@ class LAME:
         if file.stat().st_size == 0:
             raise LAMEProcessError("{} is 0-byte file".format(file))
 
+    def _input(self, input_file, stdin):
+        # with stdin ffmpeg reads the input from that file descriptor
+        # and input_file only names the job:
+        self._stdin = stdin
+        if stdin is None:
+            self._check_file(input_file)
+            return str(input_file)
+        return "-"
+
+    def _check_output(self, output_file):
+        # "-" is written to stdout:
+        if str(output_file) != "-":
+            self._check_file(output_file)
+
     @staticmethod
-    def _start_lame_process(queue, quit_event, ff_path, lame_path, ff_args=[], lame_args=[], store_stderr=False):
+    def _start_lame_process(queue, quit_event, ff_path, lame_path, ff_args=[], lame_args=[], capture=None,
+                           stdin=None):
         # to be started as a thread!
         # noinspection PyBroadException
         try:
-            with LAMEProcess(ff_path, lame_path, ff_args, lame_args, store_stderr=store_stderr) as lame:
+            with LAMEProcess(ff_path, lame_path, ff_args, lame_args, capture=capture, stdin=stdin) as lame:
                 for line in lame:
                     if line:
                         queue.put(line)
 
                     if quit_event.is_set():
                         break
-                if store_stderr:
-                    queue.put(("stderr", lame.ff_stderr, lame.lame_stderr))
+            if ResourceReport().enabled:
+                queue.put(("rusage", lame.usage))
         # catching all exceptions from the thread:
         except Exception:
             exc = sys.exc_info()
             queue.put((exc[0], exc[1]))
+        finally:
+            if capture:
+                capture.close()
 
     def _create_queue_event_thread(self):
         self._queue = Queue()
         self._quit_event = Event()
+        self._stderr = StderrCapture(stderr_log_path(self._job))
 
         # start thread that reads from stderr:
         self._thread = Thread(target=self._start_lame_process, args=(self._queue, self._quit_event,
                                                                      self._ff_path, self._lame_path,
                                                                      self._ff_args, self._lame_args,
-                                                                     self._debug))
+                                                                     self._stderr, self._stdin))
         self._thread.daemon = True
         self._thread.start()
-        log.d("started thread: {}".format(self._thread.name))
+        log.d("started thread: {}", self._thread.name)
 
     def _thread_dead(self):
         return (not self._thread.is_alive()) and self._queue.empty()
 
     def _get_stderr_exception(self, data):
-        # a tuple is either an exception or full stderr
+        # a tuple is either an exception or resource usage
         if isinstance(data, tuple):
-            # get stderr info:
-            if data[0] == "stderr":
-                if self._debug:
-                    self._ff_stderr = data[1]
-                    self._lame_stderr = data[2]
+            if data[0] == "rusage":
+                self._usage = data[1]
+                ResourceReport().add(self._job[0], self._job[1], self._usage)
             else:
                 # react to exception:
                 self._progressbar.finish()
-                log.d("raising exception {} from thread".format(data[0]))
-                raise data[0](data[1])
+                log.d("raising exception {} from thread", data[0])
+                raise self._stderr.attach(data[0](data[1]))
 
     def _quit_thread(self, exception=None):
         self._progressbar.finish()
@@ -348,17 +386,18 @@ class LAME:
 
         # give thread a chance:
         if self._thread.is_alive():
-            log.d("thread {} is still alive".format(self._thread.name))
+            log.d("thread {} is still alive", self._thread.name)
             self._thread.join(timeout=5)
 
         # check again:
         if self._thread.is_alive():
-            log.d("thread {} is still alive, will not exit cleanly!".format(self._thread.name))
+            log.d("thread {} is still alive, will not exit cleanly!", self._thread.name)
 
         if exception:
-            raise exception
+            raise self._stderr.attach(exception)
 
-    def _get_duration(self):
+    @timed("_get_duration")
+    def _get_duration(self, start=None, length=None):
         log.d("getting file duration")
 
         duration = 0
@@ -391,76 +430,92 @@ class LAME:
                         duration = hh * 60 * 60 + mm * 60 + ss
 
                 else:
-                    log.d("got duration: {}".format(duration))
-                    self._duration = duration
+                    log.d("got duration: {}", duration)
+                    self._duration = part_duration(duration, start, length)
+                    Profiler().audio(self._duration)
                     break
 
-    def _single_file_conversion(self):
+    def _single_file_conversion(self, start=None, length=None):
+        self._meter = Meter() if self.meter_output else None
         self._create_queue_event_thread()
 
-        self._get_duration()
+        self._get_duration(start, length)
 
-        self._progressbar.create(self._duration)
+        self._progressbar.create(self._duration, label=self._job[0], audio=True)
 
-        try:
-            while True:
-                if self._thread_dead():
-                    self._progressbar.finish()
-                    break
+        with Profiler().span("wait"):
+            try:
+                while True:
+                    if self._thread_dead():
+                        self._progressbar.finish()
+                        break
 
-                try:
-                    data = self._queue.get(timeout=0.1)
-                except Empty:
-                    continue
+                    try:
+                        data = self._queue.get(timeout=0.1)
+                    except Empty:
+                        continue
 
-                else:
-                    self._get_stderr_exception(data)
+                    else:
+                        self._get_stderr_exception(data)
 
-                    time_re = None
-                    try:
-                        time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
-                    except TypeError:
-                        pass
+                        if self._meter:
+                            self._meter.feed(data)
 
-                    if time_re:
-                        hh = int(time_re.group(1))
-                        mm = int(time_re.group(2))
-                        ss = int(time_re.group(3))
-                        ms = int(time_re.group(4))
+                        time_re = None
+                        try:
+                            time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
+                        except TypeError:
+                            pass
 
-                        if ms > 50:
-                            ss += 1  # round up
+                        if time_re:
+                            hh = int(time_re.group(1))
+                            mm = int(time_re.group(2))
+                            ss = int(time_re.group(3))
+                            ms = int(time_re.group(4))
+
+                            if ms > 50:
+                                ss += 1  # round up
 
-                        time = hh * 60 * 60 + mm * 60 + ss
+                            time = hh * 60 * 60 + mm * 60 + ss
 
-                        if time < self._duration:
-                            self._progressbar.update(time)
-                        else:
-                            self._progressbar.update(self._duration)
+                            if time < self._duration:
+                                self._progressbar.update(time)
+                            else:
+                                self._progressbar.update(self._duration)
+                            EventStream().progress(time, self._duration)
 
-                    if "Error" in data:
-                        self._quit_thread(LAMEProcessError(data))
+                        if "Error" in data:
+                            self._quit_thread(LAMEProcessError(data))
 
-            self._quit_thread()
+                self._quit_thread()
 
-        except KeyboardInterrupt as exc:
-            self._quit_thread(exc)
+            except KeyboardInterrupt as exc:
+                self._quit_thread(exc)
 
-    def convert_to_mp3(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+    @timed("convert_to_mp3")
+    def convert_to_mp3(self, input_file, output_file, volume=0, stdin=None, start=None, length=None):
+        """Encode input_file, only length seconds of it from start on if given.
 
-        self._ff_args = ["-hide_banner",
-                         "-i", str(input_file),
-                         "-vn", "-filter:a",
-                         "volume={}dB".format(volume),
-                         "-f", "wav", "-y", "-"]
+        A part is encoded without the bit reservoir, so that none of its
+        frames refers to bytes of the frame before it.
+        """
+        self._job = (input_file.name, "mp3")
+
+        self._ff_args = ["-hide_banner"]
+        self._ff_args.extend(input_args(self._input(input_file, stdin), start, length))
+        self._ff_args.append("-vn")
+        self._ff_args.extend(audio_filter_args("volume={}dB".format(volume), self.meter_output))
+        self._ff_args.extend(["-f", "wav", "-y", "-"])
 
         self._lame_args = ["-b", "64", "-V", "0", "-q", "0",
                            "-p", "--noreplaygain",
                            "--add-id3v2", "--pad-id3v2",
                            "-", str(output_file)]
 
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
-        self._single_file_conversion()
+        if start is not None or length is not None:
+            self._lame_args.insert(0, "--nores")
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(start, length)
 
-        self._check_file(output_file)
+        self._check_output(output_file)
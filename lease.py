@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["LeaseManager", "LeaseError"]
+
+from threading import Thread, Event, Lock
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+
+class LeaseError(Exception):
+    pass
+
+
+class LeaseManager:
+    """Claim jobs on shared storage through lease files.
+
+    Instantiate with: LeaseManager(folder)
+        where folder is a directory visible to every cooperating process
+        (on every host). Lease files are kept in folder/.leases.
+
+    A lease is a small json file created with O_CREAT | O_EXCL which is
+    atomic on local filesystems and on NFSv3 and newer, so only one process
+    can hold a given key. Held leases are renewed in the background, a lease
+    that has not been renewed for its ttl belongs to a crashed worker and is
+    reclaimed by atomically renaming it out of the way.
+
+    The age of a lease is that of its file, measured with the clock of the
+    server the folder is on: the mtime it gives a file this worker writes
+    is compared to the mtime of the lease. So the hosts' clocks don't need
+    to agree, only the file server's mtimes have to be reliable.
+
+    Args:
+        ttl: seconds after which a lease that is not renewed expires
+        owner: unique name of this worker (defaults to host:pid:random)
+
+    Raises:
+        LeaseError: if the lease folder can not be created
+    """
+    def __init__(self, folder, ttl=300, owner=None):
+        self.folder = pathlib.Path(folder) / ".leases"
+        self.ttl = ttl
+        self.owner = owner or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self._held = {}
+        self._held_lock = Lock()
+
+        # the server's time is local time plus an offset that is measured
+        # again every few seconds:
+        self._clock = None
+        self._offset = 0.0
+        self._measured = None
+        self._quit_event = Event()
+        self._thread = None
+
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+        except OSError as err:
+            raise LeaseError("Could not create lease folder {}: {}".format(self.folder, err)) from None
+
+        self._clock = self.folder / "{}.clock".format(uuid.uuid4().hex)
+
+        log.d("created LeaseManager for {} as {}", self.folder, self.owner)
+
+    def _path(self, key):
+        # keys are usually paths, hash them to get a flat and safe filename:
+        return self.folder / "{}.lease".format(hashlib.sha1(str(key).encode("utf-8")).hexdigest())
+
+    def _content(self, key):
+        return json.dumps({"key": str(key),
+                           "owner": self.owner,
+                           "host": socket.gethostname(),
+                           "pid": os.getpid(),
+                           "ttl": self.ttl})
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(str(path), mode='r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # a lease that is being written is empty for a short moment:
+            return {}
+
+    def _now(self):
+        # the time of the file server, the mtime of a file written just now:
+        local = time.time()
+        if self._measured is None or local - self._measured > min(self.ttl / 3, 60):
+            try:
+                with open(str(self._clock), mode='w') as f:
+                    f.write(self.owner)
+                self._offset = self._clock.stat().st_mtime - time.time()
+            except OSError as err:
+                log.d("could not read the clock of {}: {}", self.folder, err)
+                self._offset = 0.0
+            self._measured = local
+        return local + self._offset
+
+    def _expired(self, path, data):
+        # a lease is renewed by touching it, so its mtime tells when its
+        # owner was last alive; the owner's ttl counts:
+        ttl = data.get("ttl", self.ttl) if data else self.ttl
+        try:
+            return path.stat().st_mtime + ttl < self._now()
+        except FileNotFoundError:
+            return True
+
+    def _create(self, key, path):
+        try:
+            fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, mode='w') as f:
+            f.write(self._content(key))
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def _reclaim(self, path):
+        # rename is atomic, so only one of the processes that found
+        # the same stale lease will succeed:
+        tombstone = path.with_name("{}.{}.stale".format(path.name, uuid.uuid4().hex[:8]))
+        try:
+            os.rename(str(path), str(tombstone))
+        except FileNotFoundError:
+            return False
+
+        data = self._read(tombstone)
+        if not self._expired(tombstone, data):
+            # the owner renewed it in the meantime, put it back unless
+            # another worker has created a new lease since (a rename would
+            # replace that one, a link fails):
+            try:
+                os.link(str(tombstone), str(path))
+            except FileExistsError:
+                log.d("lost the race for {}, a new lease was created", path.name)
+            except OSError as err:
+                log.d("could not put back lease {}: {}", path.name, err)
+            try:
+                os.remove(str(tombstone))
+            except FileNotFoundError:
+                pass
+            return False
+
+        log.d("reclaimed stale lease of {}", data.get("owner") if data else "unknown owner")
+        try:
+            os.remove(str(tombstone))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def claim(self, key):
+        """Try to take the lease for key.
+
+        Returns None if another live worker holds it, otherwise a bool
+        telling whether a stale lease of a crashed worker was reclaimed
+        (in which case partial results of that worker must be redone).
+        """
+        path = self._path(key)
+        stale = False
+
+        for _ in range(2):
+            if self._create(key, path):
+                with self._held_lock:
+                    self._held[str(key)] = path
+                self._start_renewal()
+                log.d("claimed lease for {}", key)
+                return stale
+
+            data = self._read(path)
+            if data is None or not self._expired(path, data):
+                # held by someone else:
+                return None
+
+            stale = self._reclaim(path) or stale
+
+        return None
+
+    def release(self, key):
+        with self._held_lock:
+            path = self._held.pop(str(key), None)
+
+        if path:
+            try:
+                os.remove(str(path))
+                log.d("released lease for {}", key)
+            except FileNotFoundError:
+                log.d("lease for {} was already gone", key)
+
+    def leased(self, key):
+        """Tell whether anyone (live or crashed) holds the lease for key."""
+        return self._path(key).exists()
+
+    def held(self, key):
+        with self._held_lock:
+            return str(key) in self._held
+
+    def lock(self, key, poll=0.1):
+        """Context manager that waits until the lease for key is taken."""
+        return _LeaseLock(self, key, poll)
+
+    def _renew(self):
+        with self._held_lock:
+            held = list(self._held.items())
+
+        for key, path in held:
+            # only the mtime is bumped (to the server's time, like a write),
+            # so a lease that was reclaimed and created anew in the meantime
+            # is never replaced; at worst its new owner's lease is renewed:
+            try:
+                os.utime(str(path))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                log.d("could not renew lease for {}: {}", key, err)
+                continue
+
+            data = self._read(path)
+            if data is None or data.get("owner", self.owner) != self.owner:
+                # someone decided we were dead and took over, or is about to:
+                log.w("Lost lease for {} to {}.", key, data.get("owner") if data else "another worker")
+                with self._held_lock:
+                    self._held.pop(key, None)
+
+    def _renewal_loop(self):
+        while not self._quit_event.wait(self.ttl / 3):
+            self._renew()
+
+    def _start_renewal(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._renewal_loop)
+            self._thread.daemon = True
+            self._thread.start()
+            log.d("started thread: {}", self._thread.name)
+
+    def close(self):
+        self._quit_event.set()
+
+        with self._held_lock:
+            keys = list(self._held.keys())
+
+        for key in keys:
+            self.release(key)
+
+        try:
+            os.remove(str(self._clock))
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _LeaseLock:
+    def __init__(self, manager, key, poll):
+        self._manager = manager
+        self._key = key
+        self._poll = poll
+
+    def __enter__(self):
+        while self._manager.claim(self._key) is None:
+            time.sleep(self._poll)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._manager.release(self._key)
+
+
+def _worker(folder, jobs, results, ttl, crash):
+    # claims every job it can, marks it done and, if asked to, crashes
+    # while holding a lease:
+    manager = LeaseManager(folder, ttl=ttl)
+    pending = list(jobs)
+
+    while pending:
+        for job in list(pending):
+            if (pathlib.Path(results) / job).exists():
+                pending.remove(job)
+                continue
+
+            if manager.claim(job) is None:
+                continue
+
+            if crash:
+                os._exit(1)
+
+            if (pathlib.Path(results) / job).exists():
+                # its previous holder finished it after we looked:
+                manager.release(job)
+                pending.remove(job)
+                continue
+
+            time.sleep(0.01)
+            fd = os.open(str(pathlib.Path(results) / job), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, manager.owner.encode("utf-8"))
+            os.close(fd)
+
+            manager.release(job)
+            pending.remove(job)
+        time.sleep(0.05)
+
+    manager.close()
+
+
+def _check_renew_race(folder):
+    # another worker reclaims an expired lease right before its holder
+    # renews it, the renewal must leave the new lease alone:
+    with LeaseManager(folder, ttl=60) as holder, LeaseManager(folder, ttl=60) as other:
+        assert holder.claim("race") is not None
+        path = holder._path("race")
+        os.utime(str(path), (time.time() - 3600,) * 2)
+
+        # whichever call the renewal writes the lease with, the reclaim
+        # happens right before it:
+        originals = {name: getattr(os, name) for name in ("utime", "replace")}
+
+        def reclaim_first(name):
+            def call(*args, **kwargs):
+                if not other.held("race"):
+                    assert other.claim("race") is True, "the expired lease was not reclaimed"
+                return originals[name](*args, **kwargs)
+            return call
+
+        for name in originals:
+            setattr(os, name, reclaim_first(name))
+        try:
+            holder._renew()
+        finally:
+            for name, original in originals.items():
+                setattr(os, name, original)
+
+        assert LeaseManager._read(path)["owner"] == other.owner, "the renewal overwrote the new lease"
+        assert not holder.held("race") and other.held("race"), "both workers hold the lease"
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _check_renew_race(tmp)
+        print("a renewal leaves a lease reclaimed in the meantime alone")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = pathlib.Path(tmp) / "results"
+        results.mkdir()
+        jobs = ["job{:03d}".format(n) for n in range(200)]
+
+        # one worker dies holding a lease, the others must take it over:
+        workers = [multiprocessing.Process(target=_worker, args=(tmp, jobs, str(results), 1, n == 0))
+                   for n in range(6)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert all(worker.exitcode == 0 for worker in workers[1:]), "a worker failed"
+
+        done = sorted(file.name for file in results.iterdir())
+        owners = {file.read_text() for file in results.iterdir()}
+        # any job done twice would have failed on O_EXCL:
+        assert done == jobs, "missing jobs: {}".format(set(jobs) - set(done))
+        print("{} jobs done once each by {} workers in {:.2f}s".format(len(done), len(owners), time.time() - start))
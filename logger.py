@@ -1,49 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import atexit
 import os
+import queue
 import sys
+import threading
 import logging
-import inspect
-import traceback
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import colorama
 
 __all__ = ["Logger"]
 
+# a log file is rotated once it reaches this size, keeping this many old ones:
+LOG_FILE_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
 
 class ColorHandler(logging.StreamHandler):
     def __init__(self, stream=sys.stderr):
-        super().__init__(colorama.AnsiToWin32(stream).stream)
+        # colorama only has to convert on windows consoles, elsewhere
+        # writing through its wrapper would just cost time:
+        wrapper = colorama.AnsiToWin32(stream)
+        super().__init__(wrapper.stream if wrapper.should_wrap() else stream)
         self._stream = stream
 
+        isatty = getattr(self._stream, 'isatty', None)
+        self._is_tty = bool(isatty and isatty())
+
     @property
     def is_tty(self):
-        isatty = getattr(self._stream, 'isatty', None)
-        return isatty and isatty()
+        return self._is_tty
+
+    STYLES = {logging.DEBUG: colorama.Style.DIM + colorama.Back.CYAN + colorama.Fore.BLUE,
+              logging.INFO: colorama.Style.BRIGHT + colorama.Fore.WHITE,
+              logging.WARN: colorama.Style.BRIGHT + colorama.Fore.YELLOW,
+              logging.ERROR: colorama.Style.BRIGHT + colorama.Fore.RED,
+              logging.CRITICAL: colorama.Style.BRIGHT + colorama.Back.RED + colorama.Fore.WHITE}
 
     def format(self, record):
         message = logging.StreamHandler.format(self, record)
 
-        if self.is_tty:
-            if record.levelno == logging.DEBUG:
-                style = colorama.Style.DIM + colorama.Back.CYAN + colorama.Fore.BLUE
-                # style = colorama.Style.DIM + colorama.Fore.WHITE
-
-            elif record.levelno == logging.INFO:
-                style = colorama.Style.BRIGHT + colorama.Fore.WHITE
-
-            elif record.levelno == logging.WARN:
-                style = colorama.Style.BRIGHT + colorama.Fore.YELLOW
-
-            elif record.levelno == logging.ERROR:
-                style = colorama.Style.BRIGHT + colorama.Fore.RED
-
-            elif record.levelno == logging.CRITICAL:
-                style = colorama.Style.BRIGHT + colorama.Back.RED + colorama.Fore.WHITE
-
-            else:
-                style = colorama.Style.NORMAL + colorama.Fore.WHITE
-
+        if self._is_tty:
+            style = self.STYLES.get(record.levelno, colorama.Style.NORMAL + colorama.Fore.WHITE)
             return style + message + colorama.Style.RESET_ALL
 
         else:
@@ -51,29 +50,60 @@ class ColorHandler(logging.StreamHandler):
 
 
 class LogFormat(logging.Formatter):
-    def __init__(self):
-        super().__init__()
+    # one formatter per level, built once:
+    FORMATS = {logging.DEBUG: "DEBUG: {message}",
+               logging.INFO: "{message}",
+               logging.WARNING: "WARN: {message}",
+               logging.ERROR: "ERROR: {message}",
+               logging.CRITICAL: "CRITICAL ERROR: {message}"}
+
+    def __init__(self, tag_jobs=False):
+        super().__init__(fmt="{message}", style='{')
+        self._formatters = {level: logging.Formatter(fmt=fmt, style='{') for level, fmt in self.FORMATS.items()}
+        self._tag_jobs = tag_jobs
 
     def format(self, record):
-        if record.levelno == logging.DEBUG:
-            self._style = logging._STYLES['{'][0]("DEBUG: {message}")
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            message = super().format(record)
+        else:
+            message = formatter.format(record)
+
+        job = getattr(record, "job", None)
+        if self._tag_jobs and job:
+            return "[{}] {}".format(job, message)
+        return message
 
-        elif record.levelno == logging.INFO:
-            self._style = logging._STYLES['{'][0]("{message}")
 
-        elif record.levelno == logging.WARNING:
-            self._style = logging._STYLES['{'][0]("WARN: {message}")
+class FileFormat(logging.Formatter):
+    def __init__(self):
+        super().__init__(fmt="{asctime} {process:>6} {levelname:<8} [{job}] {message}", style='{')
 
-        elif record.levelno == logging.ERROR:
-            self._style = logging._STYLES['{'][0]("ERROR: {message}")
+    def format(self, record):
+        if getattr(record, "job", None) is None:
+            record.job = ""
+        return super().format(record)
 
-        elif record.levelno == logging.CRITICAL:
-            self._style = logging._STYLES['{'][0]("CRITICAL ERROR: {message}")
 
-        else:
-            self._style = logging._STYLES['{'][0]("{message}")
+class JobFilter(logging.Filter):
+    # tags records with the job of the thread that logs them, records
+    # shipped from other processes arrive tagged already:
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
 
-        return logging.Formatter.format(self, record)
+    @property
+    def job(self):
+        return getattr(self._local, "job", None)
+
+    @job.setter
+    def job(self, job):
+        self._local.job = job
+
+    def filter(self, record):
+        if not hasattr(record, "job"):
+            record.job = self.job
+        return True
 
 
 class Singleton(type):
@@ -97,6 +127,14 @@ class Logger(metaclass=Singleton):
         self._log = logging.getLogger(name)
         self._logger_set = False
 
+        self._jobs = JobFilter()
+        self._log.addFilter(self._jobs)
+
+        # set while records go through a queue, see aggregate():
+        self._terminal = None
+        self._file_level = None
+        self._listener = None
+
     @property
     def level(self):
         return self._level
@@ -110,8 +148,12 @@ class Logger(metaclass=Singleton):
             raise AttributeError("Valid options: {}".format(", ".join(self.LEVELS))) from None
 
     def _update_log_level(self):
-        if self._log.level != self._level:
-            self._log.setLevel(self._level)
+        # a log file may want more than the terminal shows:
+        level = self._level if self._file_level is None else min(self._level, self._file_level)
+        if self._log.level != level:
+            self._log.setLevel(level)
+        if self._terminal:
+            self._terminal.setLevel(self._level)
 
     def _setup_logger(self):
         handler = ColorHandler()
@@ -121,55 +163,141 @@ class Logger(metaclass=Singleton):
         self._update_log_level()
         self._logger_set = True
 
+    def _ship_to(self, records):
+        for handler in list(self._log.handlers):
+            self._log.removeHandler(handler)
+        self._log.addHandler(QueueHandler(records))
+        self._logger_set = True
+
+    def aggregate(self, path=None, file_level="DEBUG", records=None):
+        """Write all records from one listener thread instead of the logging threads.
+
+        Logging then only puts records into a queue, the listener writes
+        them to the terminal, tagged with their job, and to a rotating
+        log file at path if given. Worker processes pass the returned
+        queue, which has to be a multiprocessing one for them, to attach().
+        The listener is stopped, and the queue emptied, at exit.
+        """
+        if self._listener:
+            return self._listener.queue
+
+        if records is None:
+            records = queue.Queue()
+
+        self._terminal = ColorHandler()
+        self._terminal.setFormatter(LogFormat(tag_jobs=True))
+        handlers = [self._terminal]
+
+        if path:
+            try:
+                self._file_level = getattr(logging, file_level)
+            except AttributeError:
+                raise AttributeError("Valid options: {}".format(", ".join(self.LEVELS))) from None
+
+            file = RotatingFileHandler(str(path), maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS,
+                                       encoding="utf-8")
+            file.setLevel(self._file_level)
+            file.setFormatter(FileFormat())
+            handlers.append(file)
+
+        self._ship_to(records)
+        self._update_log_level()
+
+        self._listener = QueueListener(records, *handlers, respect_handler_level=True)
+        self._listener.start()
+        atexit.register(self.stop)
+        return records
+
+    def attach(self, records):
+        """Send the records of this process to the listener of aggregate()."""
+        self._ship_to(records)
+        self._update_log_level()
+
+    def stop(self):
+        """Write what is still queued and stop the listener of aggregate()."""
+        if self._listener:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+
+    def start_job(self, job):
+        """Tag what this thread logs with job."""
+        self._jobs.job = job
+
+    def end_job(self):
+        self._jobs.job = None
+
     def _exceptions(self, exc_type, exc_value, exc_traceback):
         self._log.debug("", exc_info=(exc_type, exc_value, exc_traceback))
 
     def handle_exceptions(self):
         sys.excepthook = self._exceptions
 
-    def d(self, msg):
+    def _message(self, msg, args):
+        # messages are only formatted once they are known to be logged:
+        if args:
+            return msg.format(*args)
+        return msg
+
+    def d(self, msg, *args):
+        if not self._log.isEnabledFor(logging.DEBUG):
+            return
         if not self._logger_set:
             self._setup_logger()
-        if self._log.isEnabledFor(logging.DEBUG):
-            # inspect one frame backwards:
-            frame = inspect.currentframe().f_back
-            trace_back = traceback.extract_stack(frame)[-1]
-            module = os.path.basename(trace_back[0])  # filename
-            line = trace_back[1]  # line number
-            self._log.debug("line {} in {}: {}".format(line, module, msg))
-
-    def i(self, msg):
+
+        # the caller's frame, without extracting the whole stack:
+        frame = sys._getframe(1)
+        module = os.path.basename(frame.f_code.co_filename)
+        self._log.debug("line {} in {}: {}".format(frame.f_lineno, module, self._message(msg, args)))
+
+    def i(self, msg, *args):
+        if not self._log.isEnabledFor(logging.INFO):
+            return
         if not self._logger_set:
             self._setup_logger()
-        if self._log.isEnabledFor(logging.INFO):
-            self._log.info(msg)
+        self._log.info(self._message(msg, args))
 
-    def w(self, msg):
+    def w(self, msg, *args):
+        if not self._log.isEnabledFor(logging.WARNING):
+            return
         if not self._logger_set:
             self._setup_logger()
-        if self._log.isEnabledFor(logging.WARNING):
-            self._log.warning(msg)
+        self._log.warning(self._message(msg, args))
 
-    def e(self, msg):
+    def e(self, msg, *args):
+        if not self._log.isEnabledFor(logging.ERROR):
+            return
         if not self._logger_set:
             self._setup_logger()
-        if self._log.isEnabledFor(logging.ERROR):
-            self._log.error(msg)
+        self._log.error(self._message(msg, args))
 
-    def c(self, msg):
+    def c(self, msg, *args):
+        if not self._log.isEnabledFor(logging.CRITICAL):
+            return
         if not self._logger_set:
             self._setup_logger()
-        if self._log.isEnabledFor(logging.CRITICAL):
-            self._log.critical(msg)
+        self._log.critical(self._message(msg, args))
 
 
 if __name__ == "__main__":
     log = Logger("test")
     log.level = "DEBUG"
     log.d("debug message")
+    log.d("lazy {} message", "debug")
     log.i("info message")
     log.w("warn message")
     log.e("error message")
     log.c("critical message")
+
+    # records of several threads written by one listener, tagged with their job:
+    log.aggregate()
+    workers = [threading.Thread(target=lambda job: (log.start_job(job), log.i("queued message")), args=(job,))
+               for job in ("first.m4a", "second.m4a")]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
     log.handle_exceptions()
     raise SystemError("test error")
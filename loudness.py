@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["BlockHistogram", "integrated_loudness", "gated_loudness"]
+
+import base64
+import math
+import zlib
+
+# EBU R128 / ITU-R BS.1770 gating:
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# ebur128 writes block loudness with three decimals into the metadata, so
+# bins of a thousandth of a LU hold every block exactly and a histogram
+# gives the same loudness as gated_loudness of its blocks. Blocks with more
+# decimals are moved by up to MAX_ERROR LU, which moves the loudness by as
+# much, unless it moves a block across the relative gate:
+BINS_PER_LU = 1000
+MAX_ERROR = 0.5 / BINS_PER_LU
+
+# histograms stored before the bins got finer have ten per LU and no
+# version prefix:
+LEGACY_BINS_PER_LU = 10
+VERSION = "2:"
+
+
+def _energy(lufs):
+    return 10 ** ((lufs + 0.691) / 10)
+
+
+def _loudness(energy):
+    return -0.691 + 10 * math.log10(energy)
+
+
+class BlockHistogram:
+    """Histogram of the loudness of 400 ms gating blocks.
+
+    The blocks are the momentary (M) values ebur128 reports every 100 ms,
+    which are exactly the overlapping blocks BS.1770 gates on. Blocks below
+    the absolute gate never contribute so they are not stored.
+
+    Histograms of several tracks are merged by adding counts, which gives
+    the same integrated loudness as analyzing the concatenated tracks.
+    """
+    def __init__(self, counts=None):
+        self.counts = dict(counts) if counts else {}
+
+    @classmethod
+    def of(cls, blocks):
+        """Histogram of a sequence of block loudness values."""
+        histogram = cls()
+        for lufs in blocks:
+            histogram.add(lufs)
+        return histogram
+
+    def add(self, lufs):
+        if lufs >= ABSOLUTE_GATE:
+            index = int(round(lufs * BINS_PER_LU))
+            self.counts[index] = self.counts.get(index, 0) + 1
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    def __add__(self, other):
+        return BlockHistogram(self.counts).merge(other)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def _mean_energy(self, threshold):
+        total = 0.0
+        blocks = 0
+        for index, count in self.counts.items():
+            lufs = index / BINS_PER_LU
+            if lufs >= threshold:
+                total += _energy(lufs) * count
+                blocks += count
+        return total / blocks if blocks else 0.0
+
+    def _integrated(self):
+        ungated = self._mean_energy(ABSOLUTE_GATE)
+        if not ungated:
+            return ABSOLUTE_GATE
+
+        return _loudness(self._mean_energy(max(ABSOLUTE_GATE, _loudness(ungated) + RELATIVE_GATE)))
+
+    def integrated(self):
+        """Gated integrated loudness in LUFS, -70.0 for silence."""
+        return round(self._integrated(), 1)
+
+    def encode(self):
+        """Compact text form: zlib compressed varints of the gaps between used bins and their counts."""
+        if not self.counts:
+            return ""
+
+        values = []
+        previous = int(ABSOLUTE_GATE * BINS_PER_LU)
+        for index in sorted(self.counts):
+            values += [index - previous, self.counts[index]]
+            previous = index
+
+        data = bytearray()
+        for value in values:
+            while value > 0x7f:
+                data.append((value & 0x7f) | 0x80)
+                value >>= 7
+            data.append(value)
+
+        return VERSION + base64.b64encode(zlib.compress(bytes(data), 9)).decode("ascii")
+
+    @classmethod
+    def decode(cls, text):
+        if not text:
+            return cls()
+
+        legacy = not text.startswith(VERSION)
+        if not legacy:
+            text = text[len(VERSION):]
+
+        values = []
+        value = shift = 0
+        for byte in zlib.decompress(base64.b64decode(text)):
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                values.append(value)
+                value = shift = 0
+
+        if legacy:
+            # the dense counts of tenth of a LU bins, from the lowest one on:
+            scale = BINS_PER_LU // LEGACY_BINS_PER_LU
+            low = values[0] + int(ABSOLUTE_GATE * LEGACY_BINS_PER_LU)
+            return cls({(low + offset) * scale: count for offset, count in enumerate(values[1:]) if count})
+
+        counts = {}
+        index = int(ABSOLUTE_GATE * BINS_PER_LU)
+        for gap, count in zip(values[::2], values[1::2]):
+            index += gap
+            counts[index] = count
+        return cls(counts)
+
+    def __repr__(self):
+        return "BlockHistogram({} blocks)".format(len(self))
+
+
+def _gated_loudness(blocks):
+    energies = [_energy(lufs) for lufs in blocks if lufs >= ABSOLUTE_GATE]
+    if not energies:
+        return ABSOLUTE_GATE
+
+    threshold = _energy(max(ABSOLUTE_GATE, _loudness(sum(energies) / len(energies)) + RELATIVE_GATE))
+    gated = [energy for energy in energies if energy >= threshold]
+    return _loudness(sum(gated) / len(gated))
+
+
+def gated_loudness(blocks):
+    """Gated integrated loudness of block loudness values, without binning.
+
+    Blocks measured in pieces give the same value as measured at once,
+    as long as every block is in exactly one of the pieces.
+    """
+    return round(_gated_loudness(blocks), 1)
+
+
+def integrated_loudness(histograms):
+    """Integrated loudness of several tracks played back to back."""
+    merged = BlockHistogram()
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged.integrated()
+
+
+if __name__ == "__main__":
+    # an album of random tracks with blocks as ebur128 writes them: its
+    # merged histograms must give the loudness of all blocks at once, also
+    # after a round trip through the stored form; exits non-zero otherwise:
+    import random
+    import sys
+
+    random.seed(128)
+    failed = 0
+    for album in range(200):
+        tracks = [[round(random.gauss(random.uniform(-30, -8), random.uniform(1, 8)), 3)
+                   for _ in range(random.randint(10, 3000))]
+                  for _ in range(random.randint(1, 12))]
+        # some silence and blocks right at the absolute gate:
+        tracks[0] += [-120.0, ABSOLUTE_GATE, ABSOLUTE_GATE - 0.001]
+
+        merged = BlockHistogram()
+        for blocks in tracks:
+            merged.merge(BlockHistogram.decode(BlockHistogram.of(blocks).encode()))
+
+        exact = _gated_loudness([lufs for blocks in tracks for lufs in blocks])
+        # only the order of the sums may differ:
+        if abs(merged._integrated() - exact) > 1e-9 or len(merged) != sum(len([lufs for lufs in blocks if lufs >= ABSOLUTE_GATE])
+                                                   for blocks in tracks):
+            print("album {}: {:.6f} LUFS merged, {:.6f} LUFS exact".format(album, merged._integrated(), exact))
+            failed += 1
+
+    # histograms stored with the old tenth of a LU bins still decode:
+    legacy = base64.b64encode(zlib.compress(bytes([0xf4, 0x03, 2, 0, 1]))).decode("ascii")
+    if BlockHistogram.decode(legacy).counts != {-20000: 2, -19800: 1}:
+        print("legacy histogram decoded wrong")
+        failed += 1
+
+    print("{} of 200 albums merged wrong".format(failed))
+    sys.exit(1 if failed else 0)
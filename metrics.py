@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["Registry", "MetricsError"]
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+import os
+import time
+import uuid
+
+from config import Singleton
+
+import logger
+log = logger.Logger(__name__)
+
+# seconds, from a jingle's md5sum to the encode of a long mix:
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class MetricsError(Exception):
+    pass
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                    for key, value in labels))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def lines(self):
+        with self._lock:
+            return ["{}{} {}".format(self.name, _labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=STAGE_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def lines(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(self.name, _labels(key + (("le", bound),)), bucket))
+                lines.append("{}_bucket{} {}".format(self.name, _labels(key + (("le", "+Inf"),)), count))
+                lines.append("{}_sum{} {}".format(self.name, _labels(key), round(total, 6)))
+                lines.append("{}_count{} {}".format(self.name, _labels(key), count))
+        return lines
+
+
+class Registry(metaclass=Singleton):
+    """Process-wide metrics in the Prometheus text exposition format.
+
+    Disabled by default so that the instrumented code paths cost a single
+    attribute check. export() renders all metrics, write() puts them into
+    a textfile for node_exporter and serve() exposes /metrics on localhost.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._start = time.time()
+        self._server = None
+
+        self.files = Counter("normalize_files_total", "Files encoded, by format.")
+        self.audio = Counter("normalize_audio_seconds_total", "Seconds of audio encoded, by format.")
+        self.lookups = Counter("normalize_db_lookups_total", "Loudness database lookups, by result (hit or miss).")
+        self.failures = Counter("normalize_failures_total", "Failed stages, by stage and component.")
+        self.stages = Histogram("normalize_stage_seconds", "Duration of a processing stage, by stage and component.")
+        self.uptime = Gauge("normalize_run_seconds", "Seconds since the run started.")
+        self.rates = Gauge("normalize_throughput", "Run averages: files per second, audio hours per hour "
+                                                   "and database hit ratio.")
+
+        self._metrics = [self.files, self.audio, self.lookups, self.failures, self.stages, self.uptime, self.rates]
+
+    def stage(self, stage, component, seconds, audio=0):
+        self.stages.observe(seconds, stage=stage, component=component)
+
+        if stage.startswith("convert_to_"):
+            output_format = stage[len("convert_to_"):]
+            self.files.inc(format=output_format)
+            self.audio.inc(audio, format=output_format)
+
+    def failure(self, stage, component):
+        self.failures.inc(stage=stage, component=component)
+
+    def lookup(self, hit):
+        self.lookups.inc(result="hit" if hit else "miss")
+
+    def _update_rates(self):
+        elapsed = time.time() - self._start
+        self.uptime.set(round(elapsed, 3))
+        if elapsed:
+            self.rates.set(round(self.files.total() / elapsed, 6), rate="files_per_second")
+            self.rates.set(round(self.audio.total() / elapsed, 6), rate="audio_hours_per_hour")
+
+        lookups = self.lookups.total()
+        if lookups:
+            self.rates.set(round(self.lookups.value(result="hit") / lookups, 6), rate="db_hit_ratio")
+
+    def export(self):
+        self._update_rates()
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write a textfile, atomically as the node_exporter collector requires."""
+        temp = "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+        try:
+            with open(temp, mode='w') as f:
+                f.write(self.export())
+            os.replace(temp, str(path))
+        except OSError as err:
+            raise MetricsError("Could not write metrics to {}: {}".format(path, err)) from None
+        log.d("metrics written to {}", path)
+
+    def serve(self, port, address="127.0.0.1"):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.export().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        try:
+            self._server = Server((address, port), Handler)
+        except OSError as err:
+            raise MetricsError("Could not serve metrics on port {}: {}".format(port, err)) from None
+
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.d("serving metrics on http://{}:{}/metrics", address, port)
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
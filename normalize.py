@@ -10,7 +10,12 @@ also normlizing all files according to EBU R128 standard.
 By default it normalizes to -16dB however other options are available (including -23dB).
 
 FLAC files can be transcoded to AAC or ALAC through Qaac or MP3 through LAME.
+With --quality-profile fast FFmpeg can stand in for them, with settings of its
+own: of the encoders that meet the profile the one measured fastest on the host
+is used.
 A single FLAC file can also be transcoded to AC3 through just FFmpeg.
+A FLAC stream can be normalized from stdin or a fifo to stdout with --stream.
+"normalize.py scan <folder>" only measures a library and writes a loudness report.
 
 In a folder next to the script or somewhere in your PATH should be:
  - ffmpeg.exe
@@ -24,6 +29,11 @@ __version__ = "1.5"
 
 # library imports:
 import argparse
+import contextlib
+import socket
+import threading
+import time
+import zlib
 
 # local imports:
 import readchar
@@ -32,6 +42,31 @@ from ffmpeg import *
 from lame import *
 from qaac import *
 from database import *
+from lease import *
+from journal import *
+from profiler import Profiler, uninstrumented
+from metrics import *
+from rusage import ResourceReport
+from events import *
+from plan import *
+from streaming import *
+from scan import *
+from segments import *
+from splice import *
+from backends import *
+from loudness import BlockHistogram
+
+# commands given before the options, the default is to convert:
+COMMANDS = ["scan"]
+
+# what a failed job of every encoder raises and its last lines of stderr:
+ENCODER_ERRORS = {"qaac": ("Qaac", QaacProcessError, lambda: conf.qaac.qaac_stderr),
+                  "lame": ("LAME", LAMEProcessError, lambda: conf.lame.lame_stderr),
+                  "ffmpeg": ("FFmpeg", FFmpegProcessError, lambda: conf.ffmpeg.full_stderr)}
+
+# sources shorter than this (in seconds) are encoded --batch at a time when
+# ffmpeg encodes their format, longer ones gain nothing from sharing a process:
+BATCH_SECONDS = 600
 
 
 def parse_args():
@@ -68,18 +103,121 @@ def parse_args():
                                                  " - from 0 to 9 where 0 = lowest, 9 = highest [default])",
                                                  "(not implemented)"))
 
+    parser.add_argument("--quality-profile", default="best", choices=sorted(QUALITY_PROFILES),
+                        help="{}\n{}\n{}".format("encoders a format may be made with, the fastest one is used",
+                                                 " - best: qaac and lame, ffmpeg only for ac3 [default]",
+                                                 " - fast: also ffmpeg's encoders, for hosts without qaac or lame"))
+    parser.add_argument("--calibrate", action="store_true",
+                        help="{}\n{}".format("measure the speed of the encoders again",
+                                             " - otherwise it is kept in the calibration file"))
+    parser.add_argument("--calibration-file", default=str(CALIBRATION_FILE), metavar="file",
+                        help="{}\n{}".format("json file the speeds of the encoders are kept in, per host",
+                                             " - [default: {}]".format(CALIBRATION_FILE)))
+
     parser.add_argument("--volume", default=-16, type=int, metavar="vol", choices=conf.volume_choices,
                         help="{}\n{}\n{}".format("set value to which to normalize",
                                                  " - -23 is by standard",
                                                  " - -19 or -16 [default] are slightly louder"))
 
+    parser.add_argument("--album", action="store_true",
+                        help="{}\n{}".format("apply one gain to all files based on their joint loudness",
+                                             " - computed from the gating blocks stored in volumes.db"))
+
     parser.add_argument("--no-db", action="store_true",
                         help="don't create a volumes.db file")
 
+    parser.add_argument("--ffmpeg", metavar="exe",
+                        help="path to ffmpeg [default: searched next to the script and in PATH]")
+    parser.add_argument("--qaac", metavar="exe",
+                        help="path to qaac [default: searched next to the script and in PATH]")
+    parser.add_argument("--lame", metavar="exe",
+                        help="path to lame [default: searched next to the script and in PATH]")
+
+    parser.add_argument("--batch", default=1, type=int, metavar="n",
+                        help="{}\n{}".format("analyze up to n files, and encode up to n files shorter than {} "
+                                             "minutes to ffmpeg's formats, with one ffmpeg process "
+                                             "[default: 1]".format(BATCH_SECONDS // 60),
+                                             " - saves the process startup on libraries of short files"))
+
+    parser.add_argument("--segments", default=os.cpu_count() or 1, type=int, metavar="n",
+                        help="{}\n{}".format("analyze files longer than {} minutes in up to n parallel segments".format(
+                                                 2 * SEGMENT_MIN // 60), "[default: number of cpus]"))
+    parser.add_argument("--encode-segments", default=1, type=int, metavar="n",
+                        help="{}\n{}".format("encode aac and mp3 files longer than {} minutes in up to n parallel "
+                                             "parts".format(2 * PART_MIN // 60),
+                                             " - the parts are joined gaplessly [default: 1, off]"))
+    parser.add_argument("--fsync", default="file", choices=FSYNC_POLICIES,
+                        help="{}\n{}\n{}\n{}".format("how hard to flush outputs to disk before they appear",
+                                                     " - none: rename only",
+                                                     " - file: flush each output before renaming it [default]",
+                                                     " - dir: also flush the folder after renaming"))
+
+    parser.add_argument("--cooperative", action="store_true",
+                        help="{}\n{}".format("share the work with other normalize processes on any host",
+                                             " - jobs are claimed through lease files next to volumes.db"))
+    parser.add_argument("--lease-ttl", default=300, type=int, metavar="sec",
+                        help="seconds after which a lease of a crashed worker is reclaimed [default: 300]")
+
+    parser.add_argument("--profile", nargs="?", const="normalize-trace.json", metavar="trace",
+                        help="{}\n{}".format("time every stage of every file and print a summary",
+                                             " - also writes a Chrome trace [default: normalize-trace.json]"))
+
+    parser.add_argument("--rusage", action="store_true",
+                        help="{}\n{}".format("report cpu time, peak memory and i/o of every ffmpeg, qaac and lame",
+                                             " - per file and per format, files over 10x the median cpu are flagged"))
+
+    parser.add_argument("--stderr-log", metavar="folder",
+                        help="{}\n{}".format("write everything the encoders print to one log file per job",
+                                             " - otherwise only the last {} lines are kept in memory".format(STDERR_TAIL)))
+
+    parser.add_argument("--log-file", metavar="file",
+                        help="{}\n{}".format("also write the log, with debug messages, to this file",
+                                             " - rotated at 10 MB, records are written from one thread"))
+
+    parser.add_argument("--events", choices=EVENT_FORMATS,
+                        help="{}\n{}".format("write one machine readable event per state change of a job",
+                                             " - jsonl: one json object per line, without colors"))
+    parser.add_argument("--events-file", default="-", metavar="file",
+                        help="file or fifo the events are written to [default: - for stdout]")
+
+    parser.add_argument("--metrics-file", metavar="file",
+                        help="write Prometheus metrics to this textfile at the end of the run")
+    parser.add_argument("--metrics-port", type=int, metavar="port",
+                        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics during the run")
+
+    parser.add_argument("--verify", action="store_true",
+                        help="{}\n{}".format("measure the loudness of every output on its way to the encoder",
+                                             " and flag outputs that are off by more than the tolerance"))
+    parser.add_argument("--verify-sample", default=0.05, type=float, metavar="fraction",
+                        help="with --verify also decode and analyze this fraction of outputs [default: 0.05]")
+    parser.add_argument("--verify-tolerance", default=1.0, type=float, metavar="lu",
+                        help="LU an output may be away from its target with --verify [default: 1.0]")
+
+    parser.add_argument("--stream", choices=sorted(STREAM_FORMATS), metavar="format",
+                        help="{}\n{}\n{}".format("read a FLAC stream and write it normalized to stdout",
+                                                 " - input is - for stdin, a fifo or a file",
+                                                 " - aac as raw adts, alac as fragmented mp4 or mp3"))
+
+    scan = parser.add_argument_group("scan", "normalize.py scan [options] <folder>: measure without encoding")
+    scan.add_argument("-j", "--workers", type=int, metavar="n",
+                      help="files hashed and analyzed at the same time [default: number of cpus]")
+    scan.add_argument("--report", default="-", metavar="file",
+                      help="write the loudness of every file into this report [default: stdout]")
+    scan.add_argument("--report-format", choices=REPORT_FORMATS,
+                      help="format of the report [default: csv for .csv files, json otherwise]")
+
     parser.add_argument("input", metavar="<input file or folder>")
 
+    # the command is a word in front of everything else:
+    argv = sys.argv[1:]
+    command = None
+    if argv and argv[0] in COMMANDS:
+        command, argv = argv[0], argv[1:]
+
     try:
-        return parser.parse_args()
+        args = parser.parse_args(argv)
+        args.command = command
+        return args
     except SystemExit:
         if ('-h' or '--help') not in sys.argv:
             print("Press any key to quit...", end='', file=sys.stderr, flush=True)
@@ -88,11 +226,17 @@ def parse_args():
 
 
 def init_config(args):
-    conf.input = pathlib.Path(args.input).absolute()
+    conf.stream = args.stream
+    conf.command = args.command
+
+    if conf.stream and args.input == "-":
+        conf.input = pathlib.Path(args.input)
+    else:
+        conf.input = pathlib.Path(args.input).absolute()
 
-    # check if the input exists:
-    if not pathlib.Path.exists(conf.input):
-        print_and_exit("{} does not exist!".format(conf.input), 1)
+        # check if the input exists:
+        if not pathlib.Path.exists(conf.input):
+            print_and_exit("{} does not exist!".format(conf.input), 1)
 
     # create string rapresentation:
     conf.input_str = str(conf.input)
@@ -106,7 +250,11 @@ def init_config(args):
     conf.mp3 = args.mp3
     conf.ac3 = args.ac3
     conf.quality = args.quality
+    conf.quality_profile = args.quality_profile
+    conf.calibrate = args.calibrate
+    conf.calibration_file = pathlib.Path(args.calibration_file).expanduser()
     conf.volume = args.volume
+    conf.album = args.album
 
     # set some defaults:
     if conf.itunes:
@@ -126,16 +274,63 @@ def init_config(args):
     conf.dry_run = args.dry_run
     conf.no_db = args.no_db
 
+    # binaries given on the commandline are not searched for:
+    conf.ffmpeg_path = pathlib.Path(args.ffmpeg).absolute() if args.ffmpeg else None
+    conf.qaac_path = pathlib.Path(args.qaac).absolute() if args.qaac else None
+    conf.lame_path = pathlib.Path(args.lame).absolute() if args.lame else None
+    conf.batch = max(args.batch, 1)
+    conf.segments = max(args.segments, 1)
+    conf.encode_segments = max(args.encode_segments, 1)
+    conf.fsync = args.fsync
+    conf.cooperative = args.cooperative
+    conf.lease_ttl = args.lease_ttl
+
+    conf.profile = args.profile
+    Profiler().enabled = bool(conf.profile)
+
+    conf.rusage = args.rusage
+    ResourceReport().enabled = conf.rusage
+
+    conf.stderr_log = args.stderr_log
+    if conf.stderr_log:
+        pathlib.Path(conf.stderr_log).mkdir(parents=True, exist_ok=True)
+
+    conf.log_file = args.log_file
+
+    conf.events = args.events
+    conf.events_file = args.events_file
+
+    # nothing but the encoded stream may go to stdout:
+    if conf.stream and conf.events and conf.events_file == "-":
+        print_and_exit("Events can't be written to stdout while streaming, use --events-file.", 1)
+
+    conf.metrics_file = args.metrics_file
+    conf.metrics_port = args.metrics_port
+    Registry().enabled = bool(conf.metrics_file or conf.metrics_port)
+
+    conf.verify = args.verify
+    conf.verify_sample = min(max(args.verify_sample, 0.0), 1.0)
+    conf.verify_tolerance = abs(args.verify_tolerance)
+    conf.flagged = []
+
+    conf.workers = max(args.workers, 1) if args.workers else None
+    conf.report = args.report
+    conf.report_format = args.report_format or ("csv" if conf.report.lower().endswith(".csv") else "json")
+
+    # the report goes to stdout by default:
+    if conf.command == "scan" and conf.report == "-" and conf.events and conf.events_file == "-":
+        print_and_exit("Events can't be written to stdout with the report, use --events-file or --report.", 1)
+
     conf.verbose = args.verbose or args.debug
     conf.debug = args.debug
 
-    log.d("parsed commandline arguments: {}".format(conf))
+    log.d("parsed commandline arguments: {}", conf)
 
 
 def init_ffmpeg():
     # test ffmpeg:
     try:
-        conf.ffmpeg = FFmpeg(debug=conf.debug)
+        conf.ffmpeg = FFmpeg(path=conf.ffmpeg_path, debug=conf.debug)
 
         # check if this ffmpeg has the required libraries compiled in:
         conf.ffmpeg.requrements = "libmp3lame"
@@ -152,11 +347,14 @@ def init_ffmpeg():
     except FFmpegMissingLib as err:
         log_and_exit("FFmpeg at {} doesn't have the required library: {}".format(conf.ffmpeg.path, err), 1)
 
+    except ValueError as err:
+        log_and_exit(err, 1)
+
 
 def init_lame():
     # qaac is not required so it can fail detection:
     try:
-        conf.lame = LAME(debug=conf.debug)
+        conf.lame = LAME(ff_path=pathlib.Path(conf.ffmpeg.path), lame_path=conf.lame_path, debug=conf.debug)
 
     except LAMENotFoundError:
         log.w("LAME binary could not be found.\nMake sure it's in your path.")
@@ -164,11 +362,14 @@ def init_lame():
     except (LAMETestFailedError, LAMEProcessError):
         log.w("Error while trying to run LAME.")
 
+    except ValueError as err:
+        log.w(err)
+
 
 def init_qaac():
     # qaac is not required so it can fail detection:
     try:
-        conf.qaac = Qaac(debug=conf.debug)
+        conf.qaac = Qaac(ff_path=pathlib.Path(conf.ffmpeg.path), qaac_path=conf.qaac_path, debug=conf.debug)
 
     except QaacNotFoundError:
         log.w("Qaac binary could not be found. Make sure it's in your path.")
@@ -176,51 +377,652 @@ def init_qaac():
     except (QaacTestFailedError, QaacProcessError):
         log.w("Error while trying to run Qaac.")
 
+    except ValueError as err:
+        log.w(err)
+
 
 def calc_volume(lufs):
-    log.d("lufs: {}, calculating to: {}".format(lufs, conf.volume))
+    log.d("lufs: {}, calculating to: {}", lufs, conf.volume)
     return round(conf.volume - lufs, 1)
 
 
-def init_db(conversion_list):
+def open_db():
     # try to create/open the volumes database:
     if not conf.db:
-        conf.db = Database(conf.database_path, in_memory=(conf.dry_run or conf.no_db))
+        # other workers write to the same database in cooperative mode:
+        lock = conf.leases.lock(conf.database_path.name) if conf.leases else None
+        conf.db = Database(conf.database_path, in_memory=(conf.dry_run or conf.no_db), lock=lock)
+
+
+def job_id(output_file):
+    # the same key identifies a job in leases and events:
+    return output_file.relative_to(conf.database_path.parent).as_posix()
+
+
+def hash_file(input_file):
+    input_file_md5 = conf.db.md5sum(input_file)
+    EventStream().emit("hashed", input=str(input_file), md5=input_file_md5)
+    return input_file_md5
+
+
+def store_analysis(input_file, input_file_md5, lufs, peak, histogram):
+    volume = calc_volume(lufs)
+    conf.db.set_entry(input_file_md5, {"gain": volume,
+                                       "lufs": lufs,
+                                       "peak": peak,
+                                       "hist": histogram.encode()}, replace=True)
+
+    EventStream().emit("analyzed", input=str(input_file), md5=input_file_md5, lufs=lufs, peak=peak, gain=volume)
+    return volume
+
+
+def analyze(input_file, input_file_md5):
+    log.d("Analyzing volume of {}", input_file.name)
+
+    # long files are decoded in parallel pieces:
+    duration = flac_duration(input_file)
+    if conf.segments > 1 and duration and duration >= 2 * SEGMENT_MIN:
+        with batch_display("analysis", len(plan_segments(duration, conf.segments))) as display:
+            done = None
+            if hasattr(display, "advance"):
+                def done(segment):
+                    display.advance(segment.length or duration - segment.start)
+
+            lufs, peak, blocks = analyze_segmented(input_file, duration, ffmpeg_path=pathlib.Path(conf.ffmpeg.path),
+                                                   workers=conf.segments, done=done)
+        return store_analysis(input_file, input_file_md5, lufs, peak, BlockHistogram.of(blocks))
+
+    lufs, peak = conf.ffmpeg.analyze_volume(input_file)
+    return store_analysis(input_file, input_file_md5, lufs, peak, conf.ffmpeg.histogram)
+
+
+def analyze_batches(missing):
+    # short files are analyzed conf.batch at a time by one ffmpeg:
+    for start in range(0, len(missing), conf.batch):
+        batch = missing[start:start + conf.batch]
+
+        try:
+            results = conf.ffmpeg.analyze_batch([input_file for input_file, _ in batch])
+        except FFmpegProcessError as err:
+            # one broken file fails the whole process, the single ones tell which:
+            log.w("Analyzing {} files at once failed: {}. Analyzing them one by one...", len(batch), err)
+            for input_file, input_file_md5 in batch:
+                analyze(input_file, input_file_md5)
+            continue
+
+        for (input_file, input_file_md5), (lufs, peak, histogram) in zip(batch, results):
+            store_analysis(input_file, input_file_md5, lufs, peak, histogram)
+
+
+def count_lookup(hit):
+    # once per source, where it is found in the database or analyzed:
+    if Registry().enabled:
+        Registry().lookup(hit=hit)
+
+
+def init_db(inputs):
+    # returns the md5 of every input:
+    open_db()
+
+    md5s = {}
+    missing = []
+    for input_file in inputs:
+        input_file_md5 = md5s[input_file] = hash_file(input_file)
+        record = conf.db.get_record(input_file_md5)
+
+        # album mode needs the histograms older databases don't have:
+        cached = record is not None and not (conf.album and "hist" not in record)
+        count_lookup(cached)
+        if not cached:
+            missing.append((input_file, input_file_md5))
+
+    if conf.batch > 1 and len(missing) > 1:
+        analyze_batches(missing)
+    else:
+        for input_file, input_file_md5 in missing:
+            analyze(input_file, input_file_md5)
+    log.d("database: {}", conf.db)
+    return md5s
+
+
+def init_album(inputs):
+    # the album gain covers all input files, not only the ones still to
+    # convert; returns it with the loudness of every input:
+    md5s = init_db(inputs)
+
+    lufs = conf.db.integrated_loudness(list(md5s.values()))
+    album_gain = calc_volume(lufs)
+    log.i("Album loudness is {} LUFS, applying {} dB to all files.", lufs, album_gain)
+    return album_gain, {file: (conf.db.get_record(md5) or {}).get("lufs") for file, md5 in md5s.items()}
+
+
+def get_volume(input_file):
+    # returns the gain with the loudness of input_file it was computed from:
+    input_file_md5 = hash_file(input_file)
+    volume = conf.db.get_entry(input_file_md5)
+
+    # in cooperative mode sources are looked up here instead of in init_db:
+    if conf.leases:
+        if volume is None:
+            # another worker may have analyzed it in the meantime:
+            conf.db.refresh()
+            volume = conf.db.get_entry(input_file_md5)
+
+        count_lookup(volume is not None)
+        if volume is None:
+            volume = analyze(input_file, input_file_md5)
+
+    return volume, (conf.db.get_record(input_file_md5) or {}).get("lufs")
+
+
+def output_pending(output_file):
+    if not output_file.exists():
+        return True
+
+    if conf.journal and not conf.journal.intact(output_file):
+        log.w("{} changed since it was written. Converting again...", output_file)
+        return True
+
+    # an output that is still leased may be a partial file of a worker
+    # that is either still busy or has crashed:
+    if conf.leases:
+        return conf.leases.leased(job_id(output_file))
+
+    return False
+
+
+def convert_file(job, convert, encoder, error, stderr):
+    with Profiler().span("job", file=job.source.name, output=job.output.name):
+        encode_file(job, convert, encoder, error, stderr)
+
+
+def stderr_tail(err, stderr, lines=20):
+    # the encoders attach the last lines of all their processes to errors:
+    tail = getattr(err, "stderr_tail", None) or stderr().splitlines()
+    return tail[-lines:]
+
+
+def verify_sampled(output_file):
+    # the same outputs are decoded again on every run:
+    return zlib.crc32(job_id(output_file).encode("utf-8")) / 0xffffffff < conf.verify_sample
+
+
+def verify_output(job, measured):
+    # what the output should measure, the gain applied to its source:
+    if job.lufs is not None:
+        expected = round(job.lufs + job.gain, 1)
+    else:
+        expected = conf.volume
+
+    checks = {}
+    if measured:
+        checks["meter"] = measured[0]
+
+    # the meter sees the audio before the encoder, a decoded output also
+    # shows what the encoder did to it; without a meter reading the output
+    # is always decoded:
+    if not measured or verify_sampled(job.output):
+        try:
+            checks["decoded"] = conf.ffmpeg.analyze_volume(job.output)[0]
+        except FFmpegProcessError as err:
+            log.w("Could not analyze {}: {}", job.output, err)
+
+    if not checks:
+        log.w("No loudness was measured for {}.", job.output)
+        return
+
+    off = {name: round(lufs - expected, 1) for name, lufs in checks.items()}
+    ok = all(abs(lu) <= conf.verify_tolerance for lu in off.values())
+
+    EventStream().emit("verified", job=job_id(job.output), expected=expected, ok=ok, **checks)
+
+    if ok:
+        log.d("{} verified at {} (expected {} LUFS)", job.output.name, checks, expected)
+    else:
+        conf.flagged.append(job.output)
+        log.w("{} is off its target of {} LUFS by {} LU.", job.output, expected,
+              ", ".join("{:+} ({})".format(lu, name) for name, lu in off.items()))
+
+
+def select_backends():
+    # every format is made by the fastest encoder within the quality profile:
+    encoders = {"ffmpeg": conf.ffmpeg, "qaac": conf.qaac, "lame": conf.lame}
+    calibration = None if conf.dry_run else Calibration(conf.calibration_file or CALIBRATION_FILE)
+
+    conf.backends = {}
+    for name in FORMATS:
+        if not getattr(conf, name):
+            continue
+
+        backend = select_backend(name, encoders, conf.quality_profile, calibration, recalibrate=conf.calibrate)
+        if backend:
+            log.d("encoding {} with {}", name, backend[0])
+            conf.backends[name] = backend
+            if conf.encode_segments > 1 and name in SPLICE_FORMATS and backend[0] == "ffmpeg":
+                log.w("{} is encoded by ffmpeg, which can't encode in parts: ignoring --encode-segments for it.",
+                      name)
+            continue
+
+        log.w("No available encoder makes {} within the {} quality profile.", name, conf.quality_profile)
+        if candidates(name, encoders, "fast"):
+            log.w("With --quality-profile fast ffmpeg's encoder would be used.")
+        setattr(conf, name, False)
+
+
+def run_format(name, jobs):
+    encoder_name, method = conf.backends[name]
+    label, error, stderr = ENCODER_ERRORS[encoder_name]
+    run_conversions(name, jobs, getattr(getattr(conf, encoder_name), method), label, error, stderr)
+
+
+def splice_plan(job):
+    # long files are encoded in parallel parts with --encode-segments, by
+    # qaac or lame:
+    if conf.encode_segments < 2 or conf.backends[job.format][0] == "ffmpeg":
+        return None
+    return parts_of(job.source, job.format, conf.encode_segments)
+
+
+def encode_parts(job, output_file, split):
+    rate, parts = split
+
+    # every part is encoded by an encoder of its own:
+    def encoder():
+        if job.format == "aac":
+            return Qaac(ff_path=pathlib.Path(conf.ffmpeg.path), qaac_path=conf.qaac.qaac_path, debug=conf.debug)
+        return LAME(ff_path=pathlib.Path(conf.ffmpeg.path), lame_path=conf.lame.lame_path, debug=conf.debug)
+
+    # the bars of the parts (and of the remux into an m4a) join the batch
+    # that is shown as jobs of their own:
+    if Reporter().batch:
+        Reporter().batch.add_jobs(len(parts) if job.format == "aac" else len(parts) - 1)
+
+    # the parts are not jobs of their own, nor is their overlap audio of
+    # the job: the job is accounted once, with the duration of its source:
+    stage = "convert_to_{}".format(job.format)
+    component = "Qaac" if job.format == "aac" else "LAME"
+    duration = flac_duration(job.source) or 0
+    start = time.perf_counter()
+    try:
+        with Profiler().span(stage, file=job.source.name):
+            with uninstrumented():
+                encode_spliced(job.source, output_file, job.format, rate, parts, encoder, volume=job.gain,
+                               ffmpeg_path=pathlib.Path(conf.ffmpeg.path))
+            Profiler().audio(duration)
+    except Exception:
+        if Registry().enabled:
+            Registry().failure(stage, component)
+        raise
+
+    if Registry().enabled:
+        Registry().stage(stage, component, time.perf_counter() - start, audio=duration)
+
+
+def encode_file(job, convert, encoder, error, stderr):
+    events = EventStream()
+    key = job_id(job.output)
+
+    if job.gain is None:
+        job = job.with_gain(*get_volume(job.source))
+
+    events.emit("encode_started", job=key, format=job.format, encoder=encoder, input=str(job.source),
+                output=str(job.output), gain=job.gain)
+    events.start_job(key)
+    log.start_job(key)
+    start = time.perf_counter()
+    split = splice_plan(job)
+
+    # encode to a temporary file that only replaces the output once complete,
+    # the journal lets a restarted batch clean up after an interruption:
+    try:
+        with atomic_output(job.output, fsync=conf.fsync) as temp_file:
+            conf.journal.start(job.output, temp_file)
+            if split:
+                encode_parts(job, temp_file, split)
+            else:
+                convert(job.source, temp_file, volume=job.gain)
+    except (error, SpliceError, FFmpegProcessError) as err:
+        tail = stderr_tail(err, stderr)
+        events.emit("failed", job=key, format=job.format, error=str(err), stderr=tail)
+        if tail:
+            log.e("last lines of stderr:\n{}", "\n".join(tail))
+        log_and_exit("{} error: {}".format(encoder, err), 1)
+    except BaseException as err:
+        # interrupted or crashed, the job still ends in the event stream:
+        events.emit("failed", job=key, format=job.format, error=str(err) or type(err).__name__,
+                    stderr=stderr_tail(err, stderr))
+        raise
+    finally:
+        events.end_job()
+        log.end_job()
+
+    conf.journal.done(job.output)
+
+    try:
+        if conf.verify:
+            # the parts of a spliced output are not metered:
+            verify_output(job, None if split else convert.__self__.output_loudness)
+
+        if events.enabled:
+            seconds = time.perf_counter() - start
+            audio = Profiler().last_audio()
+            events.emit("finished", job=key, format=job.format, output=str(job.output),
+                        size=job.output.stat().st_size, seconds=round(seconds, 3), audio=audio,
+                        speed=round(audio / seconds, 1) if seconds else None)
+    except BaseException as err:
+        events.emit("failed", job=key, format=job.format, error=str(err) or type(err).__name__, stderr=[])
+        raise
+
+    log.d("last lines of {} stderr: {}", encoder, stderr())
+
+
+def batchable(job, convert):
+    # short sources encoded by ffmpeg can share its process with --batch:
+    if conf.batch < 2 or not isinstance(getattr(convert, "__self__", None), FFmpeg):
+        return False
+    duration = flac_duration(job.source)
+    return duration is not None and duration < BATCH_SECONDS
+
+
+def encode_batch(jobs, convert, encoder, error, stderr):
+    # like encode_file for jobs that share one ffmpeg process, every output
+    # still gets its own temporary file, journal entry, events and check:
+    events = EventStream()
+    jobs = [job if job.gain is not None else job.with_gain(*get_volume(job.source)) for job in jobs]
+    keys = [job_id(job.output) for job in jobs]
+    stage = "convert_to_{}".format(jobs[0].format)
+
+    for job, key in zip(jobs, keys):
+        events.emit("encode_started", job=key, format=job.format, encoder=encoder, input=str(job.source),
+                    output=str(job.output), gain=job.gain)
 
-    for input_file, _ in conversion_list:
-        input_file_md5 = conf.db.md5sum(input_file)
+    # the whole batch shows as a single bar:
+    if Reporter().batch:
+        Reporter().batch.add_jobs(1 - len(jobs))
+    start = time.perf_counter()
 
-        if not conf.db.get_entry(input_file_md5):
-            log.d("Analyzing volume of {}".format(input_file.name))
-            lufs, _ = conf.ffmpeg.analyze_volume(input_file)
+    try:
+        with contextlib.ExitStack() as outputs:
+            temp_files = []
+            for job in jobs:
+                temp_file = outputs.enter_context(atomic_output(job.output, fsync=conf.fsync))
+                conf.journal.start(job.output, temp_file)
+                temp_files.append(temp_file)
+
+            conf.ffmpeg.convert_batch([(job.source, temp_file, job.gain)
+                                       for job, temp_file in zip(jobs, temp_files)], jobs[0].format)
+    except FFmpegProcessError as err:
+        # one broken file fails the whole process, the single ones tell which:
+        log.w("Converting {} files at once failed: {}. Converting them one by one...", len(jobs), err)
+        if Reporter().batch:
+            Reporter().batch.add_jobs(len(jobs) - 1)
+        for job in jobs:
+            convert_file(job, convert, encoder, error, stderr)
+        return
+    except BaseException as err:
+        for job, key in zip(jobs, keys):
+            events.emit("failed", job=key, format=job.format, error=str(err) or type(err).__name__,
+                        stderr=stderr_tail(err, stderr))
+        raise
+
+    seconds = time.perf_counter() - start
+    for job, key in zip(jobs, keys):
+        conf.journal.done(job.output)
+        audio = flac_duration(job.source) or 0
+
+        # every output is counted like one encoded on its own:
+        if Registry().enabled:
+            Registry().stage(stage, encoder, seconds / len(jobs), audio=audio)
+
+        try:
+            if conf.verify:
+                # the outputs of a batch are not metered:
+                verify_output(job, None)
+
+            if events.enabled:
+                events.emit("finished", job=key, format=job.format, output=str(job.output),
+                            size=job.output.stat().st_size, seconds=round(seconds, 3), audio=audio,
+                            speed=round(audio * len(jobs) / seconds, 1) if seconds else None)
+        except BaseException as err:
+            events.emit("failed", job=key, format=job.format, error=str(err) or type(err).__name__, stderr=[])
+            raise
+
+    log.d("last lines of {} stderr: {}", encoder, stderr())
+
+
+def convert_batches(jobs, convert, encoder, error, stderr):
+    # short files go --batch at a time through one ffmpeg, the rest one by one:
+    batched, single = [], []
+    for job in jobs:
+        (batched if batchable(job, convert) else single).append(job)
+
+    for start in range(0, len(batched), conf.batch):
+        batch = batched[start:start + conf.batch]
+        if len(batch) > 1:
+            encode_batch(batch, convert, encoder, error, stderr)
+        else:
+            single.insert(0, batch[0])
+
+    for job in single:
+        convert_file(job, convert, encoder, error, stderr)
+
+
+def convert_cooperatively(jobs, convert, encoder, error, stderr):
+    # every worker walks the same list, leases make sure that each job
+    # is done once and jobs of crashed workers are picked up again:
+    pending = list(jobs)
+
+    while pending:
+        for job in list(pending):
+            key = job_id(job.output)
+
+            stale = conf.leases.claim(key)
+            if stale is None:
+                continue
+
+            try:
+                if job.output.exists() and not stale:
+                    log.i("{} was done by another worker. Skipping...", job.output)
+                else:
+                    convert_file(job, convert, encoder, error, stderr)
+            finally:
+                conf.leases.release(key)
+
+            pending.remove(job)
+
+        if pending:
+            log.d("waiting for {} jobs leased by other workers", len(pending))
+            time.sleep(conf.lease_poll)
+
+
+def run_conversions(name, jobs, convert, encoder, error, stderr):
+    print_stderr("Converting to {}...".format(name))
+
+    if len(jobs) == 0:
+        print_stderr("Nothing to do!")
+        return
+
+    # jobs that already have their gain don't need an analysis:
+    if conf.leases or all(job.gain is not None for job in jobs):
+        open_db()
+    else:
+        init_db([job.source for job in jobs])
+
+    # create the output folder if needed:
+    if not conf.input_is_file and not conf.dry_run:
+        pathlib.Path(conf.input / name).mkdir(exist_ok=True)
+
+    if conf.dry_run:
+        for job in jobs:
+            log.i("Would convert {} to {}.", job.source, job.output)
+
+    elif conf.leases:
+        with batch_display(name, len(jobs)):
+            convert_cooperatively(jobs, convert, encoder, error, stderr)
+
+    else:
+        with batch_display(name, len(jobs)):
+            convert_batches(jobs, convert, encoder, error, stderr)
+
+
+def plan_conversions(inputs):
+    # the selected formats of every input file, without the existing outputs:
+    formats = [name for name in FORMATS if getattr(conf, name)]
+    return plan(inputs, conf.input, formats, output_pending, single=conf.input_is_file)
+
+
+def run_stream():
+    encoder_name = STREAM_FORMATS[conf.stream][0]
+    if encoder_name == "qaac":
+        init_qaac()
+    elif encoder_name == "lame":
+        init_lame()
+    encoder = getattr(conf, encoder_name)
+
+    if not encoder:
+        log_and_exit("No encoder for {} streams is available.".format(conf.stream), 1)
+
+    if conf.input_str == "-":
+        source = sys.stdin.buffer
+        name = pathlib.Path("stdin")
+    else:
+        source = open(conf.input_str, mode='rb')
+        name = pathlib.Path(conf.input.name)
+
+    try:
+        lufs, peak, gain = normalize_stream(conf.ffmpeg, encoder, conf.stream, source, conf.volume, name)
+    except (StreamError, FFmpegProcessError, QaacProcessError, LAMEProcessError) as err:
+        log_and_exit("Streaming {} failed: {}".format(name, err), 1)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+    log.i("Streamed {} at {} LUFS with {} dB gain.", name, lufs, gain)
+
+
+def run_scan():
+    if conf.input_is_file:
+        folder = conf.input.parent
+        sources = [conf.input]
+    else:
+        folder = conf.input
+        sources = find_sources(folder)
+
+    if len(sources) == 0:
+        log_and_exit("No FLAC files found in {}!".format(conf.input.name), 1)
+
+    conf.database_path = folder / "volumes.db"
+    open_db()
+
+    log.i("Scanning {} files...", len(sources))
+
+    counts = {"cached": 0, "analyzed": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    with batch_display("scan", len(sources)) as display:
+        advance = getattr(display, "advance", None)
+
+        def done(result):
+            with counts_lock:
+                counts["failed" if result.error else "cached" if result.cached else "analyzed"] += 1
+            if advance:
+                advance(result.duration or 0.0)
+
+        scanner = Scanner(conf.db, conf.volume, ffmpeg_path=pathlib.Path(conf.ffmpeg.path), workers=conf.workers,
+                          done=done)
+        try:
+            if conf.report == "-":
+                write_report(scanner.run(sources), sys.stdout, folder, conf.report_format)
+            else:
+                with open(conf.report, mode='w', encoding="utf-8", newline="") as f:
+                    write_report(scanner.run(sources), f, folder, conf.report_format)
+        except (OSError, DatabaseError) as err:
+            log_and_exit("Scanning failed: {}".format(err), 1)
 
-            conf.db.set_entry(input_file_md5, calc_volume(lufs))
-    log.d("database: {}".format(conf.db))
+    log.i("Scanned {} files: {} analyzed, {} from the database, {} failed.",
+          len(sources), counts["analyzed"], counts["cached"], counts["failed"])
+
+    if counts["failed"]:
+        raise SystemExit(1)
+
+
+def init_logging():
+    if conf.log_file:
+        try:
+            log.aggregate(conf.log_file)
+        except OSError as err:
+            log_and_exit("Could not open log file {}: {}".format(conf.log_file, err), 1)
+
+
+def init_events():
+    if conf.events:
+        try:
+            EventStream().open(conf.events_file)
+        except EventsError as err:
+            log_and_exit(err, 1)
+
+
+def init_metrics():
+    if conf.metrics_port:
+        try:
+            Registry().serve(conf.metrics_port)
+        except MetricsError as err:
+            log_and_exit(err, 1)
+        log.i("Serving metrics on http://127.0.0.1:{}/metrics", conf.metrics_port)
 
 
 def main(args):
     init_config(args)
 
+    init_logging()
+
+    init_events()
+
+    init_metrics()
+
     init_ffmpeg()
 
+    if conf.stream:
+        try:
+            run_stream()
+        finally:
+            EventStream().close()
+        return
+
+    if conf.command == "scan":
+        try:
+            run_scan()
+        finally:
+            if conf.profile:
+                Profiler().report(conf.profile)
+
+            if conf.metrics_file:
+                try:
+                    Registry().write(conf.metrics_file)
+                except MetricsError as err:
+                    log.e(err)
+            Registry().shutdown()
+
+            EventStream().close()
+        return
+
     if conf.itunes or conf.aac or conf.alac:
         init_qaac()
 
     if conf.mp3:
         init_lame()
 
-    # disable aac and alac encoding if qaac is not present:
-    if not conf.qaac:
-        conf.aac = False
-        conf.alac = False
-
-    # disable mp3 encoding if lame is not present:
-    if not conf.lame:
-        conf.mp3 = False
+    # formats without an encoder are disabled:
+    select_backends()
 
     if not conf.aac and not conf.alac and not conf.mp3 and not conf.ac3:
         log_and_exit("No available encoder has been selected.")
 
+    # the encoders measure the audio they are given with --verify:
+    for encoder in (conf.ffmpeg, conf.qaac, conf.lame):
+        if encoder:
+            encoder.meter_output = conf.verify
+
     # create a list of all input flac files:
     if conf.input_is_file:
         if not conf.input.name.endswith(".flac"):
@@ -228,203 +1030,91 @@ def main(args):
 
         log.i("Processing one file...")
 
-        conf.input_list.append(conf.input)
+        inputs = [conf.input]
 
     else:
         if conf.ac3:
             log_and_exit("Only files are supported for ac3 encoding!", 1)
 
-        conf.input_list = [file for file in conf.input.glob("*.flac")]
+        inputs = [file for file in conf.input.glob("*.flac")]
 
-        if len(conf.input_list) == 0:
+        if len(inputs) == 0:
             log_and_exit("No FLAC files found in {}!".format(conf.input.name), 1)
 
-        log.i("Processing {} files...".format(len(conf.input_list)))
-
-    # loop over all input files and create (input, output) combinations
-    # while filtering out existing files:
-    for file in conf.input_list:
-        if conf.input_is_file:
-            # create a list that contains only one file
-            # this is to prevent the creation of a new folder
-            aac_output_filename = file.parent / "{}_aac.m4a".format(file.stem)
-            if not aac_output_filename.exists():
-                conf.aac_conversion_list.append((file, aac_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(aac_output_filename))
-
-            alac_output_filename = file.parent / "{}_alac.m4a".format(file.stem)
-            if not alac_output_filename.exists():
-                conf.alac_conversion_list.append((file, alac_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(alac_output_filename))
-
-            mp3_output_filename = file.parent / "{}.mp3".format(file.stem)
-            if not mp3_output_filename.exists():
-                conf.mp3_conversion_list.append((file, mp3_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(mp3_output_filename))
-
-            ac3_output_filename = file.parent / "{}.ac3".format(file.stem)
-            if not ac3_output_filename.exists():
-                conf.ac3_conversion_list.append((file, ac3_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(ac3_output_filename))
-
-        else:
-            aac_output_filename = conf.input / "aac" / "{}.m4a".format(file.stem)
-            if not aac_output_filename.exists():
-                conf.aac_conversion_list.append((file, aac_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(aac_output_filename))
-
-            alac_output_filename = conf.input / "alac" / "{}.m4a".format(file.stem)
-            if not alac_output_filename.exists():
-                conf.alac_conversion_list.append((file, alac_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(alac_output_filename))
-
-            mp3_output_filename = conf.input / "mp3" / "{}.mp3".format(file.stem)
-            if not mp3_output_filename.exists():
-                conf.mp3_conversion_list.append((file, mp3_output_filename))
-            else:
-                log.i("{} alredy exists. Skipping...".format(mp3_output_filename))
+        log.i("Processing {} files...", len(inputs))
 
     # setup database path:
     if conf.input_is_file:
         conf.database_path = conf.input.parent / "volumes.db"
     else:
         conf.database_path = conf.input / "volumes.db"
-    log.d("database path: {}".format(conf.database_path))
-
-    if conf.aac:
-        print_stderr("Converting to aac...")
-        if len(conf.aac_conversion_list) > 0:
-            init_db(conf.aac_conversion_list)
-
-            # create the output folder if needed:
-            if not conf.input_is_file:
-                if not pathlib.Path(conf.input / "aac").is_dir():
-                    if not conf.dry_run:
-                        pathlib.Path.mkdir(conf.input / "aac")
-
-            for input_file, output_file in conf.aac_conversion_list:
-                if not conf.dry_run:
-                    volume = conf.db.get_entry(conf.db.md5sum(input_file))
-
-                    try:
-                        conf.qaac.convert_to_aac(input_file, output_file, volume=volume)
-                    except QaacProcessError as err:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-
-                        log_and_exit("Qaac error: {}".format(err), 1)
-                    except KeyboardInterrupt:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-                        raise
-
-                    log.d("full qaac stderr: {}".format(conf.qaac.qaac_stderr))
-                else:
-                    log.i("Would convert {} to {}.".format(input_file, output_file))
-        else:
-            print_stderr("Nothing to do!")
-
-    if conf.alac:
-        print_stderr("Converting to alac...")
-        if len(conf.alac_conversion_list) > 0:
-            init_db(conf.alac_conversion_list)
-
-            if not conf.input_is_file:
-                if not pathlib.Path(conf.input / "alac").is_dir():
-                    if not conf.dry_run:
-                        pathlib.Path.mkdir(conf.input / "alac")
-
-            for input_file, output_file in conf.alac_conversion_list:
-                if not conf.dry_run:
-                    volume = conf.db.get_entry(conf.db.md5sum(input_file))
-                    try:
-                        conf.qaac.convert_to_alac(input_file, output_file, volume=volume)
-                    except QaacProcessError as err:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-
-                        log_and_exit("Qaac error: {}".format(err), 1)
-                    except KeyboardInterrupt:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-                        raise
-
-                    log.d("full qaac stderr: {}".format(conf.qaac.qaac_stderr))
-                else:
-                    log.i("Would convert {} to {}.".format(input_file, output_file))
+    log.d("database path: {}", conf.database_path)
+
+    if conf.cooperative and not conf.dry_run:
+        try:
+            conf.leases = LeaseManager(conf.database_path.parent, ttl=conf.lease_ttl)
+        except LeaseError as err:
+            log_and_exit(err, 1)
+        log.i("Cooperating with other workers as {}.", conf.leases.owner)
+
+    if not conf.dry_run:
+        # each host keeps its own journal when sharing a library:
+        if conf.cooperative:
+            journal_name = ".normalize.{}.journal".format(socket.gethostname())
         else:
-            print_stderr("Nothing to do!")
+            journal_name = ".normalize.journal"
 
-    if conf.mp3:
-        print_stderr("Converting to mp3...")
-        if len(conf.mp3_conversion_list) > 0:
-            init_db(conf.mp3_conversion_list)
-
-            if not conf.input_is_file:
-                if not pathlib.Path(conf.input / "mp3").is_dir():
-                    if not conf.dry_run:
-                        pathlib.Path.mkdir(conf.input / "mp3")
-
-            for input_file, output_file in conf.mp3_conversion_list:
-                if not conf.dry_run:
-                    volume = conf.db.get_entry(conf.db.md5sum(input_file))
-                    try:
-                        conf.lame.convert_to_mp3(input_file, output_file, volume=volume)
-                    except KeyboardInterrupt:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-                        raise
-
-                    log.d("full lame stderr: {}".format(conf.lame.lame_stderr))
-                else:
-                    log.i("Would convert {} to {}.".format(input_file, output_file))
-        else:
-            print_stderr("Nothing to do!")
+        try:
+            conf.journal = Journal(conf.database_path.parent / journal_name, conf.database_path.parent,
+                                   fsync=(conf.fsync != "none"))
+            conf.journal.cleanup()
+        except JournalError as err:
+            log_and_exit(err, 1)
 
-    if conf.ac3:
-        print_stderr("Converting to ac3...")
-        if len(conf.ac3_conversion_list) > 0:
-            init_db(conf.ac3_conversion_list)
-
-            # for future:
-            if not conf.input_is_file:
-                if not pathlib.Path(conf.input / "ac3").is_dir():
-                    if not conf.dry_run:
-                        pathlib.Path.mkdir(conf.input / "ac3")
-
-            for input_file, output_file in conf.ac3_conversion_list:
-                if not conf.dry_run:
-                    volume = conf.db.get_entry(conf.db.md5sum(input_file))
-                    try:
-                        conf.ffmpeg.convert_to_ac3(input_file, output_file, volume=volume)
-                    except KeyboardInterrupt:
-                        try:
-                            os.remove(str(output_file))
-                        except PermissionError:
-                            pass
-                        raise
-
-                    log.d("full stderr: {}".format(conf.ffmpeg.full_stderr))
-                else:
-                    log.i("Would convert {} to {}.".format(input_file, output_file))
-        else:
-            print_stderr("Nothing to do!")
+    jobs = plan_conversions(inputs)
+
+    for format_jobs in jobs.values():
+        for job in format_jobs:
+            EventStream().emit("queued", job=job_id(job.output), format=job.format, input=str(job.source),
+                               output=str(job.output))
+
+    try:
+        if conf.album and any(jobs.values()):
+            album_gain, loudness = init_album(inputs)
+            jobs = {name: [job.with_gain(album_gain, loudness.get(job.source)) for job in format_jobs]
+                    for name, format_jobs in jobs.items()}
+
+        for name in FORMATS:
+            if getattr(conf, name):
+                run_format(name, jobs[name])
+
+        if conf.flagged:
+            log.w("{} outputs are more than {} LU off their target:\n{}", len(conf.flagged), conf.verify_tolerance,
+                  "\n".join(str(output) for output in conf.flagged))
+
+        if conf.journal:
+            conf.journal.finish()
+    finally:
+        if conf.journal:
+            conf.journal.close()
+
+        if conf.profile:
+            Profiler().report(conf.profile)
+
+        if conf.rusage:
+            ResourceReport().report()
+
+        if conf.metrics_file:
+            try:
+                Registry().write(conf.metrics_file)
+            except MetricsError as err:
+                log.e(err)
+        Registry().shutdown()
+
+        if conf.leases:
+            conf.leases.close()
+
+        EventStream().close()
 
 
 if __name__ == "__main__":
@@ -444,7 +1134,7 @@ if __name__ == "__main__":
         conf.log_level = "ERROR"
     log.level = conf.log_level
 
-    log.d("all arguments: {}".format(arguments))
+    log.d("all arguments: {}", arguments)
 
     try:
         main(arguments)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["Job", "plan", "FORMATS"]
+
+import logger
+log = logger.Logger(__name__)
+
+# output formats, in the order they are converted:
+FORMATS = ("aac", "alac", "mp3", "ac3")
+
+# where the output of an input file goes, next to a single input file
+# or into a subfolder of the input folder:
+SINGLE_OUTPUTS = {"aac": "{}_aac.m4a", "alac": "{}_alac.m4a", "mp3": "{}.mp3", "ac3": "{}.ac3"}
+FOLDER_OUTPUTS = {"aac": "aac/{}.m4a", "alac": "alac/{}.m4a", "mp3": "mp3/{}.mp3", "ac3": "ac3/{}.ac3"}
+
+
+class Job:
+    """One conversion: source file, output file, format and gain.
+
+    Jobs are immutable and small, so they can be handed to other threads
+    or pickled to worker processes as they are. The gain is None until
+    it is known, with_gain() returns a copy that has it and, if known,
+    the loudness of the source in LUFS it was computed from.
+    """
+    __slots__ = ("source", "output", "format", "gain", "lufs")
+
+    def __init__(self, source, output, format, gain=None, lufs=None):
+        object.__setattr__(self, "source", source)
+        object.__setattr__(self, "output", output)
+        object.__setattr__(self, "format", format)
+        object.__setattr__(self, "gain", gain)
+        object.__setattr__(self, "lufs", lufs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Job is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Job is immutable")
+
+    def __reduce__(self):
+        return Job, self._fields()
+
+    def _fields(self):
+        return self.source, self.output, self.format, self.gain, self.lufs
+
+    def with_gain(self, gain, lufs=None):
+        return Job(self.source, self.output, self.format, gain, lufs)
+
+    def __eq__(self, other):
+        if not isinstance(other, Job):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return "Job(source={!r}, output={!r}, format={!r}, gain={!r}, lufs={!r})".format(*self._fields())
+
+
+def plan(inputs, folder, formats, pending, single=False):
+    """Plan the conversions of inputs into formats.
+
+    Args:
+        inputs: flac files
+        folder: the input folder, outputs go into one subfolder per format
+        formats: names out of FORMATS
+        pending: called with an output file, False if it needs no conversion
+        single: inputs is one file whose outputs go next to it
+
+    Returns:
+        a dict with a list of jobs for every format
+    """
+    jobs = {name: [] for name in formats}
+
+    for file in inputs:
+        for name in formats:
+            if single:
+                output = file.parent / SINGLE_OUTPUTS[name].format(file.stem)
+            else:
+                output = folder / FOLDER_OUTPUTS[name].format(file.stem)
+
+            if pending(output):
+                jobs[name].append(Job(file, output, name))
+            else:
+                log.i("{} alredy exists. Skipping...", output)
+
+    return jobs
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["Profiler", "timed", "uninstrumented"]
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local, current_thread, get_ident
+import json
+import os
+import sys
+import time
+import pathlib
+
+from config import Singleton
+from metrics import Registry
+from rusage import ResourceReport
+from events import EventStream
+
+
+class _Span:
+    __slots__ = ("name", "start", "end", "tid", "args")
+
+    def __init__(self, name, tid, args):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.tid = tid
+        self.args = args
+
+
+class _NullSpan:
+    # returned when profiling is off so that "with" costs next to nothing:
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _SpanContext:
+    def __init__(self, profiler, name, args):
+        self._profiler = profiler
+        self._name = name
+        self._args = args
+        self._span = None
+
+    def __enter__(self):
+        self._span = self._profiler._open(self._name, self._args)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._span.args["error"] = exc_type.__name__
+        self._profiler._close(self._span)
+        return False
+
+
+class Profiler(metaclass=Singleton):
+    """Records timing spans of every stage of every file.
+
+    Spans nest per thread, so each worker shows up as its own track in
+    the exported Chrome trace (chrome://tracing or ui.perfetto.dev).
+    Disabled by default; span() then returns a shared no-op object.
+    """
+    _null = _NullSpan()
+
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._lock = Lock()
+        self._local = local()
+        self._threads = {}
+        self._origin = time.perf_counter()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return self._null
+        return _SpanContext(self, name, args)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _open(self, name, args):
+        tid = get_ident()
+        if tid not in self._threads:
+            with self._lock:
+                self._threads[tid] = (len(self._threads) + 1, current_thread().name)
+
+        span = _Span(name, tid, args)
+        self._stack().append(span)
+        return span
+
+    def _close(self, span):
+        span.end = time.perf_counter()
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+
+        with self._lock:
+            self._spans.append(span)
+
+    def audio(self, seconds):
+        """Attach the audio duration to the open spans of this thread."""
+        self._local.audio = seconds
+
+        if self.enabled:
+            for span in self._stack():
+                span.args.setdefault("audio", seconds)
+
+    def last_audio(self):
+        """Audio duration most recently reported by this thread."""
+        return getattr(self._local, "audio", 0)
+
+    def stages(self):
+        """{stage: (count, seconds, audio seconds)} of all finished spans."""
+        stages = {}
+        with self._lock:
+            spans = list(self._spans)
+
+        for span in spans:
+            count, seconds, audio = stages.get(span.name, (0, 0.0, 0.0))
+            stages[span.name] = (count + 1, seconds + span.end - span.start, audio + span.args.get("audio", 0))
+        return stages
+
+    def summary(self):
+        wall = time.perf_counter() - self._origin
+        lines = ["{:<24} {:>6} {:>10} {:>10} {:>8} {:>10}".format("stage", "count", "total s", "mean ms",
+                                                                   "% wall", "audio x")]
+
+        for name, (count, seconds, audio) in sorted(self.stages().items(), key=lambda stage: -stage[1][1]):
+            lines.append("{:<24} {:>6} {:>10.3f} {:>10.1f} {:>7.1f}% {:>10}".format(
+                name, count, seconds, seconds / count * 1000, seconds / wall * 100,
+                "{:.1f}".format(audio / seconds) if audio and seconds else "-"))
+
+        encoded = sum(audio for name, (_, _, audio) in self.stages().items() if name.startswith("convert_to_"))
+        lines.append("wall time {:.3f} s, {:.1f} audio-seconds encoded per wall-second".format(
+            wall, encoded / wall if wall else 0))
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """Write the spans in Chrome trace-event format."""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            threads = dict(self._threads)
+
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "normalize"}}]
+        for tid, (number, name) in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": number, "args": {"name": name}})
+
+        for span in spans:
+            events.append({"name": span.name,
+                           "ph": "X",
+                           "pid": pid,
+                           "tid": threads[span.tid][0],
+                           "ts": round((span.start - self._origin) * 1e6, 1),
+                           "dur": round((span.end - span.start) * 1e6, 1),
+                           "args": {key: str(value) for key, value in span.args.items()}})
+
+        with open(str(path), mode='w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def report(self, trace_path=None, stream=sys.stderr):
+        print(self.summary(), file=stream, flush=True)
+        if trace_path:
+            self.write_trace(trace_path)
+            print("trace written to {}".format(trace_path), file=stream, flush=True)
+
+
+def timed(name):
+    """Decorator recording a span around every call when profiling is on.
+
+    The name of the first path among the arguments is kept with the span.
+    When metrics are on the call's duration and failures are counted for
+    the stage and the class the method belongs to.
+    """
+    def decorator(func):
+        component = func.__qualname__.split(".")[0]
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = Profiler()
+            registry = Registry()
+            if not profiler.enabled and not registry.enabled:
+                return func(*args, **kwargs)
+
+            files = [arg for arg in args if isinstance(arg, pathlib.PurePath)]
+            start = time.perf_counter()
+            try:
+                with profiler.span(name, **({"file": files[0].name} if files else {})):
+                    result = func(*args, **kwargs)
+            except Exception:
+                if registry.enabled:
+                    registry.failure(name, component)
+                raise
+
+            if registry.enabled:
+                registry.stage(name, component, time.perf_counter() - start, audio=profiler.last_audio())
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def uninstrumented():
+    """Switch the profiler, the resource report, the metrics and the event
+    stream off for work that isn't a job of its own, and back on after it."""
+    instruments = (Profiler(), ResourceReport(), Registry(), EventStream())
+    enabled = [instrument.enabled for instrument in instruments]
+    for instrument in instruments:
+        instrument.enabled = False
+    try:
+        yield
+    finally:
+        for instrument, was_enabled in zip(instruments, enabled):
+            instrument.enabled = was_enabled
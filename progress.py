@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["Reporter", "BatchDisplay", "REFRESH_RATE"]
+
+from threading import Thread, Lock, current_thread
+import datetime
+import sys
+import time
+
+import colorama
+
+from config import Singleton
+from progressbar import ProgressBar, Percentage, Bar, Widget
+
+# redraws per second, at most:
+REFRESH_RATE = 10
+
+
+class Reporter(metaclass=Singleton):
+    """Redraws all registered displays from one thread, REFRESH_RATE times a second.
+
+    Hot loops only store their position in a display; formatting and
+    writing to the terminal happen here, so a slow terminal can't hold
+    back hashing or parsing. A display needs a draw() method, which is
+    never called concurrently with add() or remove() for it.
+    """
+    def __init__(self, rate=REFRESH_RATE):
+        self.interval = 1 / rate
+        # the BatchDisplay progress bars join while one is shown:
+        self.batch = None
+        self._displays = []
+        self._lock = Lock()
+        self._thread = None
+
+    def add(self, display):
+        with self._lock:
+            self._displays.append(display)
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="progress")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, display):
+        # once this returns the display is not being drawn anymore:
+        with self._lock:
+            try:
+                self._displays.remove(display)
+            except ValueError:
+                pass
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            with self._lock:
+                for display in self._displays:
+                    display.draw()
+
+
+class _Text(Widget):
+    # a widget showing whatever text the display put into it:
+    def __init__(self):
+        self.text = ""
+
+    def update(self, pbar):
+        return self.text
+
+
+def _format_time(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class BatchDisplay:
+    """One line per active worker plus a total line for a batch of jobs.
+
+    Progress bars created while the display is shown (see HashProgressBar)
+    become worker lines instead of drawing themselves. Bars of audio jobs
+    count towards the total, which is weighted by audio duration; jobs that
+    have not started yet are assumed to last as long as the average one so
+    far. The ETA divides the audio left by the audio processed per second
+    of the batch, so it covers all workers together.
+
+    Used as a context manager around the jobs of a batch; it redraws from
+    the Reporter thread, erasing and rewriting its lines on a terminal and
+    only printing the total line otherwise.
+    """
+    def __init__(self, title, jobs, stream=sys.stderr):
+        self._jobs = jobs
+        self._stream = stream
+
+        isatty = getattr(stream, "isatty", None)
+        self._ansi = bool(isatty and isatty())
+
+        self._lock = Lock()
+        self._workers = {}
+        self._done = 0
+        self._done_audio = 0.0
+        self._drawn = None
+        self._start = None
+
+        self._total_text = _Text()
+        self._total = self._formatter(title, 1000, self._total_text)
+
+    def _formatter(self, label, maxval, text):
+        bar = ProgressBar(maxval=maxval, fd=self._stream,
+                          widgets=["{:<24.24} ".format(label), Bar('#'), ' ', Percentage(), ' ', text])
+        # a line filling the last column would wrap on some terminals,
+        # pseudo terminals may also report no width at all:
+        bar.term_width = bar.term_width - 1 if bar.term_width > 20 else bar._env_size()
+        bar.start_time = time.time()
+        return bar
+
+    def __enter__(self):
+        self._start = time.time()
+        Reporter().batch = self
+        Reporter().add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Reporter().remove(self)
+        Reporter().batch = None
+        self.draw(final=True)
+        return False
+
+    def start(self, bar, label, audio):
+        """Show bar as the line of the current worker."""
+        text = _Text()
+        with self._lock:
+            self._workers[current_thread().name] = (bar, self._formatter(label, max(bar.maxval, 1), text), text,
+                                                    audio, time.time())
+
+    def finish(self, bar):
+        with self._lock:
+            for worker, line in list(self._workers.items()):
+                if line[0] is bar:
+                    del self._workers[worker]
+                    if line[3]:
+                        self._done += 1
+                        self._done_audio += bar.maxval
+
+    def add_jobs(self, jobs):
+        """Expect jobs more, like the parts a job is split into."""
+        with self._lock:
+            self._jobs += jobs
+
+    def advance(self, audio=0.0):
+        """Count a job that finished without an audio line, like one that was cached."""
+        with self._lock:
+            self._done += 1
+            self._done_audio += audio
+
+    def _totals(self):
+        # audio processed and audio expected in total, in seconds:
+        active = [(min(bar.value, bar.maxval), bar.maxval) for bar, _, _, audio, _ in self._workers.values() if audio]
+        processed = self._done_audio + sum(position for position, _ in active)
+
+        known = self._done_audio + sum(duration for _, duration in active)
+        started = self._done + len(active)
+        average = known / started if started else 0
+        expected = known + max(self._jobs - started, 0) * average
+        return processed, expected
+
+    def _lines(self, now):
+        lines = []
+        for bar, formatter, text, audio, start in self._workers.values():
+            formatter.currval = min(bar.value, formatter.maxval)
+            elapsed = now - start
+            text.text = "{:.1f}x".format(bar.value / elapsed) if audio and elapsed > 0 else ""
+            lines.append(formatter._format_line())
+
+        processed, expected = self._totals()
+        elapsed = now - self._start
+        throughput = processed / elapsed if elapsed > 0 else 0
+
+        self._total.currval = int(processed / expected * 1000) if expected else 0
+        self._total_text.text = "{}/{} {:.1f}x ETA {}".format(
+            self._done, self._jobs, throughput,
+            _format_time((expected - processed) / throughput) if throughput else "--:--:--")
+        lines.append(self._total._format_line())
+        return lines
+
+    def draw(self, final=False):
+        with self._lock:
+            lines = self._lines(time.time())
+
+        if self._ansi:
+            # erase the previous block and leave the cursor at its top, so
+            # that log lines printed in between get drawn over next time:
+            output = colorama.ansi.clear_screen(0) + "\n".join(lines) + "\n"
+            if not final:
+                output += colorama.Cursor.UP(len(lines))
+        else:
+            # one total line, only when it changed:
+            if lines[-1] == self._drawn and not final:
+                return
+            self._drawn = lines[-1]
+            output = lines[-1] + ("\n" if final else "\r")
+
+        self._stream.write(output)
+        self._stream.flush()
+
+
+if __name__ == "__main__":
+    # three workers encoding ten fake tracks of random length:
+    import random
+    from queue import Queue, Empty
+
+    class _Bar:
+        def __init__(self, maxval):
+            self.maxval = maxval
+            self.value = 0
+
+    tracks = Queue()
+    for number in range(10):
+        tracks.put(("track{:02d}.flac".format(number), random.randint(20, 60)))
+
+    def worker(display):
+        while True:
+            try:
+                name, duration = tracks.get_nowait()
+            except Empty:
+                return
+            bar = _Bar(duration)
+            display.start(bar, name, audio=True)
+            for position in range(duration + 1):
+                bar.value = position
+                time.sleep(0.01)
+            display.finish(bar)
+
+    with BatchDisplay("demo", tracks.qsize()) as demo:
+        workers = [Thread(target=worker, args=(demo,), name="worker{}".format(number)) for number in range(3)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
@@ -3,8 +3,6 @@
 __all__ = ["Qaac", "QaacNotFoundError", "QaacProcessError", "QaacTestFailedError"]
 
 from subprocess import Popen, PIPE, TimeoutExpired
-from functools import partial
-from collections import deque
 from threading import Thread, Event
 from queue import Queue, Empty
 import sys
@@ -26,7 +24,10 @@ if conf.log_level:
 else:
     log.level = "DEBUG"
 
-from utils import locate_bin, HashProgressBar
+from utils import locate_bin, HashProgressBar, StderrCapture, StderrLines, stderr_log_path
+from profiler import Profiler, timed
+from rusage import AccountedPopen, ResourceReport
+from events import EventStream
 
 
 class QaacException(Exception):
@@ -46,7 +47,13 @@ class QaacTestFailedError(QaacException):
 
 
 class QaacProcess:
-    def __init__(self, ff_path, qaac_path, ff_args=[], qaac_args=[], test=False, store_stderr=False):
+    """ffmpeg piping into qaac, with ffmpeg's stderr read line by line.
+
+    popen starts both processes, it takes the arguments of subprocess.Popen
+    and can be replaced by anything that returns an object like it.
+    """
+    def __init__(self, ff_path, qaac_path, ff_args=[], qaac_args=[], test=False, capture=None, stdin=None,
+                 popen=AccountedPopen):
         if ff_args and not isinstance(ff_args, list):
             raise ValueError("you must provide a list for args")
 
@@ -58,17 +65,19 @@ class QaacProcess:
         self._ff_args = ff_args
         self._qaac_args = qaac_args
         self._test = test
-        self._keep_stderr = store_stderr
+        self._capture = capture or StderrCapture()
+        self._stdin = stdin
+        self._popen = popen
+        self._drain = None
 
         self._ff_cmd = []
         self._qaac_cmd = []
         self._ff_proc = None
         self._qaac_proc = None
+        self._lines = None
         self._ff_returncode = None
         self._qaac_returncode = None
         self._interrupted = False
-        self._ff_stderr = deque()
-        self._qaac_stderr = None
 
     @property
     def ff_args(self):
@@ -96,10 +105,14 @@ class QaacProcess:
                 log.d("starting qaac test subprocess")
                 self._qaac_proc = Popen([self._qaac_path, "--check"], stderr=PIPE, bufsize=0)
             else:
-                log.d("starting ffmpeg subprocess: {}".format(self._ff_cmd))
-                log.d("starting qaac subprocess: {}".format(self._qaac_cmd))
-                self._ff_proc = Popen(self._ff_cmd, stderr=PIPE, stdout=PIPE, bufsize=0)
-                self._qaac_proc = Popen(self._qaac_cmd, stdin=self._ff_proc.stdout, stderr=PIPE, bufsize=0)
+                log.d("starting ffmpeg subprocess: {}", self._ff_cmd)
+                log.d("starting qaac subprocess: {}", self._qaac_cmd)
+                self._ff_proc = self._popen(self._ff_cmd, stdin=self._stdin, stderr=PIPE, stdout=PIPE, bufsize=0)
+                self._qaac_proc = self._popen(self._qaac_cmd, stdin=self._ff_proc.stdout, stderr=PIPE, bufsize=0)
+                self._lines = StderrLines(self._ff_proc.stderr)
+
+                # qaac's stderr is read all along so a full pipe never blocks it:
+                self._drain = self._capture.start_drain(self._qaac_proc.stderr, "qaac")
 
         except FileNotFoundError as err:
             raise QaacNotFoundError(err) from None
@@ -140,7 +153,7 @@ class QaacProcess:
             try:
                 log.d("terminating qaac process")
                 self._qaac_proc.terminate()
-                self._qaac_proc.communicate(timeout=5)
+                self._qaac_proc.wait(timeout=5)
             except TimeoutExpired:
                 log.d("killing qaac process")
                 self._qaac_proc.kill()
@@ -161,44 +174,31 @@ class QaacProcess:
         self._ff_returncode = self._ff_proc.poll()
         self._qaac_returncode = self._qaac_proc.poll()
 
-        # give qaac a chance to terminate cleanly:
-        if self._keep_stderr:
-            # and get stderr:
-            self._qaac_stderr = self._qaac_proc.communicate(timeout=5)[1]
-        self._qaac_proc.communicate(timeout=5)
+        # give qaac a chance to terminate cleanly and write its last lines:
+        self._qaac_proc.wait(timeout=5)
+        if self._drain:
+            self._drain.join(timeout=5)
         raise StopIteration
 
     def __next__(self):
-        buffer = deque()
-        for err_char in iter(partial(self._ff_proc.stderr.read, 1), b''):
-            try:
-                if self._qaac_proc.poll() is not None:
-                    # caught when exiting generator:
-                    raise QaacProcessError("unexpected termination")
-                    # noinspection PyUnreachableCode
-                    raise StopIteration
-
-                # replace any not decoded char with a space:
-                try:
-                    buffer.append(err_char.decode("utf-8"))
-                except UnicodeDecodeError:
-                    buffer.append(' ')
-
-                if '\r' in buffer:
-                    line = "".join(buffer).strip()
-                    buffer.clear()
-
-                    if self._keep_stderr:
-                        self._ff_stderr.append(line)
-
-                    return line
-
-            except KeyboardInterrupt:
-                self._interrupted = True
-                self._stop_iteration()
-        else:
+        try:
+            line = self._lines.readline()
+        except KeyboardInterrupt:
+            self._interrupted = True
             self._stop_iteration()
 
+        if line is None:
+            self._stop_iteration()
+
+        # lines are read ahead, so only an encoder gone while ffmpeg
+        # still decodes has terminated too early:
+        if self._qaac_proc.poll() is not None and self._ff_proc.poll() is None:
+            # caught when exiting generator:
+            raise QaacProcessError("unexpected termination")
+
+        self._capture.append(line, "ffmpeg")
+        return line
+
     @property
     def ffmpeg_returncode(self):
         return self._ff_returncode
@@ -209,11 +209,17 @@ class QaacProcess:
 
     @property
     def ff_stderr(self):
-        return self._ff_stderr
+        # only the last lines are kept:
+        return self._capture.tail("ffmpeg")
 
     @property
     def qaac_stderr(self):
-        return self._qaac_stderr.decode("utf-8")
+        return self._capture.text("qaac")
+
+    @property
+    def usage(self):
+        # resource usage of the children once they have been reaped:
+        return {"ffmpeg": self._ff_proc.usage, "qaac": self._qaac_proc.usage}
 
 
 class Qaac:
@@ -225,11 +231,18 @@ class Qaac:
         self._ff_args = []
         self._qaac_args = []
         self._duration = 0
-        self._ff_stderr = []
-        self._qaac_stderr = None
+        self._stderr = StderrCapture()
+        self._stdin = None
         self._qaac_supported_ver = "2.45"
         self._cat_supported_ver = "7.9.9.4"
 
+        self._job = (None, None)
+        self._usage = None
+
+        # measure the gained audio on its way to the encoder:
+        self.meter_output = False
+        self._meter = None
+
         self._progressbar = HashProgressBar()
 
         try:
@@ -258,7 +271,7 @@ class Qaac:
     def _test_bin(self):
         log.d("testing qaac binary")
 
-        qaac = QaacProcess(ff_path=None, qaac_path=self._qaac_path, test=True, store_stderr=True)
+        qaac = QaacProcess(ff_path=None, qaac_path=self._qaac_path, test=True)
         qaac = qaac.test()
 
         if qaac[1] == 0:
@@ -267,7 +280,7 @@ class Qaac:
             if ver_re:
                 ver_qaac = ver_re.group(1)
                 ver_cat = ver_re.group(2)
-                log.d("got qaac ver. {} and coreaudio ver. {}".format(ver_qaac, ver_cat))
+                log.d("got qaac ver. {} and coreaudio ver. {}", ver_qaac, ver_cat)
 
             if ver_qaac != self._qaac_supported_ver or ver_cat != self._cat_supported_ver:
                 log.w("Only Qaac version {} and "
@@ -283,17 +296,28 @@ class Qaac:
 
     @property
     def ffmpeg_stderr(self):
-        try:
-            return "\n".join(self._ff_stderr)
-        except TypeError:
-            return None
+        """Last lines ffmpeg wrote during the last job, see --stderr-log for all of them."""
+        return self._stderr.text("ffmpeg")
+
+    @property
+    def usage(self):
+        """Resource usage of the children of the last job, with --rusage."""
+        return self._usage
+
+    @property
+    def qaac_path(self):
+        """Path of the Qaac binary that is run."""
+        return self._qaac_path
+
+    @property
+    def output_loudness(self):
+        """(lufs, peak) of the audio the last conversion encoded, with meter_output."""
+        return self._meter.loudness if self._meter else None
 
     @property
     def qaac_stderr(self):
-        try:
-            return self._qaac_stderr
-        except TypeError:
-            return None
+        """Last lines qaac wrote during the last job."""
+        return self._stderr.text("qaac")
 
     @staticmethod
     def _check_file(file):
@@ -305,54 +329,71 @@ class Qaac:
         if file.stat().st_size == 0:
             raise QaacProcessError("{} is 0-byte file".format(file))
 
+    def _input(self, input_file, stdin):
+        # with stdin ffmpeg reads the input from that file descriptor
+        # and input_file only names the job:
+        self._stdin = stdin
+        if stdin is None:
+            self._check_file(input_file)
+            return str(input_file)
+        return "-"
+
+    def _check_output(self, output_file):
+        # "-" is written to stdout:
+        if str(output_file) != "-":
+            self._check_file(output_file)
+
     @staticmethod
-    def _start_qaac_process(queue, quit_event, ff_path, qaac_path, ff_args=[], qaac_args=[], store_stderr=False):
+    def _start_qaac_process(queue, quit_event, ff_path, qaac_path, ff_args=[], qaac_args=[], capture=None,
+                           stdin=None):
         # to be started as a thread!
         # noinspection PyBroadException
         try:
-            with QaacProcess(ff_path, qaac_path, ff_args, qaac_args, store_stderr=store_stderr) as qaac:
+            with QaacProcess(ff_path, qaac_path, ff_args, qaac_args, capture=capture, stdin=stdin) as qaac:
                 for line in qaac:
                     if line:
                         queue.put(line)
 
                     if quit_event.is_set():
                         break
-                if store_stderr:
-                    queue.put(("stderr", qaac.ff_stderr, qaac.qaac_stderr))
+            if ResourceReport().enabled:
+                queue.put(("rusage", qaac.usage))
         # catching all exceptions from the thread:
         except Exception:
             exc = sys.exc_info()
             queue.put((exc[0], exc[1]))
+        finally:
+            if capture:
+                capture.close()
 
     def _create_queue_event_thread(self):
         self._queue = Queue()
         self._quit_event = Event()
+        self._stderr = StderrCapture(stderr_log_path(self._job))
 
         # start thread that reads from stderr:
         self._thread = Thread(target=self._start_qaac_process, args=(self._queue, self._quit_event,
                                                                      self._ff_path, self._qaac_path,
                                                                      self._ff_args, self._qaac_args,
-                                                                     self._debug))
+                                                                     self._stderr, self._stdin))
         self._thread.daemon = True
         self._thread.start()
-        log.d("started thread: {}".format(self._thread.name))
+        log.d("started thread: {}", self._thread.name)
 
     def _thread_dead(self):
         return (not self._thread.is_alive()) and self._queue.empty()
 
     def _get_stderr_exception(self, data):
-        # a tuple is either an exception or full stderr
+        # a tuple is either an exception or resource usage
         if isinstance(data, tuple):
-            # get stderr info:
-            if data[0] == "stderr":
-                if self._debug:
-                    self._ff_stderr = data[1]
-                    self._qaac_stderr = data[2]
+            if data[0] == "rusage":
+                self._usage = data[1]
+                ResourceReport().add(self._job[0], self._job[1], self._usage)
             else:
                 # react to exception:
                 self._progressbar.finish()
-                log.d("raising exception {} from thread".format(data[0]))
-                raise data[0](data[1])
+                log.d("raising exception {} from thread", data[0])
+                raise self._stderr.attach(data[0](data[1]))
 
     def _quit_thread(self, exception=None):
         self._progressbar.finish()
@@ -361,17 +402,18 @@ class Qaac:
 
         # give thread a chance:
         if self._thread.is_alive():
-            log.d("thread {} is still alive".format(self._thread.name))
+            log.d("thread {} is still alive", self._thread.name)
             self._thread.join(timeout=5)
 
         # check again:
         if self._thread.is_alive():
-            log.d("thread {} is still alive, will not exit cleanly!".format(self._thread.name))
+            log.d("thread {} is still alive, will not exit cleanly!", self._thread.name)
 
         if exception:
-            raise exception
+            raise self._stderr.attach(exception)
 
-    def _get_duration(self):
+    @timed("_get_duration")
+    def _get_duration(self, start=None, length=None):
         log.d("getting file duration")
 
         duration = 0
@@ -404,94 +446,111 @@ class Qaac:
                         duration = hh * 60 * 60 + mm * 60 + ss
 
                 else:
-                    log.d("got duration: {}".format(duration))
-                    self._duration = duration
+                    log.d("got duration: {}", duration)
+                    self._duration = part_duration(duration, start, length)
+                    Profiler().audio(self._duration)
                     break
 
-    def _single_file_conversion(self):
+    def _single_file_conversion(self, start=None, length=None):
+        self._meter = Meter() if self.meter_output else None
         self._create_queue_event_thread()
 
-        self._get_duration()
+        self._get_duration(start, length)
 
-        self._progressbar.create(self._duration)
+        self._progressbar.create(self._duration, label=self._job[0], audio=True)
 
-        try:
-            while True:
-                if self._thread_dead():
-                    self._progressbar.finish()
-                    break
+        with Profiler().span("wait"):
+            try:
+                while True:
+                    if self._thread_dead():
+                        self._progressbar.finish()
+                        break
 
-                try:
-                    data = self._queue.get(timeout=0.1)
-                except Empty:
-                    continue
+                    try:
+                        data = self._queue.get(timeout=0.1)
+                    except Empty:
+                        continue
 
-                else:
-                    self._get_stderr_exception(data)
+                    else:
+                        self._get_stderr_exception(data)
 
-                    time_re = None
-                    try:
-                        time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
-                    except TypeError:
-                        pass
+                        if self._meter:
+                            self._meter.feed(data)
 
-                    if time_re:
-                        hh = int(time_re.group(1))
-                        mm = int(time_re.group(2))
-                        ss = int(time_re.group(3))
-                        ms = int(time_re.group(4))
+                        time_re = None
+                        try:
+                            time_re = re.search(r"^.*time=(\d\d):(\d\d):(\d\d).(\d\d)", data)
+                        except TypeError:
+                            pass
 
-                        if ms > 50:
-                            ss += 1  # round up
+                        if time_re:
+                            hh = int(time_re.group(1))
+                            mm = int(time_re.group(2))
+                            ss = int(time_re.group(3))
+                            ms = int(time_re.group(4))
 
-                        time = hh * 60 * 60 + mm * 60 + ss
+                            if ms > 50:
+                                ss += 1  # round up
 
-                        if time < self._duration:
-                            self._progressbar.update(time)
-                        else:
-                            self._progressbar.update(self._duration)
+                            time = hh * 60 * 60 + mm * 60 + ss
 
-                    if "Error" in data:
-                        self._quit_thread(QaacProcessError(data))
+                            if time < self._duration:
+                                self._progressbar.update(time)
+                            else:
+                                self._progressbar.update(self._duration)
+                            EventStream().progress(time, self._duration)
 
-            self._quit_thread()
+                        if "Error" in data:
+                            self._quit_thread(QaacProcessError(data))
 
-        except KeyboardInterrupt as exc:
-            self._quit_thread(exc)
+                self._quit_thread()
 
-    def convert_to_aac(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+            except KeyboardInterrupt as exc:
+                self._quit_thread(exc)
 
-        self._ff_args = ["-hide_banner",
-                         "-i", str(input_file),
-                         "-vn", "-filter:a",
-                         "volume={}dB".format(volume),
-                         "-f", "wav", "-y", "-"]
+    @timed("convert_to_aac")
+    def convert_to_aac(self, input_file, output_file, volume=0, stdin=None, start=None, length=None):
+        """Encode input_file, only length seconds of it from start on if given.
+
+        Outputs named "-" or *.aac are written as raw ADTS.
+        """
+        self._job = (input_file.name, "aac")
+
+        self._ff_args = ["-hide_banner"]
+        self._ff_args.extend(input_args(self._input(input_file, stdin), start, length))
+        self._ff_args.append("-vn")
+        self._ff_args.extend(audio_filter_args("volume={}dB".format(volume), self.meter_output))
+        self._ff_args.extend(["-f", "wav", "-y", "-"])
 
         self._qaac_args = ["--tvbr", "127", "--quality", "2",
                            "--native-resampler=bats,127",
                            "-", "-o", str(output_file)]
 
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
-        self._single_file_conversion()
+        # an m4a can't be written to stdout, raw adts can:
+        if str(output_file) == "-" or output_file.suffix == ".aac":
+            self._qaac_args.insert(0, "--adts")
+
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
+        self._single_file_conversion(start, length)
 
-        self._check_file(output_file)
+        self._check_output(output_file)
 
-    def convert_to_alac(self, input_file, output_file, volume=0):
-        self._check_file(input_file)
+    @timed("convert_to_alac")
+    def convert_to_alac(self, input_file, output_file, volume=0, stdin=None):
+        self._job = (input_file.name, "alac")
 
         self._ff_args = ["-hide_banner",
-                         "-i", str(input_file),
-                         "-vn", "-filter:a",
-                         "volume={}dB".format(volume),
-                         "-f", "wav", "-y", "-"]
+                         "-i", self._input(input_file, stdin),
+                         "-vn"]
+        self._ff_args.extend(audio_filter_args("volume={}dB".format(volume), self.meter_output))
+        self._ff_args.extend(["-f", "wav", "-y", "-"])
 
         self._qaac_args = ["--alac",
                            "--native-resampler=bats,127",
                            "--bits-per-sample", "24",
                            "-", "-o", str(output_file)]
 
-        log.i("Converting {} to {}...".format(input_file.name, output_file.name))
+        log.i("Converting {} to {}...", input_file.name, output_file.name)
         self._single_file_conversion()
 
-        self._check_file(output_file)
+        self._check_output(output_file)
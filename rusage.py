@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ["AccountedPopen", "ResourceUsage", "ResourceReport"]
+
+from subprocess import Popen
+from threading import Lock
+import os
+import statistics
+import sys
+
+from config import Singleton
+
+# wait4 and waitid only exist on posix, elsewhere children are not accounted:
+_ACCOUNTING = hasattr(os, "wait4") and hasattr(os, "waitid")
+
+
+class ResourceUsage:
+    """CPU time, peak memory and I/O of one finished child process."""
+    __slots__ = ("user", "sys", "maxrss", "read_bytes", "write_bytes")
+
+    def __init__(self, user=0.0, sys=0.0, maxrss=0, read_bytes=0, write_bytes=0):
+        self.user = user
+        self.sys = sys
+        self.maxrss = maxrss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @property
+    def cpu(self):
+        return self.user + self.sys
+
+    def __add__(self, other):
+        return ResourceUsage(self.user + other.user, self.sys + other.sys, max(self.maxrss, other.maxrss),
+                             self.read_bytes + other.read_bytes, self.write_bytes + other.write_bytes)
+
+    def __repr__(self):
+        return "ResourceUsage(user={:.2f}s, sys={:.2f}s, maxrss={}KiB, read={}B, write={}B)".format(
+            self.user, self.sys, self.maxrss // 1024, self.read_bytes, self.write_bytes)
+
+
+def _read_proc_io(pid):
+    # rchar/wchar count all reads and writes, pipes included:
+    counters = {}
+    try:
+        with open("/proc/{}/io".format(pid), mode='r') as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+class AccountedPopen(Popen):
+    """Popen that keeps the resource usage of the child once it is reaped.
+
+    The child is first waited for with WNOWAIT so its /proc/<pid>/io can
+    still be read, then reaped with wait4 which returns its rusage.
+    usage stays None where this is not supported (windows).
+    """
+    def __init__(self, *args, **kwargs):
+        self.usage = None
+        self._io = (0, 0)
+        super().__init__(*args, **kwargs)
+
+    def _accounted_wait(self, pid, flags):
+        if _ACCOUNTING:
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | (flags & os.WNOHANG)) is None:
+                return 0, 0
+            self._io = _read_proc_io(pid)
+
+            pid, status, rusage = os.wait4(pid, flags)
+            if pid:
+                # ru_maxrss is in KiB on linux but in bytes on macos:
+                scale = 1 if sys.platform == "darwin" else 1024
+                self.usage = ResourceUsage(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * scale, *self._io)
+            return pid, status
+
+        return os.waitpid(pid, flags)
+
+    if _ACCOUNTING:
+        def _try_wait(self, wait_flags):
+            try:
+                return self._accounted_wait(self.pid, wait_flags)
+            except ChildProcessError:
+                return self.pid, 0
+
+        def _internal_poll(self, _deadstate=None, **kwargs):
+            return super()._internal_poll(_deadstate=_deadstate, _waitpid=self._accounted_wait)
+
+
+class ResourceReport(metaclass=Singleton):
+    """Collects the usage of every child, per file and per format."""
+    def __init__(self):
+        self.enabled = False
+        self._jobs = []
+        self._lock = Lock()
+
+    def add(self, file, output_format, children):
+        """children is a {"ffmpeg": ResourceUsage, ...} dict of one job."""
+        children = {name: usage for name, usage in children.items() if usage is not None}
+        if self.enabled and children:
+            with self._lock:
+                self._jobs.append((file, output_format, children))
+
+    def per_format(self):
+        formats = {}
+        with self._lock:
+            jobs = list(self._jobs)
+
+        for _, output_format, children in jobs:
+            count, total = formats.get(output_format, (0, ResourceUsage()))
+            for usage in children.values():
+                total = total + usage
+            formats[output_format] = (count + 1, total)
+        return formats
+
+    def outliers(self, factor=10):
+        """Jobs that used more than factor times the median CPU of their format."""
+        with self._lock:
+            jobs = list(self._jobs)
+
+        medians = {}
+        for output_format in {job[1] for job in jobs}:
+            medians[output_format] = statistics.median(sum(usage.cpu for usage in job[2].values())
+                                                       for job in jobs if job[1] == output_format)
+
+        return [(file, output_format, sum(usage.cpu for usage in children.values()))
+                for file, output_format, children in jobs
+                if medians[output_format] and
+                sum(usage.cpu for usage in children.values()) > factor * medians[output_format]]
+
+    def report(self, stream=sys.stderr):
+        with self._lock:
+            jobs = list(self._jobs)
+
+        line = "{:<40} {:<9} {:<7} {:>8} {:>8} {:>9} {:>10} {:>10}"
+        print(line.format("file", "format", "child", "user s", "sys s", "rss MiB", "read MiB", "write MiB"),
+              file=stream)
+        for file, output_format, children in jobs:
+            for name, usage in sorted(children.items()):
+                print(line.format(str(file)[-40:], output_format, name,
+                                  "{:.2f}".format(usage.user), "{:.2f}".format(usage.sys),
+                                  "{:.1f}".format(usage.maxrss / 2 ** 20), "{:.1f}".format(usage.read_bytes / 2 ** 20),
+                                  "{:.1f}".format(usage.write_bytes / 2 ** 20)), file=stream)
+
+        for output_format, (count, total) in sorted(self.per_format().items()):
+            print("{}: {} jobs, {:.2f}s cpu ({:.2f}s per job), peak rss {:.1f} MiB".format(
+                output_format, count, total.cpu, total.cpu / count, total.maxrss / 2 ** 20), file=stream)
+
+        for file, output_format, cpu in self.outliers():
+            print("{} ({}) used {:.2f}s cpu, more than 10x the median".format(file, output_format, cpu),
+                  file=stream)
+        stream.flush()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure the loudness of a library without encoding anything.
+
+Every source is hashed and, unless the database has its loudness already,
+analyzed on a pool of worker threads; each thread has its own ffmpeg.
+Measurements go into the database like those of a normal run, which is
+written every few seconds instead of after every file. The results can
+be written as a JSON or CSV report with one row per source.
+"""
+
+__all__ = ["Scanner", "ScanResult", "find_sources", "write_report", "REPORT_FORMATS", "REPORT_FIELDS"]
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+import csv
+import json
+import os
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+from utils import flac_duration
+from ffmpeg import FFmpeg, FFmpegProcessError
+from database import Database
+from events import EventStream
+from metrics import Registry
+
+REPORT_FORMATS = ["json", "csv"]
+
+# columns of a report, in this order:
+REPORT_FIELDS = ["path", "lufs", "peak", "gain", "duration", "md5", "error"]
+
+
+def find_sources(folder):
+    """All flac files in folder and its subfolders, sorted and without hidden ones."""
+    sources = []
+    for parent, folders, files in os.walk(str(folder)):
+        folders[:] = sorted(name for name in folders if not name.startswith("."))
+        sources.extend(pathlib.Path(parent) / name for name in sorted(files)
+                       if name.lower().endswith(".flac") and not name.startswith("."))
+    return sources
+
+
+class ScanResult:
+    """Loudness of one source, or the error that kept it from being measured."""
+    __slots__ = ("source", "md5", "lufs", "peak", "gain", "duration", "cached", "error")
+
+    def __init__(self, source, duration=None):
+        self.source = source
+        self.md5 = None
+        self.lufs = None
+        self.peak = None
+        self.gain = None
+        self.duration = duration
+        self.cached = False
+        self.error = None
+
+    def row(self, folder):
+        """The report row, with the path relative to folder."""
+        try:
+            path = self.source.relative_to(folder).as_posix()
+        except ValueError:
+            path = str(self.source)
+        return {"path": path, "lufs": self.lufs, "peak": self.peak, "gain": self.gain, "duration": self.duration,
+                "md5": self.md5, "error": self.error}
+
+    def __repr__(self):
+        return "ScanResult(source={!r}, lufs={!r}, peak={!r}, gain={!r}, error={!r})".format(
+            self.source, self.lufs, self.peak, self.gain, self.error)
+
+
+class Scanner:
+    """Hash and analyze sources on worker threads, filling db.
+
+    target is the loudness the gains are calculated to. done is called
+    from the worker threads with every ScanResult as soon as it is known.
+    """
+    def __init__(self, db, target, ffmpeg_path=None, workers=None, done=None):
+        self.target = target
+        self.workers = workers or os.cpu_count() or 1
+        self._db = db
+        self._db_lock = Lock()
+        self._ffmpeg_path = ffmpeg_path
+        self._done = done
+        self._local = local()
+
+    def _ffmpeg(self):
+        # an FFmpeg keeps the state of the running job, so every worker
+        # thread has its own:
+        ffmpeg = getattr(self._local, "ffmpeg", None)
+        if ffmpeg is None:
+            ffmpeg = self._local.ffmpeg = FFmpeg(path=self._ffmpeg_path)
+        return ffmpeg
+
+    def _measure(self, result):
+        result.md5 = Database.md5sum(result.source)
+        EventStream().emit("hashed", input=str(result.source), md5=result.md5)
+
+        with self._db_lock:
+            record = self._db.get_record(result.md5)
+
+        # older entries only have a gain, the report needs the loudness:
+        cached = bool(record and "lufs" in record)
+        if Registry().enabled:
+            Registry().lookup(hit=cached)
+        if cached:
+            result.lufs = record["lufs"]
+            result.peak = record.get("peak")
+            result.gain = round(self.target - result.lufs, 1)
+            result.cached = True
+            return
+
+        ffmpeg = self._ffmpeg()
+        result.lufs, result.peak = ffmpeg.analyze_volume(result.source)
+        result.gain = round(self.target - result.lufs, 1)
+
+        with self._db_lock:
+            self._db.set_entry(result.md5, {"gain": result.gain,
+                                            "lufs": result.lufs,
+                                            "peak": result.peak,
+                                            "hist": ffmpeg.histogram.encode()}, replace=True)
+
+        EventStream().emit("analyzed", input=str(result.source), md5=result.md5, lufs=result.lufs,
+                           peak=result.peak, gain=result.gain)
+
+    def _scan(self, source):
+        result = ScanResult(source, duration=flac_duration(source))
+        try:
+            self._measure(result)
+        except (OSError, FFmpegProcessError) as err:
+            log.e("Scanning {} failed: {}", source, err)
+            result.error = str(err) or type(err).__name__
+
+        if self._done:
+            self._done(result)
+        return result
+
+    def run(self, sources):
+        """Scan sources, yield their ScanResults in the same order."""
+        with self._db.deferred(), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result in executor.map(self._scan, sources):
+                yield result
+
+
+def write_report(results, file, folder, report_format="json"):
+    """Write the rows of results into the text file file as they come.
+
+    Paths are relative to folder; a JSON report is a list of objects,
+    a CSV report has a header line with REPORT_FIELDS.
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError("report_format must be one of: {}".format(", ".join(REPORT_FORMATS)))
+
+    if report_format == "csv":
+        writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result.row(folder))
+        return
+
+    # one object per line so that huge reports are never held in memory:
+    file.write("[")
+    separator = "\n"
+    for result in results:
+        file.write(separator + json.dumps(result.row(folder), ensure_ascii=False))
+        separator = ",\n"
+    file.write("\n]\n")
+
+
+if __name__ == "__main__":
+    # scan a folder with the default ffmpeg, without writing a database:
+    import sys
+
+    root = pathlib.Path(sys.argv[1] if len(sys.argv) > 1 else ".").absolute()
+    scanner = Scanner(Database(None, in_memory=True), -16)
+    write_report(scanner.run(find_sources(root)), sys.stdout, root)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+Analyze long files in segments that are decoded in parallel.
+
+EBU R128 gates on 400 ms blocks that overlap by 300 ms, so one block
+ends every 100 ms. Segments are cut on that 100 ms grid. A segment that
+starts at s is decoded from s - PREROLL. This gives the first block that
+ends inside it a whole window of audio, and gives the K-weighting filter
+time to settle. The blocks that end before s belong to the previous
+segment and are dropped.
+
+The blocks of all segments together are the blocks of one pass over the
+file. Their gated loudness is the single pass value, and their largest
+peak is its peak.
+"""
+
+__all__ = ["Segment", "plan_segments", "analyze_segmented", "SEGMENT_MIN", "PREROLL"]
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+import os
+
+import logger
+log = logger.Logger(__name__)
+
+from ffmpeg import FFmpeg
+from loudness import gated_loudness
+
+# seconds between the ends of two blocks:
+STEP = 0.1
+
+# audio decoded before a segment, a multiple of STEP:
+PREROLL = 1.0
+
+# shortest segment worth an ffmpeg of its own, in seconds:
+SEGMENT_MIN = 300
+
+
+class Segment:
+    """A part of a file: decoded from start for length seconds (None: to the end),
+    of whose blocks the first skip are dropped."""
+    __slots__ = ("number", "start", "length", "skip")
+
+    def __init__(self, number, start, length, skip):
+        self.number = number
+        self.start = start
+        self.length = length
+        self.skip = skip
+
+    def __repr__(self):
+        return "Segment(number={!r}, start={!r}, length={!r}, skip={!r})".format(
+            self.number, self.start, self.length, self.skip)
+
+
+def plan_segments(duration, count, min_length=SEGMENT_MIN):
+    """Cut duration seconds into up to count segments of at least min_length seconds."""
+    count = max(1, min(count, int(duration // min_length)))
+
+    # boundaries in steps, so that they fall on the block grid:
+    steps = int(round(duration / STEP))
+    preroll = int(round(PREROLL / STEP))
+    bounds = [steps * number // count for number in range(count)] + [None]
+
+    segments = []
+    for number in range(count):
+        begin, end = bounds[number], bounds[number + 1]
+        skip = min(preroll, begin)
+        length = round((end - begin + skip) * STEP, 1) if end is not None else None
+        segments.append(Segment(number, round((begin - skip) * STEP, 1), length, skip))
+    return segments
+
+
+def analyze_segmented(input_file, duration, ffmpeg_path=None, workers=None, done=None):
+    """Analyze input_file of duration seconds with one ffmpeg per segment.
+
+    Returns (lufs, peak, blocks) with the momentary loudness of every
+    block in order. done is called with each Segment once it is analyzed.
+    """
+    segments = plan_segments(duration, workers or os.cpu_count() or 1)
+    threads = local()
+
+    def analyze(segment):
+        # an FFmpeg keeps the state of the running job, so every thread has its own:
+        ffmpeg = getattr(threads, "ffmpeg", None)
+        if ffmpeg is None:
+            ffmpeg = threads.ffmpeg = FFmpeg(path=ffmpeg_path)
+
+        _, peak = ffmpeg.analyze_volume(input_file, start=segment.start, length=segment.length)
+        blocks = ffmpeg.blocks[segment.skip:]
+
+        log.d("segment {} of {}: {} blocks from {} s", segment.number, input_file.name, len(blocks), segment.start)
+        if done:
+            done(segment)
+        return peak, blocks
+
+    log.i("Analyzing {} in {} segments...", input_file.name, len(segments))
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        results = list(executor.map(analyze, segments))
+
+    blocks = [block for _, segment_blocks in results for block in segment_blocks]
+    peak = max(peak for peak, _ in results)
+    return gated_loudness(blocks), peak, blocks
+
+
+if __name__ == "__main__":
+    # a segmented analysis must give the blocks, loudness and peak of a
+    # single pass. Without arguments generated signals are analyzed, by
+    # ffmpeg if there is one and by the stubs otherwise (which skips the
+    # loudness step); exits non-zero on a mismatch:
+    import sys
+    import tempfile
+    import pathlib
+
+    from ffmpeg import FFmpegException
+    from utils import flac_duration
+
+    # a seeked decode starts with other resampler and filter state, which
+    # the preroll settles down to the last digit ebur128 writes:
+    TOLERANCE = 0.01
+
+    def check(file, duration, ffmpeg_path):
+        ffmpeg = FFmpeg(path=ffmpeg_path)
+        _, peak = ffmpeg.analyze_volume(file)
+        single = ffmpeg.blocks
+        lufs, segmented_peak, blocks = analyze_segmented(file, duration, ffmpeg_path=ffmpeg_path, workers=4)
+
+        print("{} s in {} segments: {} blocks single, {} segmented".format(
+            duration, len(plan_segments(duration, 4)), len(single), len(blocks)))
+        print("gated loudness: {} LUFS single, {} LUFS segmented".format(gated_loudness(single), lufs))
+        print("peak: {} dBFS single, {} dBFS segmented".format(peak, segmented_peak))
+
+        errors = []
+        if len(single) != len(blocks):
+            errors.append("block counts differ")
+        elif single:
+            off = max(abs(a - b) for a, b in zip(single, blocks))
+            if off > TOLERANCE:
+                errors.append("blocks differ by up to {:.3f} LU".format(off))
+        if gated_loudness(single) != lufs:
+            errors.append("gated loudness differs")
+        if abs(peak - segmented_peak) > 0.1:
+            errors.append("peak differs")
+
+        for error in errors:
+            print("MISMATCH: {}".format(error), file=sys.stderr)
+        return not errors
+
+    if len(sys.argv) > 1:
+        file = pathlib.Path(sys.argv[1]).absolute()
+        sys.exit(0 if check(file, flac_duration(file), None) else 1)
+
+    seconds = 3 * SEGMENT_MIN + 12.3
+    with tempfile.TemporaryDirectory(prefix="r128") as folder:
+        # the noise also gets 12 dB quieter across the start of the second
+        # segment, halfway through the preroll its analysis starts with:
+        steps = [None, (plan_segments(seconds, 4)[1].start + PREROLL / 2, -12)]
+        try:
+            ffmpeg_path = pathlib.Path(FFmpeg().path)
+        except FFmpegException:
+            import stubs
+            print("no ffmpeg, using the stubs and skipping the loudness step")
+            ffmpeg_path = stubs.install(folder, duration=seconds)["ffmpeg"]
+            steps = [None]
+
+        ok = True
+        for number, step in enumerate(steps):
+            if step:
+                print("with a step of {1} dB at {0} s:".format(*step))
+            file = pathlib.Path(folder) / "noise{}.flac".format(number)
+            FFmpeg(path=ffmpeg_path).test_signal(file, seconds, step=step)
+            ok = check(file, seconds, ffmpeg_path) and ok
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+
+"""
+Encode long files in parts that run in parallel and splice them gaplessly.
+
+AAC and MP3 encoders cut their input into frames of a fixed number of
+samples and start with a delay (priming) that is not a whole frame. When
+a part starts on the frame grid, its n-th frame covers the same samples
+as frame n of a single pass, counted from where the part starts. So
+parts are cut on the frame grid and each one is encoded from OVERLAP
+frames before its first frame; those frames only let the encoder settle
+and are dropped, like the OVERLAP frames encoded after its last one.
+The frames that are kept, laid end to end, are as many as a single pass
+writes, with its priming at the front and its padding at the end.
+
+AAC parts are written as raw ADTS, whose frames can simply be
+concatenated, and the result is put into an m4a whose edit list skips
+the priming and ends after the samples of the input, before the
+padding. MP3 parts are encoded without the bit reservoir, so no
+frame needs the bytes of one that was dropped, and the Xing/LAME tag of
+the first part is rewritten to describe the whole stream.
+"""
+
+__all__ = ["Part", "plan_parts", "parts_of", "encode_spliced", "set_edit_list", "SpliceError", "SPLICE_FORMATS",
+           "PART_MIN"]
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+import os
+import tempfile
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+from utils import flac_samples
+from ffmpeg import FFmpeg
+
+# frames encoded before and after the kept ones of a part:
+OVERLAP = 64
+
+# shortest part worth an encoder of its own, in seconds:
+PART_MIN = 300
+
+# samples per frame and suffix of the parts of every format that can be spliced:
+SPLICE_FORMATS = {"aac": (1024, ".aac"),
+                  "mp3": (1152, ".mp3")}
+
+# sample rates the encoders take without resampling (and so without
+# changing the frame grid), mp3 parts must also be MPEG-1 layer III:
+SPLICE_RATES = (32000, 44100, 48000)
+
+# samples of priming qaac puts before the audio:
+AAC_PRIMING = 2112
+
+_MP3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_MP3_RATES = (44100, 48000, 32000)
+
+
+class SpliceError(Exception):
+    pass
+
+
+class Part:
+    """A part of a file: encoded from sample start on for length samples
+    (None: to the end), of whose frames the first skip are dropped and
+    the next keep (None: all) are kept."""
+    __slots__ = ("number", "start", "length", "skip", "keep")
+
+    def __init__(self, number, start, length, skip, keep):
+        self.number = number
+        self.start = start
+        self.length = length
+        self.skip = skip
+        self.keep = keep
+
+    def seconds(self, rate):
+        """(start, length) in seconds, as the encoders take them."""
+        return self.start / rate, self.length / rate if self.length is not None else None
+
+    def __repr__(self):
+        return "Part(number={!r}, start={!r}, length={!r}, skip={!r}, keep={!r})".format(
+            self.number, self.start, self.length, self.skip, self.keep)
+
+
+def plan_parts(samples, frame, count, min_frames):
+    """Cut samples into up to count parts of at least min_frames frames of frame samples."""
+    frames = -(-samples // frame)
+    count = max(1, min(count, frames // min_frames))
+    bounds = [frames * number // count for number in range(count)] + [None]
+
+    parts = []
+    for number in range(count):
+        begin, end = bounds[number], bounds[number + 1]
+        skip = min(OVERLAP, begin)
+        start = (begin - skip) * frame
+        if end is None:
+            parts.append(Part(number, start, None, skip, None))
+        else:
+            parts.append(Part(number, start, min((end + OVERLAP) * frame, samples) - start, skip, end - begin))
+    return parts
+
+
+def parts_of(input_file, fmt, count, min_length=PART_MIN):
+    """(rate, parts) input_file is encoded in as fmt, None if it isn't worth or can't be split."""
+    info = flac_samples(input_file)
+    if fmt not in SPLICE_FORMATS or count < 2 or info is None:
+        return None
+
+    samples, rate = info
+    if rate not in SPLICE_RATES:
+        log.d("{} Hz of {} can't be spliced", rate, input_file.name)
+        return None
+
+    frame = SPLICE_FORMATS[fmt][0]
+    parts = plan_parts(samples, frame, count, int(min_length * rate // frame))
+    if len(parts) < 2:
+        return None
+    return rate, parts
+
+
+def adts_frames(f):
+    """Yield the ADTS frames of the binary file f."""
+    while True:
+        header = f.read(7)
+        if not header:
+            return
+
+        if len(header) < 7 or header[0] != 0xff or header[1] & 0xf6 != 0xf0:
+            raise SpliceError("no ADTS frame at byte {}".format(f.tell() - len(header)))
+
+        # one raw data block per frame is what qaac writes:
+        if header[6] & 0x03:
+            raise SpliceError("ADTS frames with several blocks can't be spliced")
+
+        length = (header[3] & 0x03) << 11 | header[4] << 3 | header[5] >> 5
+        body = f.read(length - 7)
+        if len(body) < length - 7:
+            raise SpliceError("truncated ADTS frame at byte {}".format(f.tell() - len(header) - len(body)))
+        yield header + body
+
+
+def _id3v2_size(head):
+    # a tag header is "ID3", version, flags and a syncsafe size without
+    # the header, a footer doubles the header:
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0
+    size = head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9]
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def mp3_frames(f):
+    """Yield the MPEG-1 layer III frames of the binary file f, after an ID3v2 tag and up to an ID3v1 tag."""
+    f.seek(_id3v2_size(f.read(10)))
+
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[:3] == b"TAG":
+            f.seek(-len(header), os.SEEK_CUR)
+            return
+
+        if header[0] != 0xff or header[1] & 0xfe != 0xfa:
+            raise SpliceError("no MPEG-1 layer III frame at byte {}".format(f.tell() - 4))
+
+        bitrate = (header[2] >> 4) & 0x0f
+        rate = (header[2] >> 2) & 0x03
+        if bitrate in (0, 15) or rate == 3:
+            raise SpliceError("unsupported MP3 frame at byte {}".format(f.tell() - 4))
+
+        length = 144000 * _MP3_BITRATES[bitrate] // _MP3_RATES[rate] + ((header[2] >> 1) & 0x01)
+        body = f.read(length - 4)
+        if len(body) < length - 4:
+            raise SpliceError("truncated MP3 frame at byte {}".format(f.tell() - 4 - len(body)))
+        yield header + body
+
+
+def _xing_offset(frame):
+    # the Xing/Info header follows the side information, which is
+    # shorter for mono frames; None if frame has none:
+    offset = 21 if frame[3] >> 6 == 3 else 36
+    if frame[offset:offset + 4] in (b"Xing", b"Info"):
+        return offset
+    return None
+
+
+def _crc16(data):
+    # CRC-16/ARC as the LAME tag uses it:
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+
+class _LameTag:
+    """The Xing/Info and LAME fields of the first frame of an mp3."""
+    def __init__(self, frame):
+        self.frame = bytearray(frame)
+        xing = _xing_offset(frame)
+        if xing is None:
+            raise SpliceError("the first MP3 frame has no Xing/Info header")
+
+        flags = int.from_bytes(frame[xing + 4:xing + 8], "big")
+        position = xing + 8
+        self.fields = {}
+        for flag, name, size in ((1, "frames", 4), (2, "bytes", 4), (4, "toc", 100), (8, "quality", 4)):
+            if flags & flag:
+                self.fields[name] = position
+                position += size
+
+        self.lame = position if frame[position:position + 4] == b"LAME" else None
+
+    def get(self, name):
+        position = self.fields.get(name)
+        return int.from_bytes(self.frame[position:position + 4], "big") if position is not None else None
+
+    def set(self, name, value):
+        position = self.fields.get(name)
+        if position is not None:
+            self.frame[position:position + 4] = value.to_bytes(4, "big")
+
+    @property
+    def padding(self):
+        # 12 bits delay and 12 bits padding in samples:
+        return int.from_bytes(self.frame[self.lame + 21:self.lame + 24], "big") & 0xfff if self.lame else None
+
+    def update(self, frames, size, offsets, padding):
+        """Describe a stream of frames (after this one) of size bytes (with
+        this one) whose frames start at offsets from this one."""
+        size_delta = size - self.get("bytes") if "bytes" in self.fields else 0
+        self.set("frames", frames)
+        self.set("bytes", size)
+
+        if "toc" in self.fields:
+            toc = bytes(min(255, offsets[len(offsets) * number // 100] * 256 // size) for number in range(100))
+            self.frame[self.fields["toc"]:self.fields["toc"] + 100] = toc
+
+        if self.lame is None:
+            return
+
+        lame = self.lame
+        if padding is not None:
+            delay_padding = int.from_bytes(self.frame[lame + 21:lame + 24], "big") & 0xfff000 | padding
+            self.frame[lame + 21:lame + 24] = delay_padding.to_bytes(3, "big")
+
+        music = int.from_bytes(self.frame[lame + 28:lame + 32], "big")
+        self.frame[lame + 28:lame + 32] = (music + size_delta).to_bytes(4, "big")
+
+        # a CRC over all the music would take longer than the encoding
+        # saved, 0 stands for none:
+        self.frame[lame + 32:lame + 34] = b"\0\0"
+        self.frame[lame + 34:lame + 36] = _crc16(self.frame[:lame + 34]).to_bytes(2, "big")
+
+
+def _splice_adts(part_files, parts, output):
+    with open(str(output), mode='wb') as out:
+        for part_file, part in zip(part_files, parts):
+            with open(str(part_file), mode='rb') as f:
+                written = 0
+                for number, frame in enumerate(adts_frames(f)):
+                    if number < part.skip:
+                        continue
+                    if part.keep is not None and written == part.keep:
+                        break
+                    out.write(frame)
+                    written += 1
+
+            if part.keep is not None and written < part.keep:
+                raise SpliceError("part {} has {} frames, {} are needed".format(part.number, written, part.keep))
+
+
+def _splice_mp3(part_files, parts, output):
+    tag = None
+    frames = 0
+    offsets = []
+    size = 0
+    padding = None
+
+    with open(str(output), mode='wb') as out:
+        for part_file, part in zip(part_files, parts):
+            with open(str(part_file), mode='rb') as f:
+                head = f.read(10)
+                f.seek(0)
+                id3v2 = f.read(_id3v2_size(head))
+                f.seek(0)
+                source = mp3_frames(f)
+
+                first = next(source, None)
+                if first is None or _xing_offset(first) is None:
+                    raise SpliceError("part {} has no Xing/Info frame".format(part.number))
+
+                # the tags of the first part head the output:
+                if tag is None:
+                    out.write(id3v2)
+                    tag = _LameTag(first)
+                    tag_position = out.tell()
+                    out.write(first)
+                    size = len(first)
+                if part.keep is None:
+                    padding = _LameTag(first).padding
+
+                written = 0
+                for number, frame in enumerate(source):
+                    if number < part.skip:
+                        continue
+                    if part.keep is not None and written == part.keep:
+                        break
+                    offsets.append(size)
+                    out.write(frame)
+                    size += len(frame)
+                    written += 1
+
+                if part.keep is not None and written < part.keep:
+                    raise SpliceError("part {} has {} frames, {} are needed".format(part.number, written, part.keep))
+                frames += written
+
+                # an ID3v1 tag of the last part ends the output:
+                if part.keep is None:
+                    out.write(f.read())
+
+        tag.update(frames, size, offsets, padding)
+        out.seek(tag_position)
+        out.write(tag.frame)
+
+
+def _atoms(data, start, end):
+    # (type, start, end, header length) of the mp4 atoms in data[start:end]:
+    while start + 8 <= end:
+        size = int.from_bytes(data[start:start + 4], "big")
+        kind = bytes(data[start + 4:start + 8]).decode("latin-1")
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[start + 8:start + 16], "big")
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            raise SpliceError("broken mp4 atom {!r} at byte {}".format(kind, start))
+        yield kind, start, start + size, header
+        start += size
+
+
+def _child(data, parent, kind):
+    _, start, end, header = parent
+    for atom in _atoms(data, start + header, end):
+        if atom[0] == kind:
+            return atom
+    raise SpliceError("no {} atom in {}".format(kind, parent[0]))
+
+
+def _edit_moov(moov, priming, samples, rate):
+    # mvhd and mdhd hold a timescale and a duration after the creation and
+    # modification times, which are 8 bytes long in version 1 atoms:
+    moov_atom = ("moov", 0, len(moov), 8)
+    mvhd = _child(moov, moov_atom, "mvhd")
+    scale = mvhd[1] + 12 + (16 if moov[mvhd[1] + 8] else 8)
+
+    tracks = [atom for atom in _atoms(moov, 8, len(moov)) if atom[0] == "trak"]
+    if len(tracks) != 1:
+        raise SpliceError("{} tracks instead of one".format(len(tracks)))
+    trak = tracks[0]
+    tkhd = _child(moov, trak, "tkhd")
+    mdhd = _child(moov, _child(moov, trak, "mdia"), "mdhd")
+    media_scale = mdhd[1] + 12 + (16 if moov[mdhd[1] + 8] else 8)
+    timescale = int.from_bytes(moov[media_scale:media_scale + 4], "big")
+    media_time = priming * timescale // rate
+    edts = next((atom for atom in _atoms(moov, trak[1] + trak[3], trak[2]) if atom[0] == "edts"), None)
+
+    # edits are counted in the timescale of the movie, ffmpeg's 1000 per
+    # second can't end on a sample, that of the track (its sample rate) can:
+    moov[scale:scale + 4] = timescale.to_bytes(4, "big")
+    duration = samples * timescale // rate
+
+    # the movie and the track last as long as the edit:
+    for version, position in ((moov[mvhd[1] + 8], scale + 4),
+                              (moov[tkhd[1] + 8], tkhd[1] + 12 + (24 if moov[tkhd[1] + 8] else 16))):
+        length = 8 if version else 4
+        moov[position:position + length] = min(duration, 2 ** (length * 8) - 1).to_bytes(length, "big")
+
+    # one edit: from the first sample after the priming for the samples of the input:
+    large = duration >= 2 ** 32 or media_time >= 2 ** 31
+    entry = (duration.to_bytes(8 if large else 4, "big") + media_time.to_bytes(8 if large else 4, "big")
+             + (0x00010000).to_bytes(4, "big"))
+    elst = (16 + len(entry)).to_bytes(4, "big") + b"elst" + bytes([1 if large else 0, 0, 0, 0]) + \
+        (1).to_bytes(4, "big") + entry
+    new_edts = (8 + len(elst)).to_bytes(4, "big") + b"edts" + elst
+
+    # the edit list goes after tkhd, in place of the one ffmpeg wrote:
+    delta = len(new_edts)
+    if edts:
+        del moov[edts[1]:edts[2]]
+        delta -= edts[2] - edts[1]
+    moov[tkhd[2]:tkhd[2]] = new_edts
+    moov[trak[1]:trak[1] + 4] = (trak[2] - trak[1] + delta).to_bytes(4, "big")
+    moov[0:4] = len(moov).to_bytes(4, "big")
+    return moov
+
+
+def _moov(f, name):
+    # (position, content) of the moov atom, which has to end the mp4 file
+    # f, as ffmpeg writes it without -movflags +faststart, so that changing
+    # its size moves no chunk:
+    end = f.seek(0, os.SEEK_END)
+    moov = None
+    position = 0
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(16)
+        size = int.from_bytes(header[:4], "big")
+        if size == 1:
+            size = int.from_bytes(header[8:16], "big")
+        elif size == 0:
+            size = end - position
+        if size < 8:
+            raise SpliceError("broken mp4 atom at byte {} of {}".format(position, name))
+        if header[4:8] == b"moov":
+            moov = (position, size, int.from_bytes(header[:4], "big") == 1)
+        position += size
+
+    if moov is None or moov[0] + moov[1] != end or moov[2]:
+        raise SpliceError("{} doesn't end with a moov atom".format(name))
+
+    f.seek(moov[0])
+    return moov[0], bytearray(f.read(moov[1]))
+
+
+def set_edit_list(m4a_file, priming, samples, rate):
+    """Make players of the single track m4a_file skip priming samples and play samples more."""
+    with open(str(m4a_file), mode='r+b') as f:
+        position, moov = _moov(f, m4a_file)
+        moov = _edit_moov(moov, priming, samples, rate)
+        f.seek(position)
+        f.write(moov)
+        f.truncate()
+
+    log.d("edit list of {}: {} samples after {} of priming", m4a_file.name, samples, priming)
+
+
+def encode_spliced(input_file, output_file, fmt, rate, parts, encoder, volume=0, ffmpeg_path=None, done=None):
+    """Encode input_file to output_file as fmt in parts, one thread each.
+
+    rate and parts are what parts_of() returned. encoder is called in
+    every thread for the Qaac or LAME that thread encodes with. done is
+    called with each Part once it is encoded.
+    """
+    frame, suffix = SPLICE_FORMATS[fmt]
+    threads = local()
+
+    with tempfile.TemporaryDirectory(prefix="r128") as folder:
+        folder = pathlib.Path(folder)
+
+        def encode(part):
+            # the encoders keep the state of the running job, so every thread has its own:
+            converter = getattr(threads, "encoder", None)
+            if converter is None:
+                converter = threads.encoder = encoder()
+
+            part_file = folder / "part{:03d}{}".format(part.number, suffix)
+            start, length = part.seconds(rate)
+            convert = converter.convert_to_aac if fmt == "aac" else converter.convert_to_mp3
+            convert(input_file, part_file, volume=volume, start=start, length=length)
+
+            log.d("part {} of {}: samples {} to {}", part.number, input_file.name, part.start,
+                  part.start + part.length if part.length is not None else "end")
+            if done:
+                done(part)
+            return part_file
+
+        log.i("Encoding {} in {} parts...", input_file.name, len(parts))
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            part_files = list(executor.map(encode, parts))
+
+        if fmt == "mp3":
+            _splice_mp3(part_files, parts, output_file)
+            return
+
+        spliced = folder / "spliced.aac"
+        _splice_adts(part_files, parts, spliced)
+        FFmpeg(path=ffmpeg_path).remux_adts(spliced, output_file)
+        set_edit_list(output_file, AAC_PRIMING, flac_samples(input_file)[0], rate)
+
+
+if __name__ == "__main__":
+    # a spliced encode must have the frames, tags and length of a single
+    # pass. Without arguments a generated input is encoded by the stubs,
+    # otherwise the flac file given in the format given by qaac or lame;
+    # exits non-zero on a mismatch:
+    import sys
+
+    from qaac import Qaac
+    from lame import LAME
+
+    def mp3_summary(file):
+        with open(str(file), mode='rb') as f:
+            frames = list(mp3_frames(f))
+        tag = _LameTag(frames[0])
+        return {"frames": len(frames) - 1, "tag frames": tag.get("frames"), "tag bytes": tag.get("bytes"),
+                "padding": tag.padding, "size": file.stat().st_size}
+
+    def m4a_summary(file):
+        # the samples of all frames, the movie timescale and the edit:
+        with open(str(file), mode='rb') as f:
+            _, moov = _moov(f, file)
+
+        def field(atom, offset, version):
+            start = atom[1] + offset
+            return int.from_bytes(moov[start:start + (8 if version else 4)], "big")
+
+        moov_atom = ("moov", 0, len(moov), 8)
+        mvhd = _child(moov, moov_atom, "mvhd")
+        trak = _child(moov, moov_atom, "trak")
+        mdhd = _child(moov, _child(moov, trak, "mdia"), "mdhd")
+        elst = _child(moov, _child(moov, trak, "edts"), "elst")
+        mdhd_v1, mvhd_v1, elst_v1 = moov[mdhd[1] + 8], moov[mvhd[1] + 8], moov[elst[1] + 8]
+        if field(elst, 12, False) != 1:
+            return {"edits": field(elst, 12, False)}
+        return {"samples": field(mdhd, (32 if mdhd_v1 else 24), mdhd_v1),
+                "edit": (field(mvhd, (28 if mvhd_v1 else 20), False), field(elst, (24 if elst_v1 else 20), elst_v1),
+                         field(elst, 16, elst_v1))}
+
+    with tempfile.TemporaryDirectory(prefix="r128") as folder:
+        folder = pathlib.Path(folder)
+        if len(sys.argv) > 2:
+            file = pathlib.Path(sys.argv[1]).absolute()
+            formats = [sys.argv[2]]
+            paths = {}
+        else:
+            import stubs
+            seconds = 3 * PART_MIN + 7
+            paths = stubs.install(folder / "bin", duration=seconds)
+            # a STREAMINFO block is all parts_of() reads, 16 bit stereo at 44.1 kHz:
+            file = folder / "input.flac"
+            fields = 44100 << 44 | 1 << 41 | 15 << 36 | seconds * 44100
+            file.write_bytes(b"fLaC" + bytes([0x80, 0, 0, 34]) + bytes(10) + fields.to_bytes(8, "big") + bytes(16))
+            formats = sorted(SPLICE_FORMATS)
+
+        ffmpeg_path = paths.get("ffmpeg")
+
+        def encoder(fmt):
+            if fmt == "aac":
+                return Qaac(ff_path=ffmpeg_path, qaac_path=paths.get("qaac"))
+            return LAME(ff_path=ffmpeg_path, lame_path=paths.get("lame"))
+
+        failed = False
+        for fmt in formats:
+            samples = flac_samples(file)[0]
+            rate, parts = parts_of(file, fmt, 4)
+
+            single = folder / "single{}".format(SPLICE_FORMATS[fmt][1])
+            converter = encoder(fmt)
+            (converter.convert_to_aac if fmt == "aac" else converter.convert_to_mp3)(file, single)
+            spliced = folder / "spliced.{}".format("m4a" if fmt == "aac" else "mp3")
+            encode_spliced(file, spliced, fmt, rate, parts, lambda: encoder(fmt), ffmpeg_path=ffmpeg_path)
+
+            if fmt == "mp3":
+                expected, result = mp3_summary(single), mp3_summary(spliced)
+            else:
+                # the frames of the single pass, played from the end of
+                # the priming for the samples of the input:
+                with open(str(single), mode='rb') as f:
+                    frames = sum(1 for _ in adts_frames(f))
+                expected, result = {"samples": frames * 1024, "edit": (rate, AAC_PRIMING, samples)}, m4a_summary(spliced)
+
+            print("{} in {} parts: {}".format(fmt, len(parts), result))
+            if result != expected:
+                print("MISMATCH: a single pass gives {}".format(expected), file=sys.stderr)
+                failed = True
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Normalize a FLAC stream, from stdin or a fifo, to a stream on stdout.
+
+The input is read once: while it is analyzed it is also copied into a
+spool that stays in memory up to SPOOL_MEMORY bytes and spills into a
+temporary file beyond, then it is encoded from the spool with the gain
+the analysis found. Outputs that can't be seeked back into need their
+streamable variants: raw ADTS for AAC and a fragmented mp4 for ALAC.
+"""
+
+__all__ = ["normalize_stream", "Spool", "StreamError", "STREAM_FORMATS", "SPOOL_MEMORY"]
+
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from threading import Thread
+import os
+import pathlib
+
+import logger
+log = logger.Logger(__name__)
+
+# bytes of the input kept in memory before spilling to disk:
+SPOOL_MEMORY = 64 * 1024 * 1024
+
+CHUNK = 64 * 1024
+
+# the encoder and its method that write each format to stdout; qaac
+# can only write ALAC into a file it can seek in, ffmpeg can fragment:
+STREAM_FORMATS = {"aac": ("qaac", "convert_to_aac"),
+                  "alac": ("ffmpeg", "convert_to_alac"),
+                  "mp3": ("lame", "convert_to_mp3")}
+
+
+class StreamError(Exception):
+    pass
+
+
+class Spool:
+    """The bytes of a stream, in memory up to max_size and in a temporary file beyond."""
+    def __init__(self, max_size=SPOOL_MEMORY):
+        self._file = SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+
+    @property
+    def spilled(self):
+        return self._file._rolled
+
+    def fill(self, source, pipe):
+        """Copy source into the spool and into the pipe, until source ends.
+
+        The whole source is spooled even if the reader of pipe goes away.
+        """
+        for chunk in iter(partial(source.read, CHUNK), b''):
+            self._file.write(chunk)
+            self.size += len(chunk)
+
+            if pipe:
+                try:
+                    pipe.write(chunk)
+                except BrokenPipeError:
+                    pipe = None
+
+    def drain(self, pipe):
+        """Write everything spooled into the pipe."""
+        self._file.seek(0)
+        try:
+            for chunk in iter(partial(self._file.read, CHUNK), b''):
+                pipe.write(chunk)
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        self._file.close()
+
+
+def _run_fed(target, run):
+    # run(read_fd) while target(pipe) writes into the pipe from a thread:
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with open(write_fd, mode='wb') as pipe:
+            target(pipe)
+
+    thread = Thread(target=feed, name="feed")
+    thread.daemon = True
+    thread.start()
+
+    try:
+        return run(read_fd)
+    finally:
+        # a feeder blocked on a pipe nobody reads gets EPIPE now:
+        os.close(read_fd)
+        thread.join()
+
+
+def normalize_stream(ffmpeg, encoder, fmt, source, volume, name, spool_size=SPOOL_MEMORY):
+    """Analyze the FLAC stream source and write it to stdout as fmt, normalized to volume LUFS.
+
+    Args:
+        ffmpeg: FFmpeg instance used for the analysis
+        encoder: instance of the encoder STREAM_FORMATS names for fmt
+        source: binary file object the FLAC stream is read from
+        name: pathlib.Path the job is logged under
+
+    Returns:
+        (lufs, peak, gain)
+    """
+    if fmt not in STREAM_FORMATS:
+        raise StreamError("{} can't be streamed, only: {}".format(fmt, ", ".join(STREAM_FORMATS)))
+
+    spool = Spool(spool_size)
+    try:
+        lufs, peak = _run_fed(partial(spool.fill, source), lambda fd: ffmpeg.analyze_volume(name, stdin=fd))
+        log.d("spooled {} bytes, spilled to disk: {}", spool.size, spool.spilled)
+
+        if spool.size == 0:
+            raise StreamError("The input stream is empty.")
+
+        gain = round(volume - lufs, 1)
+        convert = getattr(encoder, STREAM_FORMATS[fmt][1])
+        _run_fed(spool.drain, lambda fd: convert(name, pathlib.Path("-"), volume=gain, stdin=fd))
+
+        return lufs, peak, gain
+    finally:
+        spool.close()
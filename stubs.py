@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fake ffmpeg, qaac and lame executables for measuring the orchestration.
+
+install() writes ffmpeg.exe, qaac.exe and lame.exe into a folder. They
+pass the binary tests of FFmpeg, Qaac and LAME, print the stderr those
+classes parse (banner, Duration, ebur128 blocks, time= progress) with
+windows line endings and move silent PCM through the pipes, so whole
+batches can run on a machine without any codec installed. qaac --adts
+and lame write frames of the right sizes and counts, with the tags of
+the real encoders, so that outputs can be spliced. The ebur128 blocks
+written into ametadata files depend on their position in the input,
+like those of real audio, and the first three after -ss are quieter,
+like those of a meter whose 400 ms window isn't full yet, so that
+segmented analyses can be checked against a single pass.
+
+Settings are baked into the executables and can be overridden per run
+through NORMALIZE_STUB_<NAME> environment variables:
+
+ - duration: seconds of audio every input file has
+ - speed: times realtime the stubs run at, 0 for as fast as possible
+ - rate: sample rate of the PCM sent through the pipes
+ - lufs, peak: loudness reported by ebur128
+ - meter_error: LU the meter of a conversion reads off the volume it applied
+ - progress: seconds of audio between two time= lines
+ - finalize: seconds the encoders take after their input has ended
+
+The executables are python scripts with a shebang, so this only works
+where those can be run directly (not on windows).
+"""
+
+__all__ = ["install", "DEFAULTS"]
+
+import json
+import math
+import os
+import random
+import re
+import struct
+import sys
+import time
+import pathlib
+
+DEFAULTS = {"duration": 30.0,
+            "speed": 0.0,
+            "rate": 44100,
+            "lufs": -18.5,
+            "peak": -0.8,
+            "meter_error": 0.0,
+            "progress": 0.5,
+            "finalize": 0.1}
+
+_WRAPPER = """#!{python}
+import sys
+sys.path.insert(0, {folder!r})
+import stubs
+sys.exit(stubs.main({name!r}, {settings!r}))
+"""
+
+_FFMPEG_BANNER = ("ffmpeg version N-stub Copyright (c) 2000-2015 the FFmpeg developers\r\n"
+                  "  built with gcc 5.2.0 (GCC)\r\n"
+                  "  configuration: --enable-gpl --enable-libmp3lame --enable-libsoxr\r\n"
+                  "  libavutil      54. 31.100 / 54. 31.100\r\n")
+
+
+def install(folder, **settings):
+    """Write the stub executables into folder, return {name: path}."""
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown stub settings: {}".format(", ".join(sorted(unknown))))
+
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    baked = dict(DEFAULTS, **settings)
+
+    paths = {}
+    for name in ("ffmpeg", "qaac", "lame"):
+        path = folder / "{}.exe".format(name)
+        path.write_text(_WRAPPER.format(python=sys.executable, folder=str(pathlib.Path(__file__).parent.absolute()),
+                                        name=name, settings=json.dumps(baked)))
+        path.chmod(0o755)
+        paths[name] = path
+    return paths
+
+
+class _Stub:
+    def __init__(self, settings):
+        settings = json.loads(settings)
+        for key, default in settings.items():
+            value = os.environ.get("NORMALIZE_STUB_{}".format(key.upper()))
+            settings[key] = type(default)(value) if value is not None else default
+        self.settings = settings
+        self._start = time.perf_counter()
+
+    def err(self, text):
+        sys.stderr.buffer.write(text.encode("utf-8"))
+        sys.stderr.buffer.flush()
+
+    def pace(self, position):
+        # sleep until position seconds of audio are due at the set speed:
+        if self.settings["speed"] > 0:
+            delay = position / self.settings["speed"] - (time.perf_counter() - self._start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def progress_line(self, position):
+        return "size=   {:6d}kB time={:02d}:{:02d}:{:05.2f} bitrate= 838.9kbits/s speed=48.1x    \r".format(
+            int(position * 100), int(position // 3600), int(position % 3600 // 60), position % 60)
+
+    def blocks(self):
+        # (position, bytes) of pcm per progress step, whole samples add up
+        # to the duration:
+        duration = self.settings["duration"]
+        step = self.settings["progress"]
+        frame = 4  # 16 bit stereo
+        position = 0.0
+        samples = 0
+        while position < duration:
+            position += min(step, duration - position)
+            end = int(round(position * self.settings["rate"]))
+            yield position, (end - samples) * frame
+            samples = end
+
+    def read_stdin(self):
+        total = 0
+        for chunk in iter(lambda: sys.stdin.buffer.read(65536), b''):
+            total += len(chunk)
+        return total
+
+    def consume(self, output, encode=None):
+        # read pcm until the pipe is closed and write a proportional output,
+        # or what encode makes of the number of samples:
+        total = self.read_stdin()
+
+        time.sleep(self.settings["finalize"])
+        data = encode(max(total - 44, 0) // 4) if encode else b"\0" * max(total // 10, 1)
+        if output == "-":
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        else:
+            with open(output, mode='wb') as f:
+                f.write(data)
+        return total
+
+
+def _wav_header(rate, size):
+    return (b"RIFF" + struct.pack("<I", 36 + size) + b"WAVEfmt " +
+            struct.pack("<IHHIIHH", 16, 1, 2, rate, rate * 4, 4, 16) + b"data" + struct.pack("<I", size))
+
+
+def _adts(samples):
+    # what qaac writes with --adts: 2112 samples of priming, 1024 per frame:
+    data = bytearray()
+    for number in range(-(-(samples + 2112) // 1024)):
+        length = 7 + 96 + number % 7
+        data += bytes([0xff, 0xf1, 0x50, 0x80 | length >> 11, (length >> 3) & 0xff, (length & 0x07) << 5 | 0x1f, 0xfc])
+        data += bytes(length - 7)
+    return bytes(data)
+
+
+def _atom(kind, *content):
+    data = b"".join(content)
+    return (8 + len(data)).to_bytes(4, "big") + kind + data
+
+
+def _m4a(adts):
+    # what ffmpeg remuxes an ADTS stream into: its frames in an mdat and a
+    # moov after it, with an edit list that covers every frame:
+    frames = 0
+    position = 0
+    while position + 7 <= len(adts):
+        frames += 1
+        position += (adts[position + 3] & 0x03) << 11 | adts[position + 4] << 3 | adts[position + 5] >> 5
+    rate = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050)[adts[2] >> 2 & 0x0f] if adts else 44100
+    samples = frames * 1024
+    duration = samples * 1000 // rate
+
+    mvhd = _atom(b"mvhd", bytes(12), (1000).to_bytes(4, "big"), duration.to_bytes(4, "big"), bytes(80))
+    tkhd = _atom(b"tkhd", bytes([0, 0, 0, 3]), bytes(8), (1).to_bytes(4, "big"), bytes(4),
+                 duration.to_bytes(4, "big"), bytes(60))
+    elst = _atom(b"elst", bytes(4), (1).to_bytes(4, "big"), duration.to_bytes(4, "big"), bytes(4),
+                 (0x00010000).to_bytes(4, "big"))
+    mdhd = _atom(b"mdhd", bytes(12), rate.to_bytes(4, "big"), samples.to_bytes(4, "big"), bytes(4))
+    hdlr = _atom(b"hdlr", bytes(8), b"soun", bytes(12), b"SoundHandler\0")
+    trak = _atom(b"trak", tkhd, _atom(b"edts", elst), _atom(b"mdia", mdhd, hdlr))
+    return _atom(b"ftyp", b"M4A ", bytes(4), b"M4A mp42isom") + _atom(b"mdat", adts) + _atom(b"moov", mvhd, trak)
+
+
+def _mp3(rate):
+    # what lame writes: an ID3v2 tag, an Info frame with a LAME tag, 64 kbps
+    # frames of 1152 samples after a delay of 576 and an ID3v1 tag:
+    index = {44100: 0, 48000: 1, 32000: 2}[rate]
+    length = 144000 * 64 // rate
+    header = bytes([0xff, 0xfb, 0x50 | index << 2, 0x44])
+
+    def encode(samples):
+        frames = -(-(samples + 576) // 1152) + 1
+        padding = frames * 1152 - 576 - samples
+
+        tag = bytearray(header + bytes(length - 4))
+        tag[36:44] = b"Info" + (0x0f).to_bytes(4, "big")
+        tag[44:48] = frames.to_bytes(4, "big")
+        tag[48:52] = ((frames + 1) * length).to_bytes(4, "big")
+        tag[52:152] = bytes(range(0, 250, 2)[:100])
+        tag[156:165] = b"LAME3.99r"
+        tag[177:180] = (576 << 12 | padding).to_bytes(3, "big")
+        tag[184:188] = ((frames + 1) * length).to_bytes(4, "big")
+
+        id3v2 = b"ID3\x03\x00\x00\x00\x00\x01\x00" + bytes(128)
+        return id3v2 + bytes(tag) + (header + bytes(length - 4)) * frames + b"TAG" + bytes(125)
+    return encode
+
+
+def _ffmpeg(stub, args):
+    settings = stub.settings
+    if not args:
+        stub.err(_FFMPEG_BANNER + "Hyper fast Audio and Video encoder\r\n"
+                 "Use -h to get full help or, even better, run 'man ffmpeg'\r\n")
+        return 1
+
+    if "-i" not in args:
+        stub.err("At least one output file must be specified\r\n")
+        return 1
+
+    inputs = [args[number + 1] for number, arg in enumerate(args) if arg == "-i"]
+    for input_file in inputs:
+        if input_file == "-":
+            # a piped input is read to its end before anything is written:
+            if not stub.read_stdin():
+                stub.err("pipe:: Invalid data found when processing input\r\n")
+                return 1
+        elif not os.path.isfile(input_file) and "lavfi" not in args:
+            stub.err("{}: No such file or directory\r\n".format(input_file))
+            return 1
+
+    if "-hide_banner" not in args:
+        stub.err(_FFMPEG_BANNER)
+
+    duration = settings["duration"]
+    for number, input_file in enumerate(inputs):
+        stub.err("Input #{0}, flac, from '{1}':\r\n"
+                 "  Duration: {2:02d}:{3:02d}:{4:05.2f}, start: 0.000000, bitrate: 912 kb/s\r\n"
+                 "    Stream #{0}:0: Audio: flac, {5} Hz, stereo, s16\r\n".format(
+                     number, input_file, int(duration // 3600), int(duration % 3600 // 60), duration % 60,
+                     settings["rate"]))
+
+    # a part of the input, from -ss on for -t seconds:
+    if "-ss" in args:
+        duration = max(duration - float(args[args.index("-ss") + 1]), 0)
+    if "-t" in args:
+        duration = min(duration, float(args[args.index("-t") + 1]))
+    settings["duration"] = duration
+
+    # a metered conversion measures its output with a branch of the graph:
+    meter = any("anullsink" in arg for arg in args)
+
+    # one block ends every 100 ms, durations like 305.1 s are not exact:
+    blocks = int(round(duration * 10, 6))
+
+    if any("ebur128" in arg for arg in args) and not meter:
+        graph = next(arg for arg in args if "ebur128" in arg)
+        lufs = settings["lufs"]
+
+        # filters are numbered through the graph, one chain per input:
+        chain = [part.split("=")[0] for part in re.sub(r"\[[^\]]*\]", "", graph.split(";")[0]).split(",")]
+        names = [number * len(chain) + chain.index("ebur128") for number in range(len(inputs))]
+
+        if "framelog=verbose" in graph:
+            # quiet: blocks go into the ametadata files, stats drive the progress:
+            files = [path.replace("\\\\:", ":") for path in re.findall(r"file=(.*?)(?=\[|;|$)", graph)]
+            first = int(round(float(args[args.index("-ss") + 1]) * 10)) if "-ss" in args else 0
+            for file, input_file in zip(files, inputs):
+                with open(file, mode='w') as f:
+                    for block in range(blocks):
+                        momentary = random.Random("{}:{}".format(input_file, first + block)).gauss(lufs, 4)
+                        if block < 3:
+                            # the rest of the window is silence:
+                            momentary += 10 * math.log10((block + 1) / 4)
+                        f.write("frame:{0:<7d}pts:{1:<9d}pts_time:{2:g}\nlavfi.r128.M={3:.3f}\n".format(
+                            block, block * 4800, block / 10, momentary))
+            if "-nostats" not in args:
+                for position, length in stub.blocks():
+                    stub.pace(position)
+                    stub.err(stub.progress_line(position))
+        else:
+            # one line every 100 ms per input:
+            for name, input_file in zip(names, inputs):
+                rand = random.Random(input_file)
+                for block in range(1, blocks + 1):
+                    stub.pace(block / 10)
+                    stub.err("[Parsed_ebur128_{} @ 0000000002d1e2a0] t: {:<10.1f} TARGET:-23 LUFS    "
+                             "M:{:6.1f} S:{:6.1f}     I:{:6.1f} LUFS       LRA:{:6.1f} LU\r\n".format(
+                                 name, block / 10, rand.gauss(lufs, 4), rand.gauss(lufs, 2), lufs, 6.1))
+        for name in names:
+            stub.err("[Parsed_ebur128_{} @ 0000000002d1e2a0] Summary:\r\n\r\n"
+                     "  Integrated loudness:\r\n"
+                     "    I:         {:5.1f} LUFS\r\n"
+                     "    Threshold: {:5.1f} LUFS\r\n\r\n"
+                     "  True peak:\r\n"
+                     "    Peak:      {:5.1f} dBFS\r\n".format(name, lufs, lufs - 10, settings["peak"]))
+        return 0
+
+    outputs = [args[number + 1] for number, arg in enumerate(args) if arg == "-y"]
+    if len(outputs) > 1:
+        for position, length in stub.blocks():
+            stub.pace(position)
+            stub.err(stub.progress_line(position))
+        for output in outputs:
+            with open(output, mode='wb') as f:
+                f.write(bytes(int(duration * settings["rate"] * 4) // 10))
+        stub.err("\r\nsize=N/A video:0kB audio:{:d}kB subtitle:0kB other streams:0kB\r\n".format(
+            int(duration * 100 * len(outputs))))
+        return 0
+
+    output = args[-1]
+    if output == "-":
+        size = sum(length for _, length in stub.blocks())
+        out = sys.stdout.buffer
+        try:
+            out.write(_wav_header(settings["rate"], size))
+            for position, length in stub.blocks():
+                stub.pace(position)
+                out.write(bytes(length))
+                stub.err(stub.progress_line(position))
+            out.flush()
+        except BrokenPipeError:
+            return 1
+        finally:
+            try:
+                out.close()
+            except BrokenPipeError:
+                pass
+    elif args[args.index("-i") - 2:args.index("-i")] == ["-f", "aac"]:
+        # a remux of raw ADTS:
+        with open(inputs[0], mode='rb') as f:
+            adts = f.read()
+        with open(output, mode='wb') as f:
+            f.write(_m4a(adts))
+    else:
+        with open(output, mode='wb') as f:
+            for position, length in stub.blocks():
+                stub.pace(position)
+                f.write(bytes(length // 10))
+                stub.err(stub.progress_line(position))
+
+    stub.err("\r\nsize=N/A video:0kB audio:{:d}kB subtitle:0kB other streams:0kB\r\n".format(
+        int(duration * 100)))
+
+    if meter:
+        graph = next(arg for arg in args if "anullsink" in arg)
+        volume = float(re.search(r"volume=(-?[\d.]+)dB", graph).group(1))
+        lufs = settings["lufs"] + volume + settings["meter_error"]
+        stub.err("[Parsed_ebur128_2 @ 0000000002d1e2a0] Summary:\r\n\r\n"
+                 "  Integrated loudness:\r\n"
+                 "    I:         {:5.1f} LUFS\r\n"
+                 "    Threshold: {:5.1f} LUFS\r\n\r\n"
+                 "  True peak:\r\n"
+                 "    Peak:      {:5.1f} dBFS\r\n".format(lufs, lufs - 10, settings["peak"] + volume))
+    return 0
+
+
+def _qaac(stub, args):
+    if "--check" in args:
+        stub.err("qaac 2.45, CoreAudioToolbox 7.9.9.4\r\n")
+        return 0
+
+    if "-o" not in args:
+        stub.err("qaac: no output file\r\n")
+        return 2
+
+    total = stub.consume(args[args.index("-o") + 1], _adts if "--adts" in args else None)
+    stub.err("\r[100.0%] {:d} bytes\r\n".format(total))
+    return 0
+
+
+def _lame(stub, args):
+    if not args:
+        stub.err("LAME 64bits version 3.99.5 (http://lame.sf.net)\r\n\r\n"
+                 "usage: lame [options] <infile> [outfile]\r\n")
+        return 1
+
+    total = stub.consume(args[-1], _mp3(stub.settings["rate"]))
+    stub.err("Writing LAME Tag...done\r\n{:d} bytes\r\n".format(total))
+    return 0
+
+
+def main(name, settings):
+    stub = _Stub(settings)
+    return {"ffmpeg": _ffmpeg, "qaac": _qaac, "lame": _lame}[name](stub, sys.argv[1:])
@@ -61,7 +61,7 @@ class DropFrame(QtWidgets.QLabel):
             url = event.mimeData().urls()[0]
             path = pathlib.Path(url.toLocalFile()).absolute()
             conf.input = path
-            log.d("accepted drop: {}".format(conf.input))
+            log.d("accepted drop: {}", conf.input)
             event.accept()
             self.signals.accepted_drop.emit()
         else:
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
 import pathlib
+import contextlib
+from collections import deque
+from threading import Thread, Lock
 
 import colorama
 colorama.init(wrap=False)
@@ -19,6 +23,7 @@ else:
     log.level = "DEBUG"
 
 from progressbar import ProgressBar, Percentage, Bar
+from progress import Reporter, BatchDisplay
 
 
 def print_stderr(msg):
@@ -39,7 +44,7 @@ def locate_bin(bin_name, exception):
     if not issubclass(exception, Exception):
         raise AttributeError("exception must be a Exception type")
 
-    log.d("trying to find {} binary".format(bin_name))
+    log.d("trying to find {} binary", bin_name)
 
     # script folder should be among the first to be searched:
     frozen = getattr(sys, 'frozen', '')
@@ -63,7 +68,7 @@ def locate_bin(bin_name, exception):
     bin_path = None
     for path in search_paths:
         path = pathlib.Path(path)
-        log.d("searching inside {}".format(path))
+        log.d("searching inside {}", path)
 
         try:
             # create a list of all exe files in the folder beeing searched:
@@ -75,7 +80,7 @@ def locate_bin(bin_name, exception):
         for exe in executables:
             if bin_name in exe.lower():
                 bin_path = exe
-                log.d("found ffmpeg bin: {}".format(bin_path))
+                log.d("found ffmpeg bin: {}", bin_path)
                 break
 
         # exe has been found, exit needless loops:
@@ -85,29 +90,255 @@ def locate_bin(bin_name, exception):
         raise exception("Could not locate {} binary anywhere in PATH.".format(bin_name))
 
 
+FSYNC_POLICIES = ["none", "file", "dir"]
+
+
+def temp_output_path(path):
+    # keep the suffix, encoders pick the container by it:
+    path = pathlib.Path(path)
+    return path.with_name(".{}.{}.tmp{}".format(path.stem, os.getpid(), path.suffix))
+
+
+def fsync_dir(path):
+    # directories can't be opened on windows, the rename is durable there anyway:
+    if os.name == "posix":
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_output(path, fsync="file"):
+    """Yield a temporary path next to path and rename it into place on success.
+
+    fsync can be "none" (rename only), "file" (flush the file to disk
+    before renaming) or "dir" (also flush the directory entry afterwards).
+    On any exception the temporary file is removed and path is untouched.
+    """
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError("fsync must be one of: {}".format(", ".join(FSYNC_POLICIES)))
+
+    path = pathlib.Path(path)
+    temp = temp_output_path(path)
+
+    try:
+        yield temp
+
+        if fsync != "none":
+            with open(str(temp), mode='rb+') as f:
+                os.fsync(f.fileno())
+
+        os.replace(str(temp), str(path))
+
+        if fsync == "dir":
+            fsync_dir(path.parent)
+
+    except BaseException:
+        try:
+            os.remove(str(temp))
+        except (FileNotFoundError, PermissionError):
+            pass
+        raise
+
+
+# lines of stderr kept in memory per process of a job:
+STDERR_TAIL = 50
+
+# bytes read from a stderr pipe at once:
+STDERR_CHUNK = 4096
+
+
+def stderr_log_path(job):
+    # job is the (input file name, format) pair the encoders keep:
+    if conf.stderr_log and job[0]:
+        return pathlib.Path(conf.stderr_log) / "{}.{}.log".format(*job)
+    return None
+
+
+def flac_duration(file):
+    """Seconds of audio in a flac file as its STREAMINFO block tells, None if unknown."""
+    info = flac_samples(file)
+    if info is None:
+        return None
+    samples, rate = info
+    return round(samples / rate, 3)
+
+
+def flac_samples(file):
+    """(samples, sample rate) of a flac file as its STREAMINFO block tells, None if unknown."""
+    try:
+        with open(str(file), mode='rb') as f:
+            header = f.read(42)
+    except OSError:
+        return None
+
+    # "fLaC", the header of the first metadata block, which must be STREAMINFO:
+    if len(header) < 42 or header[:4] != b"fLaC" or header[4] & 0x7f != 0:
+        return None
+
+    # after block and frame sizes: 20 bits sample rate, 3 channels, 5 bits
+    # per sample and 36 bits of total samples (0 if not known):
+    fields = int.from_bytes(header[18:26], "big")
+    rate = fields >> 44
+    samples = fields & 0xfffffffff
+    if not rate or not samples:
+        return None
+    return samples, rate
+
+
+class StderrLines:
+    """Non-empty lines of a binary pipe, read a chunk at a time.
+
+    Lines end with \\r (progress lines) or \\n. A read returns whatever
+    the pipe holds, so lines still arrive as soon as they are written.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._lines = deque()
+        self._buffer = b""
+        self._closed = False
+
+    def readline(self):
+        """Return the next line, None once the pipe is closed."""
+        while not self._lines:
+            if self._closed:
+                return None
+
+            chunk = self._stream.read(STDERR_CHUNK)
+            if chunk:
+                *lines, self._buffer = re.split(rb"[\r\n]", self._buffer + chunk)
+            else:
+                lines, self._buffer, self._closed = [self._buffer], b"", True
+
+            for line in lines:
+                line = line.decode("utf-8", errors="replace").strip()
+                if line:
+                    self._lines.append(line)
+
+        return self._lines.popleft()
+
+
+class StderrCapture:
+    """Bounded record of what the processes of one job wrote to stderr.
+
+    Only the last lines of every source (ffmpeg, qaac, lame) are kept in
+    memory, so a job costs the same whatever the length of the track.
+    The full transcript is streamed to log_path when one is given.
+    """
+    def __init__(self, log_path=None, lines=STDERR_TAIL):
+        self._lines = lines
+        self._rings = {}
+        self._lock = Lock()
+        self._log = None
+
+        if log_path:
+            try:
+                self._log = open(str(log_path), mode='w', encoding="utf-8")
+            except OSError as err:
+                log.w("Could not open stderr log {}: {}", log_path, err)
+
+    def append(self, line, source="ffmpeg"):
+        with self._lock:
+            try:
+                self._rings[source].append(line)
+            except KeyError:
+                self._rings[source] = deque([line], maxlen=self._lines)
+
+            if self._log:
+                self._log.write("{}: {}\n".format(source, line))
+
+    def drain(self, stream, source):
+        """Read a binary pipe until it is closed, to be run in a thread."""
+        for line in iter(StderrLines(stream).readline, None):
+            self.append(line, source)
+
+    def start_drain(self, stream, source):
+        thread = Thread(target=self.drain, args=(stream, source))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def tail(self, source=None):
+        with self._lock:
+            if source is not None:
+                return list(self._rings.get(source, ()))
+            return ["{}: {}".format(name, line) for name, ring in self._rings.items() for line in ring]
+
+    def text(self, source=None):
+        return "\n".join(self.tail(source))
+
+    def attach(self, exception):
+        """Keep the tail with exception, as its stderr_tail attribute."""
+        exception.stderr_tail = self.tail()
+        return exception
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+
 class HashProgressBar:
+    """Progress bar shown with -v, drawn by the progress Reporter.
+
+    update() only stores the value so it can be called from hot loops,
+    the bar is redrawn at most REFRESH_RATE times a second. While a
+    BatchDisplay is shown the bar becomes one of its worker lines; audio
+    bars (value in seconds of audio) count towards its total.
+    """
     def __init__(self):
         self._bar = None
+        self._batch = None
         self._maxval = 0
+        self._drawn = None
+        self.value = 0
+
+    @property
+    def maxval(self):
+        return self._maxval
 
-    def create(self, value):
+    def create(self, value, label="", audio=False):
+        self.value = 0
         if conf.verbose:
             self._maxval = value
+            self._drawn = None
+
+            self._batch = Reporter().batch
+            if self._batch:
+                self._batch.start(self, label, audio)
+                return
+
             self._bar = ProgressBar(widgets=[Bar('#'), ' ', Percentage()], maxval=self._maxval)
             self._bar.start()
+            Reporter().add(self)
 
     def update(self, value):
-        try:
-            if value <= self._maxval:
-                self._bar.update(value)
-            else:
-                self._bar.update(self._maxval)
-        except AttributeError:
-            pass
+        self.value = value
+
+    def draw(self):
+        value = min(self.value, self._maxval)
+        if value != self._drawn:
+            self._bar.update(value)
+            self._drawn = value
 
     def finish(self):
-        try:
+        if self._batch:
+            self._batch.finish(self)
+            self._batch = None
+
+        if self._bar:
+            Reporter().remove(self)
+            self.draw()
             self._bar.finish()
             self._bar = None
-        except AttributeError:
-            pass
+
+
+def batch_display(title, jobs):
+    # the progress of a whole batch, shown like the bars only with -v; a
+    # batch within a batch shows as worker lines of the outer one:
+    if conf.verbose and not Reporter().batch:
+        return BatchDisplay(title, jobs, stream=stream)
+    return contextlib.ExitStack()